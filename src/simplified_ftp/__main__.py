@@ -1,10 +1,18 @@
 import argparse
+import asyncio
 import sys
 import signal
 import logging
+import socket
+import os
 
+from aio import AsyncClient, AsyncServer
+from checksum import ALGORITHM, CRC32C, CRC32
 from client import Client
+from message import Message
 from server import Server
+from tracing import profiled
+from workers import Workers
 
 __author__ = "Ayrton Sparling"
 __copyright__ = "Ayrton Sparling"
@@ -62,7 +70,161 @@ def parse_args(args):
         "-s",
         "--send",
         metavar="PATH",
-        help="path to file that client should send to server",
+        help="path to file (or directory) that client should send to server",
+    )
+    parser.add_argument(
+        "--asyncio",
+        dest="asyncio",
+        help="use the asyncio engine instead of the epoll loops",
+        action="store_true")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        metavar="N",
+        type=int,
+        default=0,
+        help="run the server as N processes sharing the port (0 runs a single process)",
+    )
+    parser.add_argument(
+        "-c",
+        "--connections",
+        metavar="N",
+        type=int,
+        default=1,
+        help="number of connections to send a file over in parallel",
+    )
+    parser.add_argument(
+        "-d",
+        "--download",
+        metavar="FILENAME",
+        help="name of a file the client should download from the server",
+    )
+    parser.add_argument(
+        "--download-root",
+        dest="download_root",
+        metavar="PATH",
+        help="directory downloaded files are written to",
+        default="."
+    )
+    parser.add_argument(
+        "--checksums",
+        dest="checksums",
+        help="send and verify checksums (the default)",
+        action="store_true",
+        default=True)
+    parser.add_argument(
+        "--no-checksums",
+        dest="checksums",
+        help="don't send or verify checksums",
+        action="store_false")
+    parser.add_argument(
+        "--checksum-algorithm",
+        dest="checksum_algorithm",
+        help="checksums to send, crc32 is faster without an accelerated crc32c "
+             "(default: %(default)s)",
+        choices=(CRC32C, CRC32),
+        default=ALGORITHM)
+    parser.add_argument(
+        "--no-resume",
+        dest="resume_uploads",
+        help="always send files from the start instead of continuing interrupted uploads",
+        action="store_false")
+    parser.add_argument(
+        "--delta",
+        dest="delta_uploads",
+        help="only send the parts of a file that changed since the server's copy of it",
+        action="store_true")
+    parser.add_argument(
+        "--dedup",
+        dest="chunked_uploads",
+        help="only send the chunks of a file the server doesn't store yet",
+        action="store_true")
+    parser.add_argument(
+        "--chunk-store",
+        dest="chunk_store",
+        help="store uploads as deduplicated chunks (server)",
+        action="store_true")
+    parser.add_argument(
+        "--compression",
+        dest="compression",
+        help="compress uploads that compress well with this codec",
+        choices=('zlib', 'lzma', 'zstd'))
+    parser.add_argument(
+        "--metrics-port",
+        dest="metrics_port",
+        metavar="PORT",
+        type=int,
+        help="serve metrics in the Prometheus text format over HTTP on this port")
+    parser.add_argument(
+        "--metrics-interval",
+        dest="metrics_interval",
+        metavar="SECONDS",
+        type=float,
+        default=0,
+        help="write metrics to the log every SECONDS seconds")
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="write a trace of receives, parsing, disk writes and sends to PATH "
+             "(Chrome trace format)")
+    parser.add_argument(
+        "--trace-sample",
+        dest="trace_sample",
+        metavar="N",
+        type=int,
+        default=1,
+        help="only trace one receive or send out of every N")
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="profile the event loop with cProfile and write the stats to PATH")
+    parser.add_argument(
+        "--edge-triggered",
+        dest="edge_triggered",
+        help="poll connections edge triggered, receiving until their sockets are drained",
+        action="store_true")
+    parser.add_argument(
+        "--listen-backlog",
+        dest="listen_backlog",
+        metavar="N",
+        type=int,
+        default=socket.SOMAXCONN,
+        help="number of connections the kernel queues until the server accepts them")
+    parser.add_argument(
+        "--rate-limit",
+        dest="rate_limit",
+        metavar="BYTES",
+        type=int,
+        default=0,
+        help="bytes per second the server receives and sends over all connections")
+    parser.add_argument(
+        "--ip-rate-limit",
+        dest="ip_rate_limit",
+        metavar="BYTES",
+        type=int,
+        default=0,
+        help="bytes per second the server receives and sends over the connections of one ip")
+    parser.add_argument(
+        "--connection-rate-limit",
+        dest="connection_rate_limit",
+        metavar="BYTES",
+        type=int,
+        default=0,
+        help="bytes per second the server receives and sends over one connection")
+    parser.add_argument(
+        "--maximum-frame-size",
+        dest="maximum_frame_size",
+        metavar="BYTES",
+        type=int,
+        default=16777216,
+        help="largest message the server keeps in memory, larger file parts are written as "
+             "they arrive and other messages are turned down")
+    parser.add_argument(
+        "--protocol-version",
+        dest="protocol_version",
+        help="protocol version the client should send messages with",
+        choices=Message.VERSIONS,
+        default=Message.VERSION
     )
     return parser.parse_args(args)
 
@@ -78,37 +240,81 @@ def setup_logging(loglevel):
                         format=logformat, datefmt="%Y-%m-%d %H:%M:%S")
 
 
-def start_client(port, host):
+def start_client(port, host, config={}):
     """Start a client
 
     Args:
       port (int): port to connect to the server on
       host (str): ip of the server to connect to
+      config (dict): configuration options for the client
 
     Returns:
       :class:`client.Client`: a connected client
     """
-    client = Client(_logger, {})
+    client = Client(_logger, config)
     client.connect(port, host)
 
     return client
 
 
-def start_server(port):
+async def run_async_client(port, host, config, send=None, download=None):
+    """Connect with an asyncio client and run its transfers
+
+    Args:
+      port (int): port to connect to the server on
+      host (str): ip of the server to connect to
+      config (dict): configuration options for the client
+      send (str): path to a file to send to the server
+      download (str): name of a file to download from the server
+    """
+    client = AsyncClient(_logger, config)
+    await client.connect(port, host)
+    try:
+        if send and os.path.isdir(send):
+            await client.sendDirectory(send)
+        elif send:
+            await client.sendFile(send)
+        if download:
+            await client.download(download)
+    finally:
+        await client.close()
+
+
+def start_server(port, engine=Server, config={}):
     """Start a client
 
     Args:
       port (int): port number that the server should listen on
+      engine (class): server class to use, :class:`server.Server` or
+        :class:`aio.AsyncServer`
+      config (dict): configuration options for the server
 
     Returns:
       :class:`server.Server`: a listening server
     """
-    server = Server(_logger, {})
+    server = engine(_logger, config)
     server.listen(port)
 
     return server
 
 
+def start_workers(port, workers, config={}):
+    """Start a group of server processes
+
+    Args:
+      port (int): port number that the servers should listen on
+      workers (int): number of server processes
+      config (dict): configuration options for the servers
+
+    Returns:
+      :class:`workers.Workers`: the listening workers
+    """
+    workers = Workers(_logger, dict(config, workers=workers))
+    workers.listen(port)
+
+    return workers
+
+
 def main(args):
     """Main entry point allowing external calls
 
@@ -119,12 +325,67 @@ def main(args):
     setup_logging(args.loglevel)
     _logger.debug("Starting client...")
 
-    if args.system == 'server':
-        connection = start_server(args.port)
+    checksums = {
+        'checksums': args.checksums,
+        'verify_checksums': args.checksums,
+        'checksum_algorithm': args.checksum_algorithm
+    }
+    metrics = {
+        'metrics_port': args.metrics_port,
+        'metrics_interval': args.metrics_interval,
+        'trace': args.trace,
+        'trace_sample': args.trace_sample,
+        'profile': args.profile
+    }
+    scheduling = {
+        'edge_triggered': args.edge_triggered,
+        'listen_backlog': args.listen_backlog,
+        'rate_limit': args.rate_limit,
+        'ip_rate_limit': args.ip_rate_limit,
+        'connection_rate_limit': args.connection_rate_limit
+    }
+
+    # Workers can't share a metrics port or trace file, each of them logs
+    # its own metrics
+    if args.system == 'server' and args.workers > 0:
+        connection = start_workers(args.port, args.workers, dict(
+            checksums, chunk_store=args.chunk_store, maximum_frame_size=args.maximum_frame_size,
+            metrics_interval=args.metrics_interval, **scheduling))
+    elif args.system == 'server':
+        connection = start_server(
+            args.port, AsyncServer if args.asyncio else Server, dict(
+                checksums, chunk_store=args.chunk_store,
+                maximum_frame_size=args.maximum_frame_size, **metrics, **scheduling))
+    elif args.system == 'client' and args.asyncio:
+        profiled(asyncio.run, args.profile)(run_async_client(args.port, args.host, dict(
+            checksums,
+            download_root=args.download_root,
+            resume_uploads=args.resume_uploads,
+            delta_uploads=args.delta_uploads,
+            chunked_uploads=args.chunked_uploads,
+            compression=args.compression
+        ), args.send, args.download))
+        return
     elif args.system == 'client':
-        connection = start_client(args.port, args.host)
-        if args.send:
+        connection = start_client(args.port, args.host, dict(
+            checksums,
+            **metrics,
+            protocol_version=args.protocol_version,
+            download_root=args.download_root,
+            resume_uploads=args.resume_uploads,
+            delta_uploads=args.delta_uploads,
+            chunked_uploads=args.chunked_uploads,
+            compression=args.compression
+        ))
+        if args.send and os.path.isdir(args.send):
+            connection.commandQueue.put(connection.sendDirectory(args.send))
+        elif args.send and args.connections > 1:
+            connection.commandQueue.put(
+                connection.sendFileParallel(args.send, args.connections))
+        elif args.send:
             connection.commandQueue.put(connection.sendFile(args.send))
+        if args.download:
+            connection.commandQueue.put(connection.download(args.download))
 
     # This function is called when a sigint is caught and closes the server
     def close(sig, frame):
@@ -134,6 +395,11 @@ def main(args):
     # This listens for sigint (ctrl-c) and calls an inline function (lambda) to
     # stop the server (Only works on non-windows)
     signal.signal(signal.SIGINT, close)
+    signal.signal(signal.SIGTERM, close)
+
+    # Workers have to be watched (and restarted) from this process
+    if isinstance(connection, Workers):
+        connection.supervise()
 
 
 def run():
@@ -0,0 +1,571 @@
+from threading import Thread
+from concurrent.futures import Future
+from message import Message, MessageType
+from checksum import ALGORITHM
+from server import Connection, ChecksumCache
+from writer import WriterPool
+from metrics import Metrics
+from tracing import Tracer, profiled
+from uploads import Uploads, Ask, Work
+import itertools
+import asyncio
+import socket
+
+# ################# ASYNCIO ENGINE ###################
+#
+# An alternative to the epoll loops of Server and Client built on asyncio.
+# Both speak the same protocol and handle messages with the same Connection
+# class, only the I/O is driven by an asyncio event loop instead:
+#
+# - Received bytes go straight into the connection's buffer
+#   (asyncio.BufferedProtocol) and are parsed with Message.
+# - Downloads are streamed with loop.sendfile.
+# - AsyncClient exposes awaitable sendFile and download methods so it can be
+#   used from other asyncio programs. Its uploads are the generators the
+#   epoll client sends (see uploads.py), driven by AsyncClient.run.
+
+
+class TransportConnection(Connection):
+    def __init__(self, _logger, address="unknown", config={}, transfers=None, metrics=None,
+                 tracer=None, checksumCache=None):
+        """A Connection that talks through an asyncio transport
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          address (obj): address of the other endpoint
+          config (obj): configuration options, see :class:`server.Connection`
+          transfers (dict): segmented uploads shared with other connections
+          metrics (:class:`metrics.Metrics`): metrics shared with other
+            connections
+          tracer (:class:`tracing.Tracer`): records spans of the connection
+          checksumCache (:class:`server.ChecksumCache`): checksums of
+            downloaded files shared with other connections
+
+        Returns:
+          :class:`TransportConnection`: a connection without a transport yet
+        """
+        super().__init__(_logger, None, address, config, transfers, metrics=metrics,
+                         tracer=tracer, checksumCache=checksumCache)
+        self.transport = None
+
+    def close(self):
+        self.shutdown()
+        self.closeFiles()
+
+    def shutdown(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class Protocol(asyncio.BufferedProtocol):
+    def __init__(self, _logger, connection, connections=None):
+        """Feeds an asyncio transport into a connection
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          connection (:class:`TransportConnection`): handles our messages
+          connections (set): open protocols, we add and remove ourselves
+        """
+        self._logger = _logger
+        self.connection = connection
+        self.connections = connections if connections is not None else set()
+        self.sending = None
+
+    def connection_made(self, transport):
+        self.loop = asyncio.get_event_loop()
+        self.transport = transport
+        self.connection.transport = transport
+        self.connection.address = transport.get_extra_info('peername')
+        self.connections.add(self)
+
+        # Set while the transport will accept more data
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.closed = self.loop.create_future()
+
+        self._logger.info(
+            "New connection from {0}".format(self.connection.address))
+
+    def connection_lost(self, exc):
+        self._logger.debug("Connection to [{}] closed!".format(self.connection.address))
+        self.connections.discard(self)
+        self.connection.closeFiles()
+        self.connection.logStats()
+
+        if self.sending is not None:
+            self.sending.cancel()
+
+        # Anybody waiting to write would wait forever
+        self.writable.set()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def get_buffer(self, sizehint):
+        # Hand out the free end of the connection's buffer, received bytes
+        # are written straight into it
+        connection = self.connection
+        connection.reserveBuffer(max(sizehint, connection.config['internal_recv_size']))
+        return connection.bufferView[connection.bufferEnd:]
+
+    def buffer_updated(self, nbytes):
+        connection = self.connection
+        connection.countReceived(nbytes)
+        connection.startTrace()
+        connection.bufferEnd += nbytes
+        connection.processBuffer()
+        connection.handleWriteFailures()
+        if connection.acking:
+            connection.acknowledge()
+
+        # Start sending if we have to respond to something
+        self.startSending()
+
+        # Stop receiving until our writes catch up
+        if connection.writer is not None and connection.writer.pause():
+            connection.paused = True
+            self.transport.pause_reading()
+
+    def startSending(self):
+        connection = self.connection
+        if connection.wantsToSend() and (self.sending is None or self.sending.done()):
+            self.sending = self.loop.create_task(self.flush())
+
+    def writeFailed(self, owner, err):
+        # A write of one of our uploads failed, called through the event loop
+        self.connection.writeFailed(owner, err)
+        self.connection.handleWriteFailures()
+        if not self.transport.is_closing():
+            self.startSending()
+
+    def resumeReading(self):
+        # Our writes caught up, called through the event loop
+        if self.connection.paused and not self.transport.is_closing():
+            self.connection.paused = False
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    async def drain(self):
+        if self.transport.is_closing():
+            raise ConnectionResetError("Connection closed")
+        await self.writable.wait()
+
+    async def flush(self):
+        """Send responses and downloads queued by our connection"""
+        connection = self.connection
+
+        try:
+            while connection.wantsToSend() and not self.transport.is_closing():
+                # A download part is finished before anything else is sent
+                if len(connection.framing) != 0:
+                    buffer = connection.framing.popleft()
+                    self.transport.write(buffer)
+                    connection.countSent(len(buffer))
+                    await self.drain()
+
+                elif connection.downloadRemaining:
+                    # The kernel copies the file to the socket
+                    sent = await self.loop.sendfile(
+                        self.transport, connection.download,
+                        connection.downloadOffset, connection.downloadRemaining)
+
+                    # The file shrunk while we were sending it, our messages
+                    # are length prefixed so we can't recover
+                    if sent < connection.downloadRemaining:
+                        self._logger.error("{} was truncated while downloading".format(
+                            connection.download.name))
+                        connection.shutdown()
+                        return
+
+                    connection.countSent(sent)
+                    connection.downloadOffset += sent
+                    connection.downloadRemaining = 0
+                    connection.finishDownloadPart()
+
+                elif len(connection.responses) != 0:
+                    buffer = connection.responses.popleft()
+                    self.transport.write(buffer)
+                    connection.countSent(len(buffer))
+                    await self.drain()
+
+                else:
+                    connection.nextDownloadPart()
+        except ConnectionError:
+            connection.shutdown()
+
+
+class AsyncServer:
+    def __init__(self, _logger, config):
+        """Creates an asyncio server
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          config (obj): configuration options, the same as :class:`server.Server`
+
+        Returns:
+          :class:`AsyncServer`: a server that is not listening yet
+        """
+        self._logger = _logger
+
+        # Setup config with defaults
+        self.config = {
+            'file_root': '/tmp',
+            'internal_recv_size': 8192,
+            'internal_buffer_size': 65536,
+            'internal_send_size': 4194304,
+            'download_segment_size': 1048576,
+            'reuse_port': False,
+            'listen_backlog': socket.SOMAXCONN,  # Connections the kernel queues for us
+            'writer_threads': 4,
+            'writer_queue_size': 64,
+            'metrics_port': None,  # Serve metrics over HTTP on this port
+            'metrics_interval': 0,  # Seconds between metrics in the log
+            'trace': None,  # Write a trace of the connections to this path
+            'trace_sample': 1,  # Trace one receive out of this many
+            'profile': None  # Write a cProfile profile of the loop to this path
+        }
+        self.config.update(config)
+
+        # Uploads that are being received over several connections
+        self.transfers = {}
+        self.connections = set()
+
+        # Checksums of the files that were downloaded
+        self.checksumCache = ChecksumCache()
+
+        # What the server is doing, see metrics.py
+        self.metrics = Metrics()
+        self.metricsEndpoint = None
+        self.reporting = None
+        self.metrics.gauge('simftp_connections', "Connections currently open",
+                           lambda: len(self.connections))
+        self.metrics.gauge(
+            'simftp_open_transfers', "Uploads and downloads in progress",
+            lambda: sum(protocol.connection.openTransfers()
+                        for protocol in list(self.connections)))
+
+        # Where its time goes, see tracing.py
+        self.tracer = None
+        if self.config['trace'] is not None:
+            self.tracer = Tracer(self._logger, self.config['trace'], self.config['trace_sample'])
+        self.writerPool = None
+
+        self.loop = None
+        self.server = None
+        self.stopped = None
+
+        # This is set to true when we want the server to stop
+        self.done = False
+
+    def createProtocol(self):
+        connection = TransportConnection(
+            self._logger, config=self.config, transfers=self.transfers, metrics=self.metrics,
+            tracer=self.tracer, checksumCache=self.checksumCache)
+        protocol = Protocol(self._logger, connection, self.connections)
+
+        # Hand the connection's disk writes to the writer threads
+        if self.writerPool is not None:
+            connection.writer = self.writerPool.createQueue(
+                lambda: self.loop.call_soon_threadsafe(protocol.resumeReading),
+                lambda owner, err: self.loop.call_soon_threadsafe(
+                    protocol.writeFailed, owner, err))
+
+        return protocol
+
+    async def start(self, port, addr='0.0.0.0'):
+        """Start accepting connections on the running event loop"""
+        self.loop = asyncio.get_event_loop()
+        self.stopped = asyncio.Event()
+        if self.config['writer_threads'] > 0:
+            self.writerPool = WriterPool(self._logger, self.config)
+        self.server = await self.loop.create_server(
+            self.createProtocol, addr, port, reuse_address=True,
+            reuse_port=self.config['reuse_port'] or None, backlog=self.config['listen_backlog'])
+
+        if self.config['metrics_port'] is not None:
+            self.metricsEndpoint = self.metrics.serve(
+                self._logger, self.config['metrics_port'], addr)
+        if self.config['metrics_interval']:
+            self.reporting = self.loop.create_task(self.report())
+
+        self._logger.debug("Server listening on {}".format(port))
+
+    async def report(self):
+        # Write the metrics to the log every metrics_interval seconds
+        while True:
+            await asyncio.sleep(self.config['metrics_interval'])
+            self._logger.info("Metrics:\n" + self.metrics.exposition())
+
+    async def serve(self, port, addr='0.0.0.0'):
+        """Accept connections until the server is closed"""
+        await self.start(port, addr)
+        try:
+            if not self.done:
+                await self.stopped.wait()
+        finally:
+            self.server.close()
+            await self.server.wait_closed()
+
+            # Close all open connections
+            self._logger.debug("Closing all connections...")
+            for protocol in list(self.connections):
+                protocol.connection.close()
+                await protocol.closed
+
+            # Wait for pending disk writes
+            if self.writerPool is not None:
+                await self.loop.run_in_executor(None, self.writerPool.close)
+
+            if self.reporting is not None:
+                self.reporting.cancel()
+            if self.metricsEndpoint is not None:
+                await self.loop.run_in_executor(None, self.metricsEndpoint.shutdown)
+                self.metricsEndpoint.server_close()
+
+            if self.tracer is not None:
+                self.tracer.close()
+
+            self._logger.info("Server shutdown")
+
+    def listen(self, port, addr='0.0.0.0'):
+        """Serve from an event loop in a new thread, like :meth:`server.Server.listen`"""
+        self.loop = asyncio.new_event_loop()
+        thread = Thread(target=profiled(self.run, self.config['profile']), args=(port, addr))
+        thread.start()
+
+        return thread
+
+    def run(self, port, addr):
+        try:
+            self.loop.run_until_complete(self.serve(port, addr))
+        finally:
+            self.loop.close()
+
+    def close(self):
+        # May be called from any thread
+        self.done = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeUp)
+
+    def wakeUp(self):
+        if self.stopped is not None:
+            self.stopped.set()
+
+
+class ClientConnection(TransportConnection):
+    def __init__(self, _logger, config={}):
+        """A TransportConnection that reports finished downloads
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          config (obj): configuration options, see :class:`server.Connection`
+
+        Returns:
+          :class:`ClientConnection`: a connection without a transport yet
+        """
+        super().__init__(_logger, config=config)
+
+        # Futures of requested downloads and the paths they are written to,
+        # by stream id
+        self.waiting = {}
+        self.receiving = {}
+
+        # Futures of our Resume, Signature and Chunks messages, (type,
+        # filename) -> future
+        self.asking = {}
+
+    def processMessage(self, message):
+        super().processMessage(message)
+
+        key = (message.type, getattr(message, 'filename', None))
+        if key in self.asking and key in self.answers:
+            future = self.asking.pop(key)
+            if not future.done():
+                future.set_result(self.answers.pop(key))
+
+        if message.type == MessageType.FileStart:
+            self.receiving[message.stream] = self.filePath(message.filename)
+
+        # A download ends with a FileEnd or an Error on its stream
+        if message.stream not in self.waiting:
+            return
+        if message.type == MessageType.FileEnd:
+            future = self.waiting.pop(message.stream)
+            if not future.done():
+                future.set_result(self.receiving.pop(message.stream, None))
+        elif message.type == MessageType.Error:
+            future = self.waiting.pop(message.stream)
+            if not future.done():
+                future.set_exception(RuntimeError(str(message.content, 'utf-8', 'replace')))
+
+    def closeFiles(self):
+        super().closeFiles()
+
+        for future in list(self.waiting.values()) + list(self.asking.values()):
+            if not future.done():
+                future.set_exception(ConnectionResetError("Connection closed"))
+        self.waiting.clear()
+        self.asking.clear()
+
+
+class AsyncClient:
+    def __init__(self, logger, config):
+        """Creates an asyncio client
+
+        Args:
+          logger (obj): A logger with a info and debug method
+          config (obj): configuration options
+
+        Returns:
+          :class:`AsyncClient`: a client
+        """
+        self._logger = logger
+
+        # Setup config with defaults
+        self.config = {
+            'file_segment_size': 65536,  # Bytes
+            'download_root': '.',
+            'internal_recv_size': 65536,
+            'checksums': True,  # Send checksums
+            'verify_checksums': True,
+            'checksum_algorithm': ALGORITHM,  # crc32c or crc32, see checksum.py
+            'resume_uploads': True,
+            'answer_timeout': 10,  # Seconds
+            'delta_uploads': False,
+            'chunked_uploads': False,
+            'compression': None  # zlib, lzma or zstd
+        }
+        self.config.update(config)
+
+        # What our uploads send, the same as the epoll client's (see
+        # uploads.py)
+        self.uploads = Uploads(self._logger, self.config)
+
+        self.protocol = None
+
+        # Every upload and download gets a stream of its own, so several of
+        # them can share the connection at once
+        self.streams = itertools.count(1)
+
+    async def connect(self, port, addr='127.0.0.1'):
+        self.loop = asyncio.get_event_loop()
+        self.connection = ClientConnection(self._logger, {
+            'file_root': self.config['download_root'],
+            'internal_recv_size': self.config['internal_recv_size'],
+            'verify_checksums': self.config['verify_checksums']
+        })
+        _, self.protocol = await self.loop.create_connection(
+            lambda: Protocol(self._logger, self.connection), addr, port)
+
+        self._logger.debug(
+            "Client connected to {addr}:{port}".format(addr=addr, port=port))
+
+    async def close(self):
+        self.protocol.transport.close()
+        await self.protocol.closed
+
+        self._logger.info("Client shutdown")
+
+    async def send(self, message, stream=0):
+        message.stream = stream
+        data = message.toBytes()
+        self.protocol.transport.write(data)
+        self.protocol.connection.countSent(len(data))
+        await self.protocol.drain()
+
+    async def ask(self, message, stream=0):
+        """Send a Resume, Signature or Chunks message and wait for its answer
+
+        Returns:
+          :class:`message.Message`: the answer, None if it didn't arrive
+            within answer_timeout
+        """
+        key = (message.type, message.filename)
+        future = self.loop.create_future()
+        self.connection.asking[key] = future
+        try:
+            await self.send(message, stream)
+            return await asyncio.wait_for(future, self.config['answer_timeout'])
+        except asyncio.TimeoutError:
+            self._logger.warning("No answer to {} of {}".format(key[0].name, key[1]))
+            return None
+        finally:
+            self.connection.asking.pop(key, None)
+
+    async def run(self, command):
+        """Drive an upload (see uploads.py) on a stream of its own
+
+        Its Work is run in the loop's default executor, so neither that nor
+        waiting for answers holds up other uploads.
+
+        Args:
+          command (generator): the upload
+
+        Returns:
+          what the upload returned
+        """
+        stream = next(self.streams)
+        value = None
+        error = None
+        while True:
+            try:
+                step = command.send(value) if error is None else command.throw(error)
+            except StopIteration as stop:
+                return stop.value
+
+            value = None
+            error = None
+            try:
+                if isinstance(step, Work):
+                    value = await self.loop.run_in_executor(None, step.function, *step.args)
+                elif isinstance(step, Future):
+                    value = await asyncio.wrap_future(step)
+                elif isinstance(step, Ask):
+                    value = await self.ask(step.message, stream)
+                else:
+                    await self.send(step, stream)
+            except (OSError, RuntimeError) as err:
+                # Raised in the upload, like it is by the epoll client
+                error = err
+
+    async def sendFile(self, filepath):
+        """Send a file to the server
+
+        Returns once every message has been handed to the transport. Several
+        files may be sent at once, each on a stream of its own. See
+        :meth:`uploads.Uploads.sendFile`.
+
+        Args:
+          filepath (str): path of the file to send
+        """
+        await self.run(self.uploads.sendFile(filepath))
+
+    async def sendDirectory(self, dirpath):
+        """Send every file below a directory as one transfer
+
+        See :meth:`uploads.Uploads.sendDirectory`.
+
+        Args:
+          dirpath (str): path of the directory to send
+        """
+        await self.run(self.uploads.sendDirectory(dirpath))
+
+    async def download(self, filename):
+        """Download a file from the server into download_root
+
+        Args:
+          filename (str): name of the file on the server
+
+        Returns:
+          str: path the file was written to
+        """
+        stream = next(self.streams)
+        future = self.loop.create_future()
+        self.connection.waiting[stream] = future
+        await self.send(Message(type=MessageType.Download, filename=filename), stream)
+
+        return await future
@@ -0,0 +1,86 @@
+import struct
+import os
+
+# ################# BATCH UPLOADS ###################
+#
+# A directory is uploaded as one transfer instead of one per file. The
+# client walks the directory as it goes and packs every file into a record,
+# records are sent back to back in the CONTENT of File messages (a message
+# may hold many small files, or a piece of a big one):
+#
+# Record: [PATH LENGTH u16] [SIZE u64] [PATH] [DATA]
+#
+# PATH is the UTF-8 encoded path of the file relative to the directory, with
+# / separators. The server unpacks the files below the directory in its file
+# root as the records arrive.
+
+RECORD_HEADER = struct.Struct("!HQ")
+
+
+def walk(root):
+    """Find the files below a directory, lazily
+
+    Args:
+      root (str): the directory
+
+    Yields:
+      tuple: (path, relative path) of every regular file
+    """
+    for directory, directories, files in os.walk(root):
+        directories.sort()
+        relative = os.path.relpath(directory, root)
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path) or os.path.islink(path):
+                continue
+            if relative == os.curdir:
+                yield path, name
+            else:
+                yield path, "/".join(relative.split(os.sep) + [name])
+
+
+def pack(root, pieceSize):
+    """Pack the files below a directory into records
+
+    Args:
+      root (str): the directory
+      pieceSize (int): largest piece of a file that is read at once
+
+    Yields:
+      bytes: consecutive pieces of the records
+    """
+    for path, name in walk(root):
+        try:
+            file = open(path, 'rb')
+        except OSError:
+            # Files may disappear while we walk
+            continue
+
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            name = name.encode('utf-8')
+            yield RECORD_HEADER.pack(len(name), size) + name
+
+            remaining = size
+            while remaining > 0:
+                piece = file.read(min(pieceSize, remaining))
+                if len(piece) == 0:
+                    raise RuntimeError("{} shrunk while it was being sent".format(path))
+                remaining -= len(piece)
+                yield piece
+
+
+def safePath(root, name):
+    """Join a path received from an endpoint to root, without leaving root
+
+    Args:
+      root (str): the directory files are unpacked to
+      name (str): relative path with / separators
+
+    Returns:
+      str: the path below root
+    """
+    parts = [part for part in name.split('/') if part not in ('', os.curdir)]
+    if len(parts) == 0 or os.pardir in parts or any('\0' in part for part in parts):
+        raise RuntimeError("Invalid path: {}".format(name))
+    return os.path.join(root, *parts)
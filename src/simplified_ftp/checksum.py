@@ -0,0 +1,166 @@
+import struct
+import zlib
+
+# ################# CRC-32C ###################
+#
+# CRC-32C (Castagnoli, reflected polynomial 0x82F63B78) as used by the
+# protocol. Hardware accelerated implementations are used when one of the
+# optional crc32c or google-crc32c packages is installed, otherwise a table
+# driven slicing-by-8 implementation is used.
+#
+# Without an accelerated CRC-32C, the plain CRC-32 (reflected polynomial
+# 0xEDB88320) of zlib is used instead. The sender of a file picks the
+# algorithm and says so in its messages (see message.py), every endpoint
+# understands both.
+#
+# crc32c(data, crc) continues the checksum crc over data, so a checksum can be
+# computed incrementally. combine() joins the checksums of two consecutive
+# pieces of data without looking at the data again.
+
+POLYNOMIAL = 0x82F63B78
+CRC32_POLYNOMIAL = 0xEDB88320
+
+# Names of the algorithms, as configured
+CRC32C = "crc32c"
+CRC32 = "crc32"
+
+
+def _makeTables():
+    tables = [[0] * 256 for _ in range(8)]
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ POLYNOMIAL if crc & 1 else crc >> 1
+        tables[0][byte] = crc
+
+    # tables[n][byte] is the crc of byte followed by n zero bytes
+    for byte in range(256):
+        crc = tables[0][byte]
+        for table in tables[1:]:
+            crc = tables[0][crc & 0xFF] ^ (crc >> 8)
+            table[byte] = crc
+    return tables
+
+
+TABLES = _makeTables()
+
+# Words of 8 bytes for slicing-by-8
+_WORDS = struct.Struct("<II")
+
+
+def crc32cSoftware(data, crc=0):
+    """Continue the CRC-32C crc over data with slicing-by-8
+
+    Args:
+      data (bytes): any bytes-like object
+      crc (int): checksum of the preceding data
+
+    Returns:
+      int: checksum of the preceding data and data
+    """
+    t0, t1, t2, t3, t4, t5, t6, t7 = TABLES
+    data = memoryview(data).cast('B')
+    end = len(data) - len(data) % 8
+
+    crc ^= 0xFFFFFFFF
+    for low, high in _WORDS.iter_unpack(data[:end]):
+        low ^= crc
+        crc = (t7[low & 0xFF] ^ t6[(low >> 8) & 0xFF] ^
+               t5[(low >> 16) & 0xFF] ^ t4[low >> 24] ^
+               t3[high & 0xFF] ^ t2[(high >> 8) & 0xFF] ^
+               t1[(high >> 16) & 0xFF] ^ t0[high >> 24])
+    for byte in data[end:]:
+        crc = t0[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+
+    return crc ^ 0xFFFFFFFF
+
+
+# Use a hardware accelerated implementation if one is installed
+try:
+    from crc32c import crc32c as _crc32c
+
+    def crc32c(data, crc=0):
+        return _crc32c(data, crc)
+
+    IMPLEMENTATION = "crc32c"
+except ImportError:
+    try:
+        from google_crc32c import extend as _extend
+
+        def crc32c(data, crc=0):
+            return _extend(crc, bytes(data))
+
+        IMPLEMENTATION = "google-crc32c"
+    except ImportError:
+        crc32c = crc32cSoftware
+        IMPLEMENTATION = "software"
+
+
+
+def crc32(data, crc=0):
+    return zlib.crc32(data, crc)
+
+
+# The software CRC-32C manages a few MB/s and would limit every transfer to
+# that, zlib's CRC-32 is about as fast as an accelerated CRC-32C
+ACCELERATED = IMPLEMENTATION != "software"
+ALGORITHM = CRC32C if ACCELERATED else CRC32
+
+# The checksum function of each algorithm
+ALGORITHMS = {CRC32C: crc32c, CRC32: crc32}
+
+
+def _matrixTimes(matrix, vector):
+    # Multiply a GF(2) 32x32 matrix (a list of columns) with a vector
+    result = 0
+    column = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[column]
+        vector >>= 1
+        column += 1
+    return result
+
+
+def _matrixSquare(matrix):
+    return [_matrixTimes(matrix, column) for column in matrix]
+
+
+def _zerosOperators(polynomial):
+    # The operators that append 1, 2, 4, ... 2**63 zero bytes to a crc, any
+    # length of zeros is a product of some of them
+    operator = [polynomial] + [1 << bit for bit in range(31)]  # One zero bit
+    for _ in range(3):
+        operator = _matrixSquare(operator)  # Eight zero bits (one byte)
+
+    operators = [operator]
+    for _ in range(63):
+        operators.append(_matrixSquare(operators[-1]))
+    return operators
+
+
+ZEROS_OPERATORS = {CRC32C: _zerosOperators(POLYNOMIAL),
+                   CRC32: _zerosOperators(CRC32_POLYNOMIAL)}
+
+
+def combine(crc1, crc2, length2, algorithm=CRC32C):
+    """Get the checksum of two consecutive pieces of data
+
+    Args:
+      crc1 (int): checksum of the first piece
+      crc2 (int): checksum of the second piece
+      length2 (int): size of the second piece in bytes
+      algorithm (str): algorithm of the checksums, CRC32C or CRC32
+
+    Returns:
+      int: checksum of both pieces
+    """
+    # Append length2 zero bytes to crc1 one power of two at a time
+    operators = ZEROS_OPERATORS[algorithm]
+    power = 0
+    while length2:
+        if length2 & 1:
+            crc1 = _matrixTimes(operators[power], crc1)
+        length2 >>= 1
+        power += 1
+    return crc1 ^ crc2
@@ -0,0 +1,202 @@
+import threading
+import hashlib
+import struct
+import os
+
+# ################# CHUNK STORE ###################
+#
+# Content addressed storage for uploads, identical content is stored (and
+# sent) once no matter which file it belongs to:
+#
+# 1. The client splits a file into content defined chunks, cut wherever a
+#    rolling Gear hash of the last 64 bytes matches a mask. Inserting or
+#    removing bytes only changes the chunks around the edit.
+# 2. It sends the server the manifest of the file, the SHA-256 and the length
+#    of every chunk. The server answers with a bitmap of the chunks it
+#    doesn't have yet.
+# 3. The client sends only those chunks, back to back in the CONTENT of File
+#    messages. The server checks each of them against its hash and stores it
+#    in file_root/.chunks, then keeps the manifest in place of the file.
+#
+# Manifests and bitmaps are packed binary:
+#
+# Manifest: [SHA-256 32 bytes] [LENGTH u32]...
+# Bitmap:   bit i (of byte i // 8, most significant bit first) is set when
+#           chunk i of the manifest has to be sent
+
+MANIFEST_ENTRY = struct.Struct("!32sI")
+
+MINIMUM_CHUNK_SIZE = 16384
+MAXIMUM_CHUNK_SIZE = 262144
+
+# A cut is made where the top 16 bits of the hash are zero, about every
+# 64 KiB after the minimum
+CHUNK_MASK = 0xFFFF << 48
+
+# One random 64 bit number per byte value, derived from the byte so every
+# client cuts the same content into the same chunks
+GEAR = [int.from_bytes(hashlib.sha256(bytes([value])).digest()[:8], 'big')
+        for value in range(256)]
+
+
+def split(data):
+    """Cut data into content defined chunks
+
+    Args:
+      data (bytes): the data to split, may be a mmap
+
+    Yields:
+      tuple: (offset, length) of every chunk
+    """
+    size = len(data)
+    start = 0
+    while start < size:
+        end = min(start + MAXIMUM_CHUNK_SIZE, size)
+        cut = end
+
+        # No cut is made before the minimum size, only the 64 bytes before
+        # it are hashed since the Gear hash forgets older bytes
+        hash = 0
+        position = start + MINIMUM_CHUNK_SIZE
+        for byte in data[position - 64:min(position, end)]:
+            hash = ((hash << 1) + GEAR[byte]) & 0xFFFFFFFFFFFFFFFF
+        for offset, byte in enumerate(data[position:end], position + 1):
+            hash = ((hash << 1) + GEAR[byte]) & 0xFFFFFFFFFFFFFFFF
+            if not hash & CHUNK_MASK:
+                cut = offset
+                break
+
+        yield start, cut - start
+        start = cut
+
+
+def chunkHash(chunk):
+    return hashlib.sha256(chunk).digest()
+
+
+def manifest(data):
+    """Split data into chunks and describe them
+
+    Returns:
+      list: (hash, offset, length) of every chunk
+    """
+    return [(chunkHash(data[offset:offset + length]), offset, length)
+            for offset, length in split(data)]
+
+
+def packManifest(entries):
+    return b"".join(MANIFEST_ENTRY.pack(digest, length) for digest, length in entries)
+
+
+def unpackManifest(packed, size=None):
+    """Get the entries of a packed manifest
+
+    Args:
+      packed (bytes): the manifest
+      size (int): size of the file the manifest describes, if it is known
+
+    Returns:
+      list: (hash, length) of every chunk
+
+    Raises:
+      RuntimeError: if the manifest is invalid or doesn't add up to size
+    """
+    if len(packed) % MANIFEST_ENTRY.size != 0:
+        raise RuntimeError("Invalid manifest length: {}".format(len(packed)))
+    entries = list(MANIFEST_ENTRY.iter_unpack(packed))
+
+    # A chunk is held in memory until it is complete, so its length is
+    # bounded before anything is received
+    for _, length in entries:
+        if not 0 < length <= MAXIMUM_CHUNK_SIZE:
+            raise RuntimeError("Invalid chunk length in manifest: {}".format(length))
+    if size is not None and sum(length for _, length in entries) != size:
+        raise RuntimeError("Manifest describes {} bytes, not {}".format(
+            sum(length for _, length in entries), size))
+    return entries
+
+
+def packBitmap(indexes, count):
+    bitmap = bytearray((count + 7) // 8)
+    for index in indexes:
+        bitmap[index // 8] |= 0x80 >> (index % 8)
+    return bytes(bitmap)
+
+
+def unpackBitmap(bitmap, count):
+    """Get the indexes of the chunks set in a bitmap
+
+    Returns:
+      list: the indexes, None if the bitmap doesn't fit count chunks
+    """
+    if len(bitmap) != (count + 7) // 8:
+        return None
+    return [index for index in range(count) if bitmap[index // 8] & (0x80 >> (index % 8))]
+
+
+def manifestPath(path):
+    # The manifest a file is kept as, next to where the file would be
+    return os.path.join(os.path.dirname(path), ".{}.manifest".format(os.path.basename(path)))
+
+
+class ChunkStore:
+    def __init__(self, root):
+        """Chunks stored by their SHA-256 below root/.chunks
+
+        Chunks are written to a temporary file and renamed into place, so
+        any number of connections (and processes) may store the same chunk
+        at once.
+
+        Args:
+          root (str): the file root of the server
+
+        Returns:
+          :class:`ChunkStore`: a chunk store
+        """
+        self.root = os.path.join(root, '.chunks')
+
+    def path(self, digest):
+        name = digest.hex()
+        return os.path.join(self.root, name[:2], name)
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, digest, chunk):
+        if chunkHash(chunk) != digest:
+            raise RuntimeError("Chunk {} doesn't match its hash".format(digest.hex()))
+
+        path = self.path(digest)
+        if os.path.exists(path):
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tempPath = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tempPath, "wb") as file:
+            file.write(chunk)
+        os.replace(tempPath, path)
+
+    def open(self, digest):
+        return open(self.path(digest), "rb")
+
+    def readManifest(self, path):
+        """Get the manifest a file is kept as
+
+        Returns:
+          list: (hash, length) of every chunk of the file, None if the file
+            isn't kept as a manifest
+        """
+        try:
+            with open(manifestPath(path), "rb") as file:
+                return unpackManifest(file.read())
+        except OSError:
+            return None
+
+    def writeManifest(self, path, entries):
+        # Keep the file as a manifest from now on
+        tempPath = manifestPath(path) + ".tmp"
+        with open(tempPath, "wb") as file:
+            file.write(packManifest(entries))
+        os.replace(tempPath, manifestPath(path))
+        if os.path.exists(path):
+            os.unlink(path)
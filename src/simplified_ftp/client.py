@@ -1,16 +1,53 @@
 from threading import Thread
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from message import Message, MessageType
+from checksum import ALGORITHM
+from server import Connection
+from metrics import Metrics, Reporter
+from tracing import Tracer, profiled
+from uploads import Uploads, Ask, Work
 import queue
 import socket
 import select
+import errno
+import time
 import os
+import itertools
+import uuid
 
 
-def read(file, offset, size):
-    file.seek(offset)
-    fileBuffer = file.read(size)
-    offset += len(fileBuffer)
-    return offset, fileBuffer
+# Round trips may take this much longer than the shortest one before the
+# window shrinks, however short that is
+MINIMUM_QUEUE_DELAY = 0.005
+
+
+class CommandQueue(queue.Queue):
+    def __init__(self, wakeup):
+        """The commands of a client, queueing one wakes its loop up
+
+        Args:
+          wakeup (:class:`socket.socket`): the end of the socket pair the
+            loop doesn't wait on
+
+        Returns:
+          :class:`CommandQueue`: an empty queue
+        """
+        super().__init__()
+        self.wakeup = wakeup
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        wake(self.wakeup)
+
+
+def wake(wakeup):
+    # A full socket buffer already wakes the loop up, a closed one means
+    # there is no loop left to wake
+    try:
+        wakeup.send(b"\0")
+    except OSError:
+        pass
 
 
 class Client:
@@ -29,21 +66,124 @@ class Client:
         # Setup config with defaults
         self.config = {
             'event_timeout': 0.2,
-            'command_queue_timeout': 0.2,
-            'max_concurrent_packets': 5,
-            'file_segment_size': 1024  # Bytes
+            'max_concurrent_packets': 5,  # Smallest window, in file segments
+            'file_segment_size': 1024,  # Bytes
+            'protocol_version': Message.VERSION,
+            'download_root': '.',
+            'internal_recv_size': 65536,
+            'parallel_connections': 4,
+            'checksums': True,  # Send checksums
+            'verify_checksums': True,
+            'checksum_algorithm': ALGORITHM,  # crc32c or crc32, see checksum.py
+            'resume_uploads': True,
+            'answer_timeout': 10,  # Seconds
+            'delta_uploads': False,
+            'chunked_uploads': False,
+            'compression': None,  # zlib, lzma or zstd
+            'max_streams': 16,  # Commands running at once
+            'worker_threads': 2,  # Threads running the slow parts of commands
+            'send_burst': 64,  # Messages sent per writable event
+            'flow_control': True,  # Keep a window of unacknowledged bytes
+            'max_window': 16777216,  # Bytes
+            'metrics_port': None,  # Serve metrics over HTTP on this port
+            'metrics_interval': 0,  # Seconds between metrics in the log
+            'trace': None,  # Write a trace of the client to this path
+            'trace_sample': 1,  # Trace one receive or send out of this many
+            'profile': None  # Write a cProfile profile of the loop to this path
         }
         self.config.update(config)
 
-        self.commandQueue = queue.Queue()
+        # What our uploads send, see uploads.py
+        self.uploads = Uploads(self._logger, self.config)
+
+        # Commands and close wake the loop up through this socket pair, it
+        # waits on our socket otherwise. Unlike the server's pipe both ends
+        # are closed with the client, whenever the loop stops.
+        self.wakeup = socket.socketpair()
+        for end in self.wakeup:
+            end.setblocking(False)
+        self.commandQueue = CommandQueue(self.wakeup[1])
+
+        # Commands being run, (stream id, command, start time, value to
+        # resume it with). Each gets a stream of its own and they take turns
+        # sending messages.
+        self.active = deque()
+        self.streams = itertools.count(1)
+
+        # Commands waiting for the answer to an Ask, ((type, filename),
+        # deadline, entry of active) in the order they asked
+        self.asking = []
+
+        # Commands waiting for a Work or Future, the Futures of our Work
+        # that isn't done yet, and the entries of those whose Future is done
+        # (appended by the thread that finished it, the value to resume them
+        # with is the Future)
+        self.workers = ThreadPoolExecutor(self.config['worker_threads'], 'simftp-work')
+        self.submitted = set()
+        self.working = 0
+        self.worked = deque()
+
+        # What the client is doing, see metrics.py. Our connection adds what
+        # it receives.
+        self.metrics = Metrics()
+        self.metricsEndpoint = None
+        self.sentMessages = self.metrics.counter(
+            'simftp_sent_messages_total', "Messages sent")
+        self.commandSeconds = self.metrics.histogram(
+            'simftp_command_seconds', "Time from starting a command to sending its last message")
+        self.metrics.gauge('simftp_active_commands', "Commands being run",
+                           lambda: len(self.active) + len(self.asking) + self.working)
+
+        # Where its time goes, see tracing.py
+        self.tracer = None
+        if self.config['trace'] is not None:
+            self.tracer = Tracer(self._logger, self.config['trace'], self.config['trace_sample'])
+
+        # Flow control, see windowOpen. Bytes sent on the connection, (bytes
+        # sent up to the end of a message, when it was sent) of the messages
+        # that weren't acknowledged yet, and how many bytes may be in flight.
+        self.flowControl = False
+        self.sent = 0
+        self.acked = 0
+        self.unacknowledged = deque()
+        self.minimumWindow = self.config['max_concurrent_packets'] * self.config['file_segment_size']
+        self.window = self.minimumWindow
+        self.minRtt = None
+        self.lastProgress = time.monotonic()
+        self.lastShrink = 0
+        self.metrics.gauge('simftp_window_bytes', "Bytes that may be in flight",
+                           lambda: self.window)
+        self.metrics.gauge('simftp_in_flight_bytes', "Bytes sent but not acknowledged",
+                           lambda: self.sent - self.acked)
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.done = False
 
+        # Done once the loop stopped and the connection is closed
+        self.stopped = Future()
+
     def connect(self, port, addr='127.0.0.1'):
         self.socket.connect((addr, port))
-        thread = Thread(target=self.loop, args=())
+        self.address = (addr, port)
+
+        # Files the server sends us are received just like the server
+        # receives ours
+        self.connection = Connection(self._logger, self.socket, (addr, port), {
+            'file_root': self.config['download_root'],
+            'verify_checksums': self.config['verify_checksums']
+        }, metrics=self.metrics, tracer=self.tracer)
+
+        # Ask the server to acknowledge what we send, legacy messages can't
+        if self.config['flow_control'] and self.config['protocol_version'] == Message.VERSION:
+            self.flowControl = True
+            self.sendBuffers(Message(type=MessageType.Ack).toBuffers())
+
+        if self.config['metrics_port'] is not None:
+            self.metricsEndpoint = self.metrics.serve(
+                self._logger, self.config['metrics_port'], '127.0.0.1')
+
+        thread = Thread(target=profiled(self.loop, self.config['profile']), args=())
         thread.start()
         self._logger.debug(
             "Client connected to {addr}:{port}".format(addr=addr, port=port))
@@ -51,83 +191,434 @@ class Client:
 
     def close(self):
         self.done = True
+        wake(self.wakeup[1])
+
+    def flush(self, timeout=None):
+        """Wait until the server handled everything we queued
+
+        Args:
+          timeout (float): seconds to wait for acknowledgements once every
+            command was sent, None waits forever
+
+        Returns:
+          bool: True if the server acknowledged everything, False if it
+            didn't in time or we aren't using flow control
+        """
+        self.commandQueue.join()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.flowControl and not self.done:
+            if self.connection.peerAcked >= self.sent:
+                return True
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            time.sleep(0.001)
+        return False
 
     def sendFile(self, filepath):
-        offset = 0
+        """Send a file to the server
+
+        See :meth:`uploads.Uploads.sendFile`.
+
+        Args:
+          filepath (str): path of the file to send
+        """
+        return self.uploads.sendFile(filepath)
+
+    def sendDirectory(self, dirpath):
+        """Send every file below a directory as one transfer
+
+        See :meth:`uploads.Uploads.sendDirectory`.
+
+        Args:
+          dirpath (str): path of the directory to send
+        """
+        return self.uploads.sendDirectory(dirpath)
+
+    def sendFileRange(self, filepath, transfer, offset, length):
+        """Send one byte range of a file that is uploaded over several connections
+
+        See :meth:`uploads.Uploads.sendFileRange`.
+
+        Args:
+          filepath (str): path of the file to send
+          transfer (str): id of the upload, shared by all of its ranges
+          offset (int): where the range starts in the file
+          length (int): size of the range in bytes
+        """
+        return self.uploads.sendFileRange(filepath, transfer, offset, length)
+
+    def sendFileParallel(self, filepath, connections=None):
+        """Send a file as byte ranges over several connections at once
+
+        The server writes every range straight into place and only creates
+        the file once all of them have arrived. This connection sends the
+        first range, the others are sent by extra clients that close once
+        they are done. They are connected on a worker thread and waited for
+        without holding up the loop.
+
+        Args:
+          filepath (str): path of the file to send
+          connections (int): number of connections to use, defaults to the
+            parallel_connections config option
+        """
+        if connections is None:
+            connections = self.config['parallel_connections']
+
+        transfer = uuid.uuid4().hex
+        size = os.path.getsize(filepath)
         segmentSize = self.config['file_segment_size']
-        endSent = False
-        filename = os.path.basename(filepath)
-
-        # Open a file to read from
-        with open(filepath, 'rb') as file:
-
-            # Create file start message
-            offset, fileBuffer = read(file, offset, segmentSize)
-            yield Message(type=MessageType.FileStart, filename=filename, content=fileBuffer)
-
-            # Create file part or file end message depending on size of fileBuffer
-            offset, fileBuffer = read(file, offset, segmentSize)
-            while len(fileBuffer) != 0:
-                if len(fileBuffer) < segmentSize:
-                    yield Message(type=MessageType.FileEnd, content=fileBuffer)
-                    endSent = True
-                    break
+
+        # Split the file into ranges on segment boundaries
+        rangeSize = -(-size // max(connections, 1))
+        rangeSize = max(-(-rangeSize // segmentSize) * segmentSize, segmentSize)
+        ranges = [(offset, min(rangeSize, size - offset))
+                  for offset in range(0, size, rangeSize)] or [(0, 0)]
+
+        helpers = yield Work(self.connectHelpers, filepath, transfer, ranges[1:])
+
+        yield from self.sendFileRange(filepath, transfer, *ranges[0])
+
+        # Wait for the other ranges to go out
+        for helper in helpers:
+            yield helper.stopped
+
+    def connectHelpers(self, filepath, transfer, ranges):
+        # Connect a client for each of ranges, that sends it and closes
+        helpers = []
+        try:
+            for offset, length in ranges:
+                helper = Client(self._logger, self.config)
+                helper.connect(self.address[1], self.address[0])
+                helpers.append(helper)
+                helper.commandQueue.put(
+                    helper.closing(helper.sendFileRange(filepath, transfer, offset, length)))
+        except OSError:
+            for helper in helpers:
+                helper.close()
+            raise
+        return helpers
+
+    def closing(self, command):
+        # Run a command and close the client once it is done (or failed)
+        try:
+            yield from command
+        finally:
+            self.close()
+
+    def ping(self):
+        # An Ack without a count makes the server acknowledge everything it
+        # received, which tells us the connection still works
+        yield Message(type=MessageType.Ack)
+
+    def download(self, filename):
+        # The server answers with the file, which our connection writes to
+        # download_root as it arrives
+        yield Message(type=MessageType.Download, filename=filename)
+
+    def startCommands(self):
+        # Start the queued commands, as many as we may run at once. Legacy
+        # messages have no stream id so those commands run one at a time.
+        limit = self.config['max_streams']
+        if self.config['protocol_version'] != Message.VERSION:
+            limit = 1
+
+        try:
+            while len(self.active) + len(self.asking) + self.working < limit:
+                command = self.commandQueue.get(False)
+                self.active.append((next(self.streams), command, time.monotonic(), None))
+        except queue.Empty:
+            pass
+
+    def resumeAsking(self):
+        # Resume the commands whose answer arrived, or that waited too long
+        # for it
+        now = time.monotonic()
+        asking = []
+        for key, deadline, entry in self.asking:
+            if key in self.connection.answers:
+                answer = self.connection.answers.pop(key)
+            elif now >= deadline:
+                self._logger.warning("No answer to {} of {}".format(key[0].name, key[1]))
+                answer = None
+            else:
+                asking.append((key, deadline, entry))
+                continue
+            stream, command, started, _ = entry
+            self.active.append((stream, command, started, answer))
+        self.asking = asking
+
+    def waitFor(self, future, entry):
+        # Set a command aside until future is done, the loop is woken up
+        # then
+        def done(future):
+            stream, command, started, _ = entry
+            self.worked.append((stream, command, started, future))
+            wake(self.wakeup[1])
+
+        self.working += 1
+        future.add_done_callback(done)
+
+    def resumeWorked(self):
+        # Resume the commands whose Work is done
+        while len(self.worked) != 0:
+            self.working -= 1
+            self.active.append(self.worked.popleft())
+
+    def sendBuffers(self, buffers):
+        """Send the buffers of a message with one gathering system call
+
+        Args:
+          buffers (list): the buffers, see Message.toBuffers
+
+        Returns:
+          int: the size of the message
+        """
+        # Note when a message leaves so its acknowledgement measures the
+        # round trip time
+        now = time.monotonic()
+        if self.sent == self.acked:
+            self.lastProgress = now
+
+        size = sum(len(buffer) for buffer in buffers)
+        remaining = size
+        while True:
+            try:
+                sent = self.socket.sendmsg(buffers)
+            except OSError as err:
+                # A mapped file shrunk after readMapped checked it, part of
+                # the message may be gone already
+                if err.errno == errno.EFAULT:
+                    raise RuntimeError("A file shrunk while it was being sent")
+                raise
+            remaining -= sent
+            if remaining == 0:
+                break
+
+            # Interrupted after part of the message, skip what was sent
+            while sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+        self.sent += size
+        self.connection.countSent(size)
+        if self.flowControl:
+            self.unacknowledged.append((self.sent, now))
+        return size
+
+    def windowOpen(self):
+        """Tell if we may send more, adapting the window to acknowledgements
+
+        The window grows by every acknowledged byte (doubling every round
+        trip) while round trips stay close to the shortest one we measured.
+        Longer round trips mean data is queuing up on the way, in the
+        server's socket buffer or its disk writes, so the window shrinks by a
+        quarter, at most once per round trip.
+
+        Returns:
+          bool: True if fewer than window bytes are unacknowledged
+        """
+        if not self.flowControl:
+            return True
+
+        acked = self.connection.peerAcked
+        if acked > self.acked:
+            now = time.monotonic()
+            sample = None
+            while len(self.unacknowledged) != 0 and self.unacknowledged[0][0] <= acked:
+                sample = self.unacknowledged.popleft()
+            newlyAcked = acked - self.acked
+            self.acked = acked
+            self.lastProgress = now
+
+            if sample is not None:
+                rtt = now - sample[1]
+                self.minRtt = rtt if self.minRtt is None else min(self.minRtt, rtt)
+                if rtt - self.minRtt > max(self.minRtt, MINIMUM_QUEUE_DELAY):
+                    if now - self.lastShrink >= rtt:
+                        self.window = max(int(self.window * 0.75), self.minimumWindow)
+                        self.lastShrink = now
                 else:
-                    yield Message(type=MessageType.FilePart, content=fileBuffer)
-                    offset, fileBuffer = read(file, offset, segmentSize)
+                    self.window = min(self.window + newlyAcked, self.config['max_window'])
+
+        return self.sent - self.acked < self.window
+
+    def drain(self):
+        # Closing a socket with unread data resets the connection, which
+        # throws away what the server didn't receive yet. Wait until it
+        # acknowledged everything, reading its acknowledgements.
+        deadline = time.monotonic() + self.config['answer_timeout']
+        while self.flowControl and self.connection.peerAcked < self.sent:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._logger.warning("Server didn't acknowledge everything we sent")
+                return
+            readable, _, _ = select.select([self.socket], [], [], remaining)
+            if readable and self.connection.recv(self.config['internal_recv_size']) == 0:
+                return
+
+    def checkAcknowledgements(self):
+        # A server that never acknowledged anything doesn't understand Acks,
+        # carry on without flow control
+        if (self.flowControl and self.connection.peerAcked == 0 and self.sent > 0 and
+                time.monotonic() - self.lastProgress > self.config['answer_timeout']):
+            self._logger.warning("Server doesn't acknowledge messages, sending without flow control")
+            self.flowControl = False
+            self.unacknowledged.clear()
+
+    def sendMessages(self):
+        # Send a message of every running command in turn, so a big file
+        # doesn't hold up the ones queued after it
+        tracing = self.tracer is not None and self.tracer.sampled()
+        if tracing:
+            traceStarted = time.perf_counter()
+            sent = 0
+
+        budget = self.config['send_burst']
+        while budget > 0 and len(self.active) != 0 and self.windowOpen():
+            stream, command, started, value = self.active[0]
+            try:
+                if not isinstance(value, Future):
+                    message = command.send(value)
+                elif value.exception() is not None:
+                    message = command.throw(value.exception())
+                else:
+                    message = command.send(value.result())
+            except StopIteration:
+                self.active.popleft()
+                self.commandQueue.task_done()
+                self.commandSeconds.observe(time.monotonic() - started)
+                continue
+            except (OSError, RuntimeError) as err:
+                # Give up on the command, eg. a file that shrunk
+                self._logger.error("Command failed: {}".format(err))
+                self.active.popleft()
+                self.commandQueue.task_done()
+                continue
+
+            # Work and questions set the command aside until they are done
+            # (see resumeWorked) or answered (see resumeAsking), an earlier
+            # answer would be stale by now
+            if isinstance(message, Work):
+                message = self.workers.submit(message.function, *message.args)
+                self.submitted.add(message)
+                message.add_done_callback(self.submitted.discard)
+            if isinstance(message, Future):
+                self.active.popleft()
+                self.waitFor(message, (stream, command, started, None))
+                continue
+            elif isinstance(message, Ask):
+                self.active.popleft()
+                self.connection.answers.pop(message.key, None)
+                self.asking.append((message.key, time.monotonic() + self.config['answer_timeout'],
+                                    (stream, command, started, None)))
+                message = message.message
+            else:
+                self.active[0] = (stream, command, started, None)
+                self.active.rotate(-1)
+
+            message.stream = stream
+            try:
+                size = self.sendBuffers(message.toBuffers())
+            except RuntimeError as err:
+                # Whatever follows a partly sent message would be garbled
+                self._logger.error("Closing connection: {}".format(err))
+                self.done = True
+                return
+            self._logger.debug("Sent a %s message of %d bytes", message.type.name, size)
+            self.sentMessages.inc()
+            budget -= 1
 
-            # Close our file
-            file.close()
+            if tracing:
+                sent += size
 
-        # If we happened to send the entire file but not send a file end, lets do that now
-        if not endSent:
-            yield Message(type=MessageType.FileEnd, content=b"")
+        if tracing:
+            self.tracer.record('send', traceStarted, bytes=sent,
+                               messages=self.config['send_burst'] - budget)
 
     def loop(self):
         # See http://scotdoyle.com/python-epoll-howto.html for a detailed
         # explination on the epoll interface
         epoll = select.epoll()
-        epoll.register(self.socket.fileno(), select.EPOLLOUT)
+        mode = select.EPOLLIN
+        epoll.register(self.socket.fileno(), mode)
+        epoll.register(self.wakeup[0].fileno(), select.EPOLLIN)
+
+        loopSeconds = self.metrics.histogram(
+            'simftp_loop_seconds', "Time spent handling the events of one epoll wait")
+        reporter = Reporter(self._logger, self.metrics, self.config['metrics_interval'])
         try:
             while not self.done:
                 # Get any epoll events, return [] if none are found by event_timeout
                 events = epoll.poll(self.config['event_timeout'])
+                started = time.perf_counter()
 
                 # Process events from epoll
                 for fileno, event in events:
 
+                    # Commands were queued (they are started below) or we
+                    # are being closed
+                    if fileno == self.wakeup[0].fileno():
+                        self.wakeup[0].recv(4096)
+                        continue
+
                     # If socket is in EPOLLOUT state
                     if event & select.EPOLLOUT:
-                        try:
-
-                            # Check for commands to process
-                            command = self.commandQueue.get(
-                                True, self.config['command_queue_timeout'])
 
-                            # Commands are generators so we can iterate over them
-                            # to get all of their messages.
-                            for message in command:
-                                msgBytes = message.toBytes()
-                                self._logger.debug(
-                                    "Sending: {}".format(msgBytes))
-                                self.socket.send(msgBytes)
-
-                                # After download message switch to epoll in
-                                # epoll.modify(fileno, EPOLIN)
-
-                        except queue.Empty:
-                            continue
+                        # Commands are generators so we can iterate over
+                        # them to get all of their messages.
+                        self.sendMessages()
 
                     if event & select.EPOLLIN:
-                        self._logger.debug(
-                            "Got data {}".format(self.socket.recv(10)))
+                        # Receive any files or errors the server sent us
+                        if self.connection.recv(self.config['internal_recv_size']) == 0:
+                            self._logger.info("Server closed connection.")
+                            self.done = True
 
                     elif event & select.EPOLLHUP:
                         self._logger.info("Server closed connection.")
+                        self.done = True
+
+                # Only wait to send while we have something to send and our
+                # window isn't full
+                self.resumeWorked()
+                self.resumeAsking()
+                self.startCommands()
+                self.checkAcknowledgements()
+                if len(self.active) != 0 and self.windowOpen():
+                    wanted = select.EPOLLOUT | select.EPOLLIN
+                else:
+                    wanted = select.EPOLLIN
+                if wanted != mode and not self.done:
+                    mode = wanted
+                    epoll.modify(self.socket.fileno(), mode)
+
+                if len(events) != 0:
+                    loopSeconds.observe(time.perf_counter() - started)
+                reporter.tick()
         finally:
 
+            # Work that didn't start yet is dropped with its command
+            # (shutdown only cancels it itself from Python 3.9 on)
+            for future in list(self.submitted):
+                future.cancel()
+            self.workers.shutdown(wait=True)
+
             epoll.unregister(self.socket.fileno())
+            epoll.unregister(self.wakeup[0].fileno())
             epoll.close()
-            self.socket.close()
+
+            for end in self.wakeup:
+                end.close()
+            self.drain()
+            self.connection.close()
+
+            if self.metricsEndpoint is not None:
+                self.metricsEndpoint.shutdown()
+                self.metricsEndpoint.server_close()
+
+            if self.tracer is not None:
+                self.tracer.close()
 
             self._logger.info("Client shutdown")
+            self.stopped.set_result(None)
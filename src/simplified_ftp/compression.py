@@ -0,0 +1,187 @@
+import zlib
+
+# ################# COMPRESSION ###################
+#
+# File content of an upload may be compressed as one stream, named in the
+# "compression" field of its FileStart. The CONTENT of the File messages are
+# consecutive pieces of that stream (a piece may be empty, or hold what the
+# compressor had left to say at the end in the FileEnd), so every segment
+# benefits from the ones before it. Checksums of messages cover what was
+# sent, the checksum of the whole file covers the uncompressed data.
+#
+# zlib is always available, lzma and zstd (the optional zstandard package)
+# are used when installed. Data that doesn't compress is sent as is, which
+# is decided by compressing a sample of it.
+#
+# The FileStart of a compressed upload holds no content, so a receiver that
+# doesn't support its codec turns it down (with an Error) before any content
+# arrives. Receivers decompress a bounded piece at a time and never more than
+# the announced size of the file.
+
+# Use lzma and zstd if they are installed
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ('zlib',) + (('lzma',) if lzma is not None else ()) + (
+    ('zstd',) if zstandard is not None else ())
+
+# What the decompressors raise on corrupt data
+ERRORS = (zlib.error, EOFError) + ((lzma.LZMAError,) if lzma is not None else ()) + (
+    (zstandard.ZstdError,) if zstandard is not None else ())
+
+# Bytes from the start of an upload that are compressed to see if the rest
+# is worth it, and the largest compressed to uncompressed ratio that is
+SAMPLE_SIZE = 65536
+MAXIMUM_RATIO = 0.9
+
+# Most bytes decompressed at once
+PIECE_SIZE = 1048576
+
+# zstd decompresses all it can at once, so it is fed this many bytes at a
+# time. Each byte of a zstd stream decompresses to at most 32 KB.
+ZSTD_INPUT_SIZE = 32
+
+
+class Compressor:
+    def __init__(self, codec):
+        """Compresses the content of one upload as a stream
+
+        Args:
+          codec (str): one of CODECS
+
+        Returns:
+          :class:`Compressor`: a compressor at the start of its stream
+        """
+        self.codec = codec
+        if codec == 'zlib':
+            self.stream = zlib.compressobj(6)
+        elif codec == 'lzma' and lzma is not None:
+            self.stream = lzma.LZMACompressor(preset=1)
+        elif codec == 'zstd' and zstandard is not None:
+            self.stream = zstandard.ZstdCompressor(level=3).compressobj()
+        else:
+            raise RuntimeError("Unsupported compression: {}".format(codec))
+
+    def compress(self, data):
+        return self.stream.compress(data)
+
+    def flush(self):
+        # The rest of the stream, nothing may be compressed after this
+        return self.stream.flush()
+
+
+class Decompressor:
+    def __init__(self, codec):
+        """Decompresses the content of one upload
+
+        Args:
+          codec (str): the compression named in the upload's FileStart
+
+        Returns:
+          :class:`Decompressor`: a decompressor at the start of its stream
+        """
+        self.codec = codec
+        if codec == 'zlib':
+            self.stream = zlib.decompressobj()
+        elif codec == 'lzma' and lzma is not None:
+            self.stream = lzma.LZMADecompressor()
+        elif codec == 'zstd' and zstandard is not None:
+            self.stream = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            raise RuntimeError("Unsupported compression: {}".format(codec))
+
+    def decompress(self, data, maxLength=PIECE_SIZE):
+        """Decompress the next part of the stream
+
+        Args:
+          data (bytes): the next bytes of the stream
+          maxLength (int): most bytes to return at once
+
+        Yields:
+          bytes: consecutive pieces of the decompressed data
+        """
+        try:
+            if self.codec == 'zlib':
+                yield from self.decompressZlib(data, maxLength)
+            elif self.codec == 'lzma':
+                yield from self.decompressLzma(data, maxLength)
+            else:
+                yield from self.decompressZstd(data, maxLength)
+        except ERRORS as err:
+            raise RuntimeError("Invalid {} stream: {}".format(self.codec, err))
+
+    def decompressZlib(self, data, maxLength):
+        # What doesn't fit is left in unconsumed_tail, a piece of maxLength
+        # may be followed by more even without one
+        while True:
+            piece = self.stream.decompress(data, maxLength)
+            if len(piece) != 0:
+                yield piece
+            data = self.stream.unconsumed_tail
+            if len(data) == 0 and len(piece) < maxLength:
+                return
+
+    def decompressLzma(self, data, maxLength):
+        # What doesn't fit is kept by the decompressor until asked for more
+        piece = self.stream.decompress(data, maxLength)
+        while True:
+            if len(piece) != 0:
+                yield piece
+            if self.stream.needs_input or self.stream.eof:
+                return
+            piece = self.stream.decompress(b"", maxLength)
+
+    def decompressZstd(self, data, maxLength):
+        # Pieces may exceed maxLength by what ZSTD_INPUT_SIZE bytes make
+        data = memoryview(data)
+        pending = []
+        size = 0
+        for start in range(0, len(data), ZSTD_INPUT_SIZE):
+            piece = self.stream.decompress(data[start:start + ZSTD_INPUT_SIZE])
+            pending.append(piece)
+            size += len(piece)
+            if size >= maxLength:
+                yield b"".join(pending)
+                pending = []
+                size = 0
+        if size != 0:
+            yield b"".join(pending)
+
+
+def worthCompressing(sample):
+    """Tell if data is worth compressing from a sample of it
+
+    Already compressed data (archives, images, video...) only costs CPU to
+    compress again.
+
+    Args:
+      sample (bytes): the start of the data
+
+    Returns:
+      bool: True if the sample compresses well
+    """
+    if len(sample) == 0:
+        return False
+    return len(zlib.compress(sample, 1)) <= len(sample) * MAXIMUM_RATIO
+
+
+def compressorFor(codec, sample):
+    """Get a compressor for data, if it is worth compressing
+
+    Args:
+      codec (str): the preferred codec, zlib is used if it isn't available
+      sample (bytes): the start of the data
+
+    Returns:
+      :class:`Compressor`: None if the data should be sent as is
+    """
+    if not worthCompressing(sample):
+        return None
+    return Compressor(codec if codec in CODECS else 'zlib')
@@ -0,0 +1,252 @@
+from itertools import accumulate
+import hashlib
+import struct
+import math
+import os
+
+# ################# DELTA TRANSFERS ###################
+#
+# rsync style delta encoding, used to upload a new version of a file the
+# server already has a copy of:
+#
+# 1. The server splits its copy (the basis) into blocks and sends a signature
+#    of every whole block, a weak rolling checksum and a strong hash.
+# 2. The client slides a window over the new file one byte at a time. Where
+#    the weak checksum of the window matches a block (and the strong hash
+#    confirms it) it refers to that block instead of sending it.
+# 3. The server rebuilds the new file from the literal data and the blocks
+#    of its basis the client referred to.
+#
+# Operations are packed back to back into the CONTENT of File messages:
+#
+# Literal: [0] [LENGTH u32] [DATA]
+# Copy:    [1] [FIRST BLOCK u32] [BLOCK COUNT u32]
+
+LITERAL = 0
+COPY = 1
+
+# A weak checksum and a strong hash per block
+SIGNATURE = struct.Struct("!I16s")
+
+LITERAL_HEADER = struct.Struct("!BI")
+COPY_OPERATION = struct.Struct("!BII")
+
+MINIMUM_BLOCK_SIZE = 2048
+MAXIMUM_BLOCK_SIZE = 131072
+
+# Most bytes a single copy may refer to, the server reads them at once
+MAXIMUM_COPY_SIZE = 4194304
+
+
+def blockSize(size):
+    """Pick a block size for a basis of size bytes
+
+    Larger files get larger blocks so their signatures stay small.
+    """
+    size = int(math.sqrt(size)) // 1024 * 1024
+    return min(max(size, MINIMUM_BLOCK_SIZE), MAXIMUM_BLOCK_SIZE)
+
+
+def weakChecksum(block):
+    """Get the rolling checksum of a block
+
+    Returns:
+      tuple: the two 16 bit halves (a, b) of the checksum
+    """
+    # b is the sum of (len(block) - i) * block[i], which is the sum of the
+    # running totals of the block
+    return sum(block) & 0xFFFF, sum(accumulate(block)) & 0xFFFF
+
+
+def strongHash(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def signatures(file, blockSize):
+    """Get the signatures of every whole block of a file
+
+    Args:
+      file (obj): the basis file, opened for reading
+      blockSize (int): size of a block in bytes
+
+    Returns:
+      bytes: the packed signatures
+    """
+    packed = bytearray()
+    offset = 0
+    while True:
+        block = os.pread(file.fileno(), blockSize, offset)
+        if len(block) < blockSize:
+            return bytes(packed)
+        a, b = weakChecksum(block)
+        packed += SIGNATURE.pack(a | b << 16, strongHash(block))
+        offset += blockSize
+
+
+def signatureTable(packed):
+    # weak checksum -> {strong hash: block number}
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(packed)):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+
+def operations(data, blockSize, table):
+    """Find the blocks of the basis in new data
+
+    Searching gives up once more than half of the data had to be sent as
+    literals, at that point the rest is sent as is since the search costs
+    more than it can save.
+
+    Args:
+      data (bytes): the new file, may be a mmap
+      blockSize (int): size of the basis' blocks
+      table (dict): see :func:`signatureTable`
+
+    Yields:
+      tuple: (LITERAL, start, end) for data[start:end] or (COPY, block
+        number, offset) for the block found at data[offset:offset + blockSize]
+    """
+    size = len(data)
+    offset = 0
+    literalStart = 0
+    literals = 0
+
+    if size >= blockSize and table:
+        a, b = weakChecksum(data[:blockSize])
+
+    while offset + blockSize <= size and table:
+        candidates = table.get(a | b << 16)
+        if candidates is not None:
+            index = candidates.get(strongHash(data[offset:offset + blockSize]))
+            if index is not None:
+                if literalStart < offset:
+                    yield LITERAL, literalStart, offset
+                    literals += offset - literalStart
+                yield COPY, index, offset
+
+                offset += blockSize
+                literalStart = offset
+                if offset + blockSize <= size:
+                    a, b = weakChecksum(data[offset:offset + blockSize])
+                continue
+
+        if literals + offset - literalStart > size // 2:
+            break
+
+        # Roll the window one byte forward
+        if offset + blockSize < size:
+            removed = data[offset]
+            a = (a - removed + data[offset + blockSize]) & 0xFFFF
+            b = (b - blockSize * removed + a) & 0xFFFF
+        offset += 1
+
+    if literalStart < size:
+        yield LITERAL, literalStart, size
+
+
+def encode(data, blockSize, table, segmentSize):
+    """Pack the operations that rebuild data
+
+    Args:
+      data (bytes): the new file, may be a mmap
+      blockSize (int): size of the basis' blocks
+      table (dict): see :func:`signatureTable`
+      segmentSize (int): size to pack the operations into
+
+    Yields:
+      bytes: packed operations of about segmentSize bytes each
+    """
+    packed = bytearray()
+    maximumRun = max(MAXIMUM_COPY_SIZE // blockSize, 1)
+
+    # Consecutive blocks are referred to at once, [first block, count]
+    run = None
+
+    for operation, first, second in operations(data, blockSize, table):
+        if operation == COPY:
+            if run is not None and sum(run) == first and run[1] < maximumRun:
+                run[1] += 1
+                continue
+            if run is not None:
+                packed += COPY_OPERATION.pack(COPY, *run)
+            run = [first, 1]
+
+        else:
+            if run is not None:
+                packed += COPY_OPERATION.pack(COPY, *run)
+                run = None
+
+            # Split literals so they fill up the segment
+            start, end = first, second
+            while start < end:
+                length = min(end - start, segmentSize - len(packed))
+                packed += LITERAL_HEADER.pack(LITERAL, length)
+                packed += data[start:start + length]
+                start += length
+                if len(packed) >= segmentSize:
+                    yield bytes(packed)
+                    packed = bytearray()
+
+        if len(packed) >= segmentSize:
+            yield bytes(packed)
+            packed = bytearray()
+
+    if run is not None:
+        packed += COPY_OPERATION.pack(COPY, *run)
+    if len(packed) != 0:
+        yield bytes(packed)
+
+
+def patch(content, basis, blockSize):
+    """Rebuild data from operations and the basis they refer to
+
+    Args:
+      content (bytes): packed operations
+      basis (int): file descriptor of the basis
+      blockSize (int): size of the basis' blocks
+
+    Yields:
+      bytes: consecutive pieces of the new data, literals are views into
+        content
+
+    Raises:
+      RuntimeError: the operations are invalid, or copy more (or other)
+        blocks than the basis has
+    """
+    content = memoryview(content)
+    basisSize = os.fstat(basis).st_size
+    position = 0
+    while position < len(content):
+        operation = content[position]
+
+        if operation == LITERAL:
+            if position + LITERAL_HEADER.size > len(content):
+                raise RuntimeError("Truncated literal in delta")
+            _, length = LITERAL_HEADER.unpack_from(content, position)
+            position += LITERAL_HEADER.size
+            if position + length > len(content):
+                raise RuntimeError("Truncated literal in delta")
+            yield content[position:position + length]
+            position += length
+
+        elif operation == COPY:
+            if position + COPY_OPERATION.size > len(content):
+                raise RuntimeError("Truncated copy in delta")
+            _, first, count = COPY_OPERATION.unpack_from(content, position)
+            position += COPY_OPERATION.size
+
+            # The counts come from the endpoint, check them before reading
+            if count * blockSize > MAXIMUM_COPY_SIZE:
+                raise RuntimeError("Delta copies {} blocks at once".format(count))
+            if (first + count) * blockSize > basisSize:
+                raise RuntimeError("Delta refers to blocks {}-{} past the end of its basis".format(
+                    first, first + count))
+            blocks = os.pread(basis, count * blockSize, first * blockSize)
+            if len(blocks) != count * blockSize:
+                raise RuntimeError("Delta refers to blocks {}-{} past the end of its basis".format(
+                    first, first + count))
+            yield blocks
+
+        else:
+            raise RuntimeError("Invalid delta operation: {}".format(operation))
@@ -1,8 +1,15 @@
-from enum import IntFlag, unique
+from enum import IntEnum, IntFlag, unique
+from checksum import crc32c, crc32, combine, CRC32C, CRC32
+import json
+import struct
 
 # ################# PROTOCOL DEFINITION ###################
 #
-# Checksums are CRC-32C. All messages end it a \0 termination character.
+# Checksums are CRC-32C, or CRC-32 where the Crc32 flag says so.
+#
+# ### Version 0.1
+#
+# All messages end it a \0 termination character.
 #
 # Messages are UTF-8 encoded with a binary CONTENT field.
 #
@@ -12,121 +19,837 @@ from enum import IntFlag, unique
 #   Example: SimFTP/0.1 1 laseuybjaw3blk23r89nzjx
 # FileEnd: [PROTOCOL]/[VERSION] [TYPE] [CONTENT]
 #   Example: SimFTP/0.1 2 laseuybjaw3blk23r89nzjx
-# TODO: Error: [PROTOCOL]/[VERSION] [TYPE] [CONTENT]
-#   Example: SimFTP/0.1 128 laseuybjaw3blk23r89nzjx
+# Error: [PROTOCOL]/[VERSION] [TYPE] [CONTENT]
+#   Example: SimFTP/0.1 128 No such file: file.txt
+#
+# ### Version 0.2
+#
+# Messages are length prefixed, the receiver never has to scan the content for
+# a terminator so CONTENT may hold any byte (including \0). Every message
+# starts with a fixed size binary header (network byte order):
+#
+# [PROTOCOL]/[VERSION] 10 bytes, always "SimFTP/0.2"
+# [TYPE]               unsigned 8 bit
+# [FLAGS]              unsigned 8 bit
+# [HEADER LENGTH]      unsigned 16 bit, size of [HEADER]
+# [PAYLOAD LENGTH]     unsigned 64 bit, size of [CONTENT]
+# [STREAM ID]          unsigned 32 bit
+#
+# It is followed by [HEADER], a UTF-8 encoded JSON object holding the message
+# type specific fields (eg. the filename of a FileStart), and [CONTENT]. A
+# field of the wrong type (see FIELD_TYPES) makes the message invalid.
+#
+# If the Checksum flag is set [CONTENT] is followed by [CHECKSUM], the
+# unsigned 32 bit CRC-32C of [CONTENT]. A FileEnd may hold the CRC-32C of the
+# whole file in its "crc" field.
+#
+# If the Crc32 flag is set the checksums of the message are CRC-32 instead.
+# Set on a FileStart, it says so for the whole file: its FileEnd's "crc" and
+# the checksum an interrupted upload is resumed with. A Resume with the flag
+# set asks for (and is answered with) a CRC-32.
+#
+# FileStart: [FIXED HEADER] {"filename": "file.txt"} laseuybjaw3blk23r89nzjx
+# FilePart: [FIXED HEADER] laseuybjaw3blk23r89nzjx
+# FileStart (segment): [FIXED HEADER] {"filename": "file.txt", "transfer": "8c1f", "size": 4096, "offset": 2048} ...
+# FileStart (compressed): [FIXED HEADER] {"filename": "file.txt", "compression": "zlib"} x\x9c...
+# FileStart (sized): [FIXED HEADER] {"filename": "file.txt", "size": 4096, "mtime": 1700000000.5, "mode": 420} ...
+# FileEnd (checksummed): [FIXED HEADER] {"crc": 3808858755} laseuybjaw3blk23r89nzjx [CHECKSUM]
+# Download: [FIXED HEADER] {"filename": "file.txt"}
+#
+# Resume: [FIXED HEADER] {"filename": "file.txt", "size": 4096}
+#   Answer: [FIXED HEADER] {"filename": "file.txt", "offset": 2048, "crc": 3808858755}
+#
+# Signature: [FIXED HEADER] {"filename": "file.txt"}
+#   Answer: [FIXED HEADER] {"filename": "file.txt", "size": 8192, "block_size": 2048} [SIGNATURES]
+#
+# Chunks: [FIXED HEADER] {"filename": "file.txt", "size": 8192} [MANIFEST]
+#   Answer: [FIXED HEADER] {"filename": "file.txt", "missing": 3} [BITMAP]
+#
+# A Download is answered with FileStart, FilePart... and FileEnd messages
+# carrying the requested file, or with an Error message whose CONTENT is a
+# UTF-8 encoded description of the problem.
+#
+# Ack: [FIXED HEADER] {}
+#   Answers: [FIXED HEADER] {"acked": 1048576}
+#
+# An Ack without a count asks the receiver to acknowledge what it receives.
+# It then sends Acks holding the number of bytes (whole messages, the first
+# Ack included) it received and handled since the connection was opened,
+# every now and then and whenever it runs out of data. The sender keeps a
+# window of unacknowledged bytes in flight, see client.py. An Ack of more
+# bytes than were sent is answered with an Error.
+#
+# The messages of several uploads and downloads may be interleaved on one
+# connection. Every transfer uses a [STREAM ID] of its own, File messages
+# belong to the transfer of their stream and answers (including Errors) carry
+# the stream of the message they answer.
+#
+# Both versions are understood by receivers, the version of each message is
+# detected from its [PROTOCOL]/[VERSION] prefix.
+#
+# Receivers keep a message in memory until all of it arrived, up to a maximum
+# size of their choosing. The content of a larger File message is handled as
+# it arrives instead, a larger message of another type (or one whose [HEADER]
+# is longer than MAXIMUM_HEADER_LENGTH) is dropped and answered with an
+# Error on its stream.
 
 
-# Define message types that can be transmitted or received
+# Define message types that can be transmitted or received. A type is one
+# value, not a combination of bits, see FILE_TYPES and CONTENT_TYPES for the
+# groups of them. The first types had one bit each, version 0.1 messages
+# still carry those values.
 @unique
-class MessageType(IntFlag):
-    FileStart = int('0000_0001', 2)  # 1
-    FilePart = int('0000_0010', 2)  # 2
-    FileEnd = int('0000_0100', 2)  # 4
-    Download = int('0001_0000', 2)  # 8
-    File = FileStart | FilePart | FileEnd  # 7
-    Error = int('1000_0000', 2)  # 128
-
-
-# Message formats are the layout for each packet of a certain message type
-MESSAGE_FORMATS = {
-    MessageType.FileStart: "{self.protocol}/{self.version} {self.type} {self.filename} ",
-    MessageType.FilePart: "{self.protocol}/{self.version} {self.type} ",
-    MessageType.FileEnd: "{self.protocol}/{self.version} {self.type} ",
-    MessageType.Download: "{self.protocol}/{self.version} {self.type} {self.filename} ",
+class MessageType(IntEnum):
+    FileStart = 1
+    FilePart = 2
+    FileEnd = 4
+    Chunks = 8
+    Download = 16
+    Resume = 32
+    Ack = 48
+    Signature = 64
+    Error = 128
+
+
+# Define flags that can be set on version 0.2 messages
+@unique
+class MessageFlag(IntFlag):
+    Checksum = int('0000_0001', 2)  # 1
+    Crc32 = int('0000_0010', 2)  # 2
+
+
+# Message types that may be sent as version 0.1 messages, a filename follows
+# the prefix of the types that have one
+LEGACY_TYPES = {
+    MessageType.FileStart: True,
+    MessageType.FilePart: False,
+    MessageType.FileEnd: False,
+    MessageType.Download: True,
+    MessageType.Error: False,
+}
+
+# Message types that belong to the upload (or download) of a file
+FILE_TYPES = frozenset((MessageType.FileStart, MessageType.FilePart, MessageType.FileEnd))
+
+# Message types that carry a binary CONTENT field
+CONTENT_TYPES = FILE_TYPES | {MessageType.Error, MessageType.Signature, MessageType.Chunks}
+
+# Message type specific fields that are carried in the [HEADER] of a version
+# 0.2 message
+HEADER_FIELDS = {
+    MessageType.FileStart: ('filename',),
+    MessageType.Download: ('filename',),
+    MessageType.Resume: ('filename',),
+    MessageType.Signature: ('filename',),
+    MessageType.Chunks: ('filename',),
+}
+
+# Fields that may be left out of the [HEADER] of a version 0.2 message
+#
+# A FileStart with a size announces the total size of the file. The receiver
+# reserves the space before any content arrives (turning down a file that
+# doesn't fit with an Error) and checks that the file has that size at
+# FileEnd. The mtime (seconds since the epoch) and mode (permission bits) are
+# given to the finished file.
+#
+# A FileStart with a transfer id is one byte range of a file that is being
+# uploaded over several connections at once. It holds the total size of the
+# file and the offset its range starts at. Without a transfer id an offset
+# continues an interrupted upload.
+#
+# A Resume with a size asks where an interrupted upload of a file of that
+# size can be continued, it is answered with a Resume holding the offset and
+# the checksum of the part the server already has.
+#
+# A FileStart with a delta block size carries delta operations (see
+# delta.py) against the server's current copy of the file instead of the
+# file itself. The block size comes from the Signature message answering a
+# Signature without a block size.
+#
+# A FileStart with chunked set carries the chunks (see chunks.py) of a file
+# the server was missing, as listed by the Chunks message answering a Chunks
+# without a missing count.
+#
+# A FileStart with a compression carries the file compressed as one stream
+# with that codec (see compression.py), spread over the File messages.
+#
+# A FileStart with batch set uploads a directory of that name as one stream
+# of file records (see batch.py).
+OPTIONAL_HEADER_FIELDS = {
+    MessageType.FileStart: ('transfer', 'size', 'offset', 'delta', 'chunked', 'compression',
+                            'batch', 'mtime', 'mode'),
+    MessageType.FileEnd: ('crc',),
+    MessageType.Resume: ('size', 'offset', 'crc'),
+    MessageType.Signature: ('size', 'block_size'),
+    MessageType.Chunks: ('size', 'missing'),
+    MessageType.Ack: ('acked',),
+}
+
+# Types of the fields of a received [HEADER], the others are integers. Numbers
+# may not be negative or larger than a signed 64 bit integer (which is what
+# the operating system takes them as), and bools don't count as integers.
+FIELD_TYPES = {
+    'filename': str,
+    'transfer': str,
+    'compression': str,
+    'chunked': bool,
+    'batch': bool,
+    'mtime': (int, float),
 }
 
+MAXIMUM_FIELD_VALUE = 2 ** 63 - 1
+
+# The fixed size part of a version 0.2 message
+FRAME_HEADER = struct.Struct("!10sBBHQI")
+
+# The checksum that follows the content of a version 0.2 message
+FRAME_CHECKSUM = struct.Struct("!I")
+
+
+# Message types that may appear on the wire, indexed by value
+MESSAGE_TYPES = {member.value: member for member in MessageType}
+
+# CONTENT_TYPES and the Checksum flag as plain ints, testing those costs a
+# fraction of the enum operators on every frame
+CONTENT_VALUES = frozenset(int(type) for type in CONTENT_TYPES)
+CHECKSUM = int(MessageFlag.Checksum)
+CRC32_FLAG = int(MessageFlag.Crc32)
+
+# The checksum function of the messages whose Crc32 flag is (or isn't) set
+CHECKSUMS = {0: crc32c, CRC32_FLAG: crc32}
+
+# Every type specific field, a message only has those of its type
+FIELDS = tuple(dict.fromkeys(
+    field for fields in (HEADER_FIELDS, OPTIONAL_HEADER_FIELDS)
+    for typeFields in fields.values() for field in typeFields))
+
+# The type of a version 0.1 message is written in decimal
+LEGACY_TYPE_NAMES = {str(int(type)).encode('utf-8'): type for type in LEGACY_TYPES}
+
+# Version 0.1 filenames are found by scanning this much of a message first
+LEGACY_HEADER_SIZE = 4352
+
+# Largest [HEADER] of a version 0.2 message we accept, a filename and the
+# optional fields take far less
+MAXIMUM_HEADER_LENGTH = 16384
+
 
 class Message:
+    """A message of either protocol version
+
+    Messages are created for every frame that is sent or received, so they
+    have no __dict__. A parsed message keeps the bytes of its [HEADER] and
+    only decodes them when one of its type specific fields is first read (or
+    validate is called), which is also when an invalid header raises a
+    RuntimeError. Its content is a memoryview of the bytes it was parsed
+    from.
+    """
+    __slots__ = ('version', 'type', 'flags', 'stream', 'checksum', 'content',
+                 '_header') + FIELDS
+
     PROTOCOL_FORMAT = "{protocol}/{version} {type}"
-    VERSION = "0.1"
+    VERSION = "0.2"
+    LEGACY_VERSION = "0.1"
+    VERSIONS = (LEGACY_VERSION, VERSION)
     PROTOCOL = "SimFTP"
+    MAGIC = "{}/{}".format(PROTOCOL, VERSION).encode('utf-8')
+    LEGACY_MAGIC = "{}/{}".format(PROTOCOL, LEGACY_VERSION).encode('utf-8')
     MINIMUM_SIZE = len(PROTOCOL_FORMAT.format(
         protocol=PROTOCOL,
-        version=VERSION,
+        version=LEGACY_VERSION,
         id=0,
         type=0,
         content=b""
     )) + 8 + 1  # +8 for checksum, +1 for \0 (one control character)
 
+    # Protocol of the message, there is only one
+    protocol = PROTOCOL
+
     def __init__(self, **params):
 
-        # Define protocol and version of the message.
-        # These are predefined based on the version of simplified-ftp
-        self.protocol = Message.PROTOCOL  # params.protocol
-        self.version = Message.VERSION  # params.version
+        # Define the version of the message, the protocol is predefined
+        self.version = params.get('version', Message.VERSION)
         self.type = params['type']
+        self.flags = params.get('flags', 0)
+        self.stream = params.get('stream', 0)
+        self._header = None
+
+        # Checksum of the content, if known
+        self.checksum = params.get('checksum')
+
+        if self.version not in Message.VERSIONS:
+            raise RuntimeError(
+                "Unknown protocol version: {}".format(self.version))
 
         # Define addition properties on message based on message type
-        if self.type == MessageType.FileStart or self.type == MessageType.Download:
-            self.filename = params['filename']
-        if self.type in MessageType.File:
+        for field in HEADER_FIELDS.get(self.type, ()):
+            setattr(self, field, params[field])
+        for field in OPTIONAL_HEADER_FIELDS.get(self.type, ()):
+            setattr(self, field, params.get(field))
+        if self.type in CONTENT_VALUES:
             self.content = params['content']
 
-    def fromBytes(bytes):
+    def __getattr__(self, name):
+        # Only called for slots that are not set yet, the fields of a parsed
+        # message are set once its header is decoded
+        if name in FIELDS and self._header is not None:
+            self._decodeHeader()
+            return getattr(self, name)
+        raise AttributeError("'Message' object has no attribute '{}'".format(name))
 
-        assert len(bytes) >= Message.MINIMUM_SIZE
+    def algorithm(self):
+        # Algorithm of the message's checksums, CRC32C or CRC32
+        return CRC32 if self.flags & CRC32_FLAG else CRC32C
 
-        params = {}
+    def validate(self):
+        # Decode the header of a parsed message now, so an invalid one raises
+        # here rather than wherever one of its fields is first read
+        if self._header is not None:
+            self._decodeHeader()
 
-        # Protocol is the first 6 bytes (SimFTP), first 6 characters
-        protocol = bytes[:6]
+    def _decodeHeader(self):
+        header, self._header = self._header, None
 
-        # Version is first 3 bytes (0.1)
-        version = bytes[7:10]
+        fields = {}
+        if header:
+            try:
+                fields = json.loads(str(header, 'utf-8'))
+            except ValueError as err:
+                raise RuntimeError("Invalid message header: {}".format(err))
+            if not isinstance(fields, dict):
+                raise RuntimeError("Invalid message header: not an object")
 
-        # Same as id, type is variable length
-        typeEnd = bytes.find(b' ', 11)
-        params['type'] = MessageType(
-            int(bytes[11:typeEnd].decode('utf-8')))
+        # Ensure the type specific fields were supplied, with the right types
+        for field in HEADER_FIELDS.get(self.type, ()):
+            if fields.get(field) is None:
+                raise RuntimeError("Missing {} in {} message".format(
+                    field, self.type.name))
+            setattr(self, field, checkField(self.type, field, fields[field]))
+        for field in OPTIONAL_HEADER_FIELDS.get(self.type, ()):
+            value = fields.get(field)
+            if value is not None:
+                checkField(self.type, field, value)
+            setattr(self, field, value)
 
-        # ### Do some message data validation
+    def frameSize(bytes, start=0, end=None):
+        """Get the size of the message at the start of a buffer
 
-        # Ensure the supplied type is a known message type.
-        if params['type'].name is None:
-            raise RuntimeError("Invalid message type: {}".format(type))
+        Args:
+          bytes (bytes): received bytes (a bytes or bytearray object)
+          start (int): position in bytes where the message starts
+          end (int): position in bytes where the received data ends
 
-        # Ensure the supplied protocol is the expect protocol
-        if protocol.decode('utf-8') != Message.PROTOCOL:
-            raise RuntimeError(
-                "Unknown message protocol: {}".format(protocol.decode()))
+        Returns:
+          int: the number of bytes the message occupies (including any
+            terminator), or None if the message has not been fully received
+        """
+        if end is None:
+            end = len(bytes)
+        magic = bytes[start:start + len(Message.MAGIC)]
+
+        if magic == Message.MAGIC:
+            if end - start < FRAME_HEADER.size:
+                return None
+            _, _, flags, headerLength, payloadLength, _ = FRAME_HEADER.unpack_from(
+                bytes, start)
+            size = FRAME_HEADER.size + headerLength + payloadLength
+            if flags & CHECKSUM:
+                size += FRAME_CHECKSUM.size
+            return size if end - start >= size else None
+
+        if magic == Message.LEGACY_MAGIC:
+            # Legacy messages are terminated with a null terminator (\0)
+            terminator = bytes.find(b'\0', start, end)
+            return terminator + 1 - start if terminator != -1 else None
+
+        # Not enough bytes have arrived to tell which version this is
+        if end - start < len(Message.MAGIC):
+            magic = magic[:end - start]
+            if Message.MAGIC.startswith(magic) or Message.LEGACY_MAGIC.startswith(magic):
+                return None
+
+        raise RuntimeError(
+            "Unknown message protocol: {}".format(magic.decode(errors='replace')))
 
-        # Ensure the supplied protocol version is the expect protocol version
-        if version.decode('utf-8') != Message.VERSION:
+    def fromBytes(bytes, verify=True):
+        """Parse a message
+
+        Args:
+          bytes (bytes): a whole message, may be a memoryview. The content of
+            the message is a view into bytes, not a copy.
+          verify (bool): check the content against the message's checksum
+
+        Returns:
+          :class:`Message`: the parsed message
+        """
+        view = bytes if isinstance(bytes, memoryview) else memoryview(bytes)
+
+        # Version 0.2 messages have a binary header
+        if view[:len(Message.MAGIC)] == Message.MAGIC:
+            return Message._fromFrame(view, verify)
+
+        # Legacy messages may still have their terminator attached, it is
+        # part of the minimum size (as in toBytes)
+        end = len(view)
+        if view[end - 1:] == b'\0':
+            end -= 1
+
+        assert end + 1 >= Message.MINIMUM_SIZE
+
+        # Only the text before the content is scanned, which takes a copy
+        # of it as memoryviews can't be searched
+        head = view[:LEGACY_HEADER_SIZE].tobytes()
+
+        # Ensure the supplied protocol and version are the expected ones
+        if not head.startswith(LEGACY_PREFIX):
+            if head[:6] != Message.PROTOCOL.encode('utf-8'):
+                raise RuntimeError(
+                    "Unknown message protocol: {}".format(head[:6].decode(errors='replace')))
             raise RuntimeError(
-                "Unknown protocol version: {}".format(version.decode()))
+                "Unknown protocol version: {}".format(head[7:10].decode(errors='replace')))
+
+        # Ensure the supplied type is a known message type. Same as the
+        # filename, the type is variable length
+        typeEnd = head.find(b' ', len(LEGACY_PREFIX))
+        type = LEGACY_TYPE_NAMES.get(head[len(LEGACY_PREFIX):typeEnd])
+        if typeEnd == -1 or type is None:
+            raise RuntimeError("Invalid message type: {}".format(
+                head[len(LEGACY_PREFIX):typeEnd].decode(errors='replace')))
+
+        message = Message.__new__(Message)
+        message.version = Message.LEGACY_VERSION
+        message.type = type
+        message.flags = 0
+        message.stream = 0
+        message.checksum = None
+        message._header = None
+        contentStart = typeEnd + 1
 
         # Add additional properties to the message depending on message type
-        if params['type'] == MessageType.Download:
-            filenameEnd = bytes.find(b' ', typeEnd + 1)
-            params['filename'] = bytes[typeEnd + 1:filenameEnd].decode('utf-8')
+        if LEGACY_TYPES[type]:
+            filenameEnd = head.find(b' ', contentStart)
+            if filenameEnd == -1 and len(head) < len(view):
+                head = view.tobytes()
+                filenameEnd = head.find(b' ', contentStart)
+            if filenameEnd == -1:
+                filenameEnd = end
+            try:
+                message.filename = head[contentStart:filenameEnd].decode('utf-8')
+            except ValueError as err:
+                raise RuntimeError("Invalid filename: {}".format(err))
+            contentStart = filenameEnd + 1
+
+        # Version 0.1 has none of the optional fields
+        for field in OPTIONAL_HEADER_FIELDS.get(type, ()):
+            setattr(message, field, None)
+
+        # FileStart, FilePart, FileEnd & Error have contents after their
+        # filename or type field
+        if type in CONTENT_VALUES:
+            message.content = view[min(contentStart, end):end]
+
+        return message
+
+    def _fromFrame(bytes, verify):
+        _, type, flags, headerLength, payloadLength, stream = FRAME_HEADER.unpack_from(
+            bytes)
+
+        size = FRAME_HEADER.size + headerLength + payloadLength
+        if flags & CHECKSUM:
+            size += FRAME_CHECKSUM.size
+        if len(bytes) != size:
+            raise RuntimeError("Invalid message length: {} (expected {})".format(
+                len(bytes), size))
+
+        return Message._fromFields(bytes, 0, type, flags, headerLength, payloadLength, stream,
+                                   verify)
+
+    def _fromFields(bytes, start, type, flags, headerLength, payloadLength, stream, verify):
+        # Build the version 0.2 message at start in bytes (a memoryview) from
+        # its unpacked fixed header
+        if type not in MESSAGE_TYPES:
+            raise RuntimeError("Invalid message type: {}".format(type))
+        type = MESSAGE_TYPES[type]
 
-        if params['type'] == MessageType.FileStart:
-            filenameEnd = bytes.find(b' ', typeEnd + 1)
-            params['filename'] = bytes[typeEnd + 1:filenameEnd].decode('utf-8')
-            params['content'] = bytes[filenameEnd + 1:]
+        headerStart = start + FRAME_HEADER.size
+        headerEnd = headerStart + headerLength
+        payloadEnd = headerEnd + payloadLength
 
-        # FilePart & FileEnd will have contents after their message type field
-        elif params['type'] == MessageType.FilePart or params['type'] == MessageType.FileEnd:
-            params['content'] = bytes[typeEnd + 1:]
+        # Set the slots directly, the header is kept (as a copy, the buffer
+        # it arrived in is reused) and only decoded when a field is read
+        message = Message.__new__(Message)
+        message.version = Message.VERSION
+        message.type = type
+        message.flags = flags
+        message.stream = stream
+        message.checksum = None
+        message._header = (bytes[headerStart:headerEnd].tobytes()
+                           if type in FIELDED_TYPES else None)
 
-        # Construct a new message and return it
-        return Message(**params)
+        if type in CONTENT_VALUES:
+            message.content = bytes[headerEnd:payloadEnd]
+
+        # Make sure the content arrived intact
+        if flags & CHECKSUM:
+            message.checksum, = FRAME_CHECKSUM.unpack_from(bytes, payloadEnd)
+            checksum = CHECKSUMS[flags & CRC32_FLAG]
+            if verify and checksum(bytes[headerEnd:payloadEnd]) != message.checksum:
+                raise RuntimeError("Checksum mismatch in {} message".format(type.name))
+
+        return message
 
     def toBytes(self):
 
-        # Use MESSAGE_FORMATS[type] to define the basic structure of the message
-        bytes = MESSAGE_FORMATS[self.type].format(
-            self=self
-        ).encode('utf-8')
+        if self.version == Message.VERSION:
+            return self._toFrame()
+
+        # The start of the message only depends on its type
+        parts = [LEGACY_PREFIXES[self.type]]
+        if LEGACY_TYPES[self.type]:
+            parts.append(self.filename.encode('utf-8') + b" ")
 
         # Add message content
-        if self.type in MessageType.File:
-            bytes += self.content
+        if self.type in CONTENT_VALUES:
+            parts.append(self.content)
 
-        bytes += b"\0"
+        parts.append(b"\0")
+        bytes = b"".join(parts)
 
         # Ensure our message fufills the basic requirements
         assert len(bytes) >= Message.MINIMUM_SIZE
 
         # Return our generated message bytes
         return bytes
+
+    def _toFrame(self):
+        return b"".join(self.toBuffers())
+
+    def toBuffers(self):
+        """Get the bytes of the message as a list of buffers
+
+        The content is not copied, so a version 0.2 message whose content is
+        a view of a file can be sent with socket.sendmsg without its bytes
+        ever being copied by Python.
+
+        Returns:
+          list: the header, the content and the checksum (if any) of a
+            version 0.2 message, the whole message for version 0.1
+        """
+        if self.version != Message.VERSION:
+            return [self.toBytes()]
+
+        content = self.content if self.type in CONTENT_VALUES else b""
+        buffers = [self.headerBytes(len(content)), content]
+
+        if self.flags & CHECKSUM:
+            if self.checksum is None:
+                self.checksum = CHECKSUMS[self.flags & CRC32_FLAG](content)
+            buffers.append(FRAME_CHECKSUM.pack(self.checksum))
+
+        return buffers
+
+    def headerBytes(self, payloadLength=None):
+        """Get the bytes of a version 0.2 message that precede its content
+
+        Allows the content of a message to be sent separately, eg. straight
+        from a file. If the Checksum flag is set the content has to be
+        followed by its checksum.
+
+        Args:
+          payloadLength (int): size of the content that will follow, defaults
+            to the size of this message's content
+
+        Returns:
+          bytes: the fixed header and the type specific header
+        """
+        if self.version != Message.VERSION:
+            raise RuntimeError(
+                "Separate headers are not supported by version {}".format(self.version))
+
+        if payloadLength is None:
+            payloadLength = len(self.content) if self.type in CONTENT_VALUES else 0
+
+        # Only the type specific fields are sent in the header, most messages
+        # (FileParts) have none
+        header = b""
+        if self.type in FIELDED_TYPES:
+            fields = {field: getattr(self, field)
+                      for field in HEADER_FIELDS.get(self.type, ())}
+            for field in OPTIONAL_HEADER_FIELDS.get(self.type, ()):
+                if getattr(self, field) is not None:
+                    fields[field] = getattr(self, field)
+            if fields:
+                header = json.dumps(fields, separators=(',', ':')).encode('utf-8')
+
+        return FRAME_HEADER.pack(
+            Message.MAGIC,
+            self.type,
+            self.flags,
+            len(header),
+            payloadLength,
+            self.stream
+        ) + header
+
+
+def checkField(type, field, value):
+    """Ensure a received header field has the type its message expects
+
+    Args:
+      type (:class:`MessageType`): type of the message
+      field (str): name of the field
+      value (obj): the value that was received
+
+    Returns:
+      obj: the value
+
+    Raises:
+      RuntimeError: the value can't be used as the field
+    """
+    expected = FIELD_TYPES.get(field, int)
+    valid = isinstance(value, expected) and (expected is bool or not isinstance(value, bool))
+    if valid and expected is str:
+        # Paths can't hold a null character
+        valid = '\0' not in value
+    elif valid and expected is not bool:
+        valid = 0 <= value <= MAXIMUM_FIELD_VALUE
+    if not valid:
+        raise RuntimeError("Invalid {} in {} message: {}".format(
+            field, type.name, json.dumps(value)[:64]))
+    return value
+
+
+class FrameDecoder:
+    def __init__(self, verify=True, maximumSize=None):
+        """Splits a stream of received bytes into messages
+
+        Every complete message in a buffer is parsed in one pass. A message
+        that has only partly arrived is left where it is, decode is called
+        again once more bytes have been added after it.
+
+        Messages larger than maximumSize are never left in the buffer. The
+        content of a larger File message is passed on as it arrives, see
+        stream. Other larger messages are dropped.
+
+        Args:
+          verify (bool): check the content of messages against their checksum
+          maximumSize (int): most bytes of a message that are kept in the
+            buffer, None for no limit
+
+        Returns:
+          :class:`FrameDecoder`: a decoder at the start of a stream
+        """
+        self.verify = verify
+        self.maximumSize = maximumSize
+
+        # Bytes of a partial legacy message that were already searched for
+        # its terminator
+        self.scanned = 0
+
+        # The File message whose content is being passed on, [True until
+        # the first piece was, type, stream, flags, bytes of content still
+        # to come, checksum of the content so far, header]
+        self.streaming = None
+
+        # Bytes of a dropped message that are still to come
+        self.skipping = 0
+
+    def reset(self):
+        # The partial message was dropped, start over with the next bytes
+        self.scanned = 0
+        self.streaming = None
+        self.skipping = 0
+
+    def stream(self, view, position, end, messages):
+        """Pass on what arrived of the File message being streamed
+
+        Its content is passed on in FileParts, the first of which is a
+        FileStart if the message is one. A FileEnd follows the last of them
+        if the message is one.
+
+        Returns:
+          int: the position after what was passed on, the message is done
+            once self.streaming is None
+        """
+        first, type, stream, flags, remaining, crc, header = self.streaming
+        verify = self.verify and flags & CHECKSUM
+
+        length = min(remaining, end - position)
+        if length or first and type == MessageType.FileStart:
+            pieceType = (MessageType.FileStart if first and type == MessageType.FileStart
+                         else MessageType.FilePart)
+            content = view[position:position + length]
+            message = self.piece(pieceType, stream, flags, content, header)
+
+            # The checksum in the frame is that of the whole content, each
+            # piece has its own
+            if verify:
+                message.checksum = CHECKSUMS[flags & CRC32_FLAG](content)
+                crc = combine(crc, message.checksum, length, message.algorithm())
+
+            messages.append(message)
+            position += length
+            remaining -= length
+            self.streaming[0] = False
+            self.streaming[4:6] = remaining, crc
+
+        if remaining:
+            return position
+
+        if flags & CHECKSUM:
+            if end - position < FRAME_CHECKSUM.size:
+                return position
+            checksum, = FRAME_CHECKSUM.unpack_from(view, position)
+            if verify and checksum != crc:
+                messages.append(RuntimeError("Checksum mismatch in {} message".format(type.name)))
+            position += FRAME_CHECKSUM.size
+
+        if type == MessageType.FileEnd:
+            message = self.piece(type, stream, flags, view[position:position], header)
+            message.checksum = 0 if verify else None  # Of no content
+            messages.append(message)
+
+        self.streaming = None
+        return position
+
+    def piece(self, type, stream, flags, content, header):
+        # Pieces aren't followed by a checksum, they keep the algorithm of
+        # the message's
+        message = Message.__new__(Message)
+        message.version = Message.VERSION
+        message.type = type
+        message.flags = flags & CRC32_FLAG
+        message.stream = stream
+        message.checksum = None
+        message._header = header if type in FIELDED_TYPES else None
+        message.content = content
+        return message
+
+    def drop(self, type, stream, size, messages):
+        # Skip a message that is too large, its sender is told
+        name = MESSAGE_TYPES[type].name if type in MESSAGE_TYPES else "type {}".format(type)
+        error = RuntimeError("{} message of {} bytes is too large".format(name, size))
+        error.stream = stream
+        messages.append(error)
+        self.skipping = size
+
+    def decode(self, buffer, start=0, end=None):
+        """Parse every complete message at the start of a buffer
+
+        Args:
+          buffer (bytearray): received bytes (a bytes or bytearray object)
+          start (int): position in buffer where the first message starts
+          end (int): position in buffer where the received data ends
+
+        Returns:
+          tuple: the messages, with the RuntimeError raised by each one that
+            could not be parsed in its place, and the number of bytes they
+            occupy. The content of the messages is a view into buffer.
+
+        Raises:
+          RuntimeError: the bytes at start are not a message of either
+            version, the stream can't be split any further
+        """
+        if end is None:
+            end = len(buffer)
+        view = memoryview(buffer)
+        verify = self.verify
+        maximumSize = self.maximumSize if self.maximumSize is not None else float('inf')
+        messages = []
+        position = start
+
+        while position < end:
+
+            # The rest of a message that is too large for the buffer
+            if self.skipping:
+                skipped = min(self.skipping, end - position)
+                self.skipping -= skipped
+                position += skipped
+                continue
+            if self.streaming is not None:
+                position = self.stream(view, position, end, messages)
+                if self.streaming is not None:
+                    break
+                continue
+
+            # Version 0.2 messages, the fixed header tells their size
+            if end - position >= FRAME_HEADER.size:
+                magic, type, flags, headerLength, payloadLength, stream = \
+                    FRAME_HEADER.unpack_from(buffer, position)
+                if magic == Message.MAGIC:
+                    size = FRAME_HEADER.size + headerLength + payloadLength
+                    if flags & CHECKSUM:
+                        size += FRAME_CHECKSUM.size
+                    if headerLength > MAXIMUM_HEADER_LENGTH or size > maximumSize:
+                        if (headerLength > MAXIMUM_HEADER_LENGTH or
+                                MESSAGE_TYPES.get(type) not in FILE_TYPES):
+                            self.drop(type, stream, size, messages)
+                            continue
+
+                        # The content of a File message is passed on as it
+                        # arrives, once the header is complete
+                        headerStart = position + FRAME_HEADER.size
+                        if end - headerStart < headerLength:
+                            break
+                        header = buffer[headerStart:headerStart + headerLength]
+                        self.streaming = [True, MESSAGE_TYPES[type], stream, flags, payloadLength,
+                                          0, bytes(header)]
+                        position = self.stream(view, headerStart + headerLength, end, messages)
+                        if self.streaming is not None:
+                            break
+                        continue
+                    if end - position < size:
+                        break
+                    try:
+                        messages.append(Message._fromFields(
+                            view, position, type, flags, headerLength, payloadLength, stream,
+                            verify))
+                    except RuntimeError as err:
+                        messages.append(err)
+                    position += size
+                    continue
+
+            # Legacy messages end with a terminator, we only search the bytes
+            # that arrived since the last call
+            if (end - position >= len(Message.LEGACY_MAGIC) and
+                    buffer[position:position + len(Message.LEGACY_MAGIC)] == Message.LEGACY_MAGIC):
+                terminator = buffer.find(b'\0', position + self.scanned, end)
+                if terminator == -1:
+                    self.scanned = end - position
+                    if (self.maximumSize is not None and self.scanned > self.maximumSize and
+                            not messages):
+                        # Without its end we can't find the next message
+                        raise RuntimeError("Legacy message is larger than {} bytes".format(
+                            self.maximumSize))
+                    break
+                self.scanned = 0
+                try:
+                    messages.append(Message.fromBytes(view[position:terminator + 1], verify))
+                except RuntimeError as err:
+                    messages.append(err)
+                except AssertionError:
+                    messages.append(RuntimeError("Message too short"))
+                position = terminator + 1
+                continue
+
+            # Too few bytes to tell, or not a message at all. The messages
+            # before it are handled first, the next call raises.
+            try:
+                Message.frameSize(buffer, position, end)
+            except RuntimeError:
+                if not messages:
+                    raise
+            break
+
+        return messages, position - start
+
+
+# Message types that have type specific fields
+FIELDED_TYPES = frozenset(HEADER_FIELDS) | frozenset(OPTIONAL_HEADER_FIELDS)
+
+# The start of every version 0.1 message, up to its type
+LEGACY_PREFIX = Message.LEGACY_MAGIC + b" "
+
+# The start of version 0.1 messages of each type, up to their filename or
+# content
+LEGACY_PREFIXES = {type: LEGACY_PREFIX + str(int(type)).encode('utf-8') + b" "
+                   for type in LEGACY_TYPES}
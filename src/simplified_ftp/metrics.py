@@ -0,0 +1,202 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+import bisect
+import time
+
+# ################# METRICS ###################
+#
+# Servers and clients count what they do in a Metrics registry. It can be
+# served over HTTP in the Prometheus text format (metrics_port) and written
+# to the log every metrics_interval seconds:
+#
+# # HELP simftp_received_bytes_total Bytes received from endpoints
+# # TYPE simftp_received_bytes_total counter
+# simftp_received_bytes_total 1048576
+#
+# Instruments are updated by the thread running the event loop only, other
+# threads (like that of the endpoint) only read them.
+
+# Upper bounds of the buckets of histograms, in their unit
+SECONDS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def formatValue(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, function=None):
+        """A value that goes up and down
+
+        Args:
+          name (str): name of the metric
+          help (str): what it measures
+          function (callable): computes the value when it is read, instead
+            of it being set
+
+        Returns:
+          :class:`Gauge`: a gauge at 0
+        """
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self):
+        return [(self.name, self.function() if self.function is not None else self.value)]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            samples.append(('{}_bucket{{le="{}"}}'.format(self.name, formatValue(bound)),
+                            cumulative))
+        samples.append((self.name + '_sum', self.sum))
+        samples.append((self.name + '_count', self.count))
+        return samples
+
+
+class Metrics:
+    def __init__(self):
+        """A registry of metrics
+
+        Asking for an instrument that already exists returns it, so every
+        connection of a server adds to the same counters.
+
+        Returns:
+          :class:`Metrics`: an empty registry
+        """
+        self.instruments = {}
+
+    def register(self, cls, name, *args):
+        instrument = self.instruments.get(name)
+        if instrument is None:
+            instrument = self.instruments[name] = cls(name, *args)
+        return instrument
+
+    def counter(self, name, help):
+        return self.register(Counter, name, help)
+
+    def gauge(self, name, help, function=None):
+        return self.register(Gauge, name, help, function)
+
+    def histogram(self, name, help, buckets=SECONDS_BUCKETS):
+        return self.register(Histogram, name, help, buckets)
+
+    def exposition(self):
+        """Render every instrument in the Prometheus text format
+
+        Returns:
+          str: the exposition, one sample per line
+        """
+        lines = []
+        for instrument in list(self.instruments.values()):
+            lines.append("# HELP {} {}".format(instrument.name, instrument.help))
+            lines.append("# TYPE {} {}".format(instrument.name, instrument.kind))
+            for name, value in instrument.samples():
+                lines.append("{} {}".format(name, formatValue(value)))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, _logger, port, addr='0.0.0.0'):
+        """Serve the exposition over HTTP from a thread of its own
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          port (int): port to listen on
+          addr (str): interface to listen on
+
+        Returns:
+          :class:`http.server.HTTPServer`: the listening endpoint, call its
+            shutdown method to stop it
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                _logger.debug("Metrics: " + format % args)
+
+        endpoint = HTTPServer((addr, port), Handler)
+        thread = Thread(target=endpoint.serve_forever, daemon=True)
+        thread.start()
+
+        _logger.info("Serving metrics on {}".format(port))
+        return endpoint
+
+
+class Reporter:
+    def __init__(self, _logger, metrics, interval):
+        """Writes the metrics to the log every interval seconds
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          metrics (:class:`Metrics`): the metrics to write
+          interval (float): seconds between reports, 0 never reports
+
+        Returns:
+          :class:`Reporter`: a reporter, call tick from the event loop
+        """
+        self._logger = _logger
+        self.metrics = metrics
+        self.interval = interval
+        self.next = time.monotonic() + interval
+
+    def tick(self):
+        if not self.interval or time.monotonic() < self.next:
+            return
+        self.next = time.monotonic() + self.interval
+        self._logger.info("Metrics:\n" + self.metrics.exposition())
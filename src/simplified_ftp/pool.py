@@ -0,0 +1,178 @@
+from threading import Thread, Lock, Event
+from collections import deque
+from contextlib import contextmanager
+from client import Client
+import socket
+import time
+
+
+class ClientPool:
+    def __init__(self, _logger, config):
+        """Keeps connected clients around for transfers that follow each other
+
+        Connecting (and starting a client's loop thread) costs more than
+        sending a small file, so clients are handed back to the pool once
+        their commands were sent and the next transfer to the same server
+        reuses one. Idle clients are pinged every keepalive_interval, which
+        keeps the connection (and middleboxes) alive and tells if the server
+        is still there. A client the server closed, or that left a ping
+        unanswered, is never handed out again.
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          config (obj): configuration options, also passed on to every
+            client
+
+        Returns:
+          :class:`ClientPool`: an empty pool
+        """
+        self._logger = _logger
+
+        # Setup config with defaults
+        self.config = {
+            'pool_size': 4,  # Idle clients kept per server
+            'keepalive_interval': 15,  # Seconds between pings of idle clients
+            'idle_timeout': 300,  # Seconds before an idle client is closed
+            'ping_timeout': 5,  # Seconds a ping may go unanswered
+            'answer_timeout': 10  # Seconds the server may take to acknowledge a transfer
+        }
+        self.config.update(config)
+
+        # Idle clients by server address, most recently used last. Every
+        # entry is [client, idle since, last pinged].
+        self.lock = Lock()
+        self.idle = {}
+
+        # Loop threads of every client we created, client -> thread
+        self.threads = {}
+
+        # This is set when we want the keepalive thread to stop
+        self.done = Event()
+
+        self.thread = Thread(target=self.keepalive, args=(), daemon=True)
+        self.thread.start()
+
+    def acquire(self, port, addr='127.0.0.1'):
+        """Get a connected client, reusing an idle one if we have one
+
+        Args:
+          port (int): port of the server
+          addr (str): ip of the server
+
+        Returns:
+          :class:`client.Client`: a client that is only used by the caller
+            until it is released
+        """
+        with self.lock:
+            idle = self.idle.get((addr, port), ())
+            while len(idle) != 0:
+                client, _, pinged = idle.pop()
+                if self.healthy(client, pinged):
+                    self._logger.debug("Reusing a connection to {}:{}".format(addr, port))
+                    return client
+                self.discard(client)
+
+        client = Client(self._logger, self.config)
+        client.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        thread = client.connect(port, addr)
+        with self.lock:
+            self.threads[client] = thread
+        return client
+
+    def release(self, client):
+        """Give a client back once its commands were sent
+
+        Args:
+          client (:class:`client.Client`): a client from acquire
+        """
+        client.commandQueue.join()
+
+        with self.lock:
+            idle = self.idle.setdefault(client.address, deque())
+            now = time.monotonic()
+            if not self.done.is_set() and self.healthy(client, now) and (
+                    len(idle) < self.config['pool_size']):
+                idle.append([client, now, now])
+                return
+            self.discard(client)
+
+    @contextmanager
+    def connection(self, port, addr='127.0.0.1'):
+        """Use a client for the duration of a with statement
+
+        Args:
+          port (int): port of the server
+          addr (str): ip of the server
+
+        Returns:
+          :class:`client.Client`: a client, released when the with block ends
+        """
+        client = self.acquire(port, addr)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def transfer(self, port, addr, command, *args):
+        """Run a command on a pooled client and wait until the server handled it
+
+        Args:
+          port (int): port of the server
+          addr (str): ip of the server
+          command (str): name of the client's command, eg. 'sendFile'
+          args: arguments of the command
+
+        Returns:
+          bool: True if the server acknowledged everything we sent, False if
+            it didn't in time or doesn't acknowledge messages
+        """
+        with self.connection(port, addr) as client:
+            client.commandQueue.put(getattr(client, command)(*args))
+            return client.flush(self.config['answer_timeout'])
+
+    def healthy(self, client, pinged):
+        # The server closed the connection, or didn't acknowledge what we
+        # sent up to our last ping (or the release of the client) in time
+        if client.done:
+            return False
+        return not (client.flowControl and client.connection.peerAcked < client.sent and
+                    time.monotonic() - pinged > self.config['ping_timeout'])
+
+    def discard(self, client):
+        # Called with the lock held
+        client.close()
+        self._logger.debug("Closed a connection to {}:{}".format(*client.address))
+
+    def keepalive(self):
+        interval = self.config['keepalive_interval']
+        while not self.done.wait(min(interval, self.config['ping_timeout'])):
+            now = time.monotonic()
+            with self.lock:
+                for idle in self.idle.values():
+                    for entry in list(idle):
+                        client, since, pinged = entry
+                        if (not self.healthy(client, pinged) or
+                                now - since > self.config['idle_timeout']):
+                            idle.remove(entry)
+                            self.discard(client)
+                        elif now - pinged >= interval:
+                            entry[2] = now
+                            client.commandQueue.put(client.ping())
+
+                # Forget the threads of clients that are gone
+                for client, thread in list(self.threads.items()):
+                    if not thread.is_alive():
+                        del self.threads[client]
+
+    def close(self):
+        # Close every client, waiting for those in use to be released
+        self.done.set()
+        self.thread.join()
+        with self.lock:
+            for idle in self.idle.values():
+                for client, _, _ in idle:
+                    self.discard(client)
+            self.idle.clear()
+            threads = list(self.threads.values())
+        for thread in threads:
+            thread.join()
@@ -1,106 +1,1861 @@
-from threading import Thread
+from threading import Thread, Lock
 from queue import Queue
-from message import Message, MessageType
+from collections import deque, OrderedDict
+from message import (Message, MessageType, MessageFlag, FrameDecoder, FILE_TYPES,
+                     FRAME_CHECKSUM)
+from checksum import combine, ALGORITHM, ALGORITHMS, CRC32C, CRC32
+from writer import WriterPool
+from compression import Decompressor
+from batch import RECORD_HEADER, safePath
+from metrics import Metrics, Reporter, BYTES_BUCKETS
+from tracing import Tracer, profiled
+from shaping import Shaper
+import chunks
+import delta
 import socket
 import select
+import fcntl
+import errno
+import heapq
+import itertools
+import json
+import time
+import os
+
+# Most buffers one writev takes
+IOV_MAX = os.sysconf('SC_IOV_MAX')
+
+
+class SegmentedFile:
+    def __init__(self, _logger, path, size, transfer):
+        """A file that is uploaded as byte ranges over several connections
+
+        Ranges are written into a preallocated temporary file, which replaces
+        path once every byte of the file has arrived. Completed ranges are
+        recorded next to the temporary file, so ranges of one upload may be
+        received by different server processes.
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          path (str): where the finished file is stored
+          size (int): total size of the file in bytes
+          transfer (str): id of the upload
+
+        Returns:
+          :class:`SegmentedFile`: an open segmented file
+        """
+        self._logger = _logger
+        self.path = path
+        self.size = size
+        self.tempPath = os.path.join(
+            os.path.dirname(path), ".{}.{}.part".format(os.path.basename(path), transfer))
+        self.rangesPath = self.tempPath + ".ranges"
+
+        # Connections of this process currently writing a range of this file
+        self.writers = 0
+
+        # Our file descriptor is shared by the writer threads of several
+        # connections, it is closed when the last of them releases it
+        self.lock = Lock()
+        self.references = 0
+
+        # Other processes may have created the temporary file already, only
+        # one we created is removed again if it can't be set up
+        try:
+            self.fd = os.open(self.tempPath, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+            created = True
+        except FileExistsError:
+            self.fd = os.open(self.tempPath, os.O_RDWR)
+            created = False
+
+        try:
+            if size > 0:
+                os.posix_fallocate(self.fd, 0, size)
+        except OSError as err:
+            if err.errno not in (errno.ENOSPC, errno.EFBIG, errno.EDQUOT):
+                # Not every file system can, the file grows as it is written
+                self._logger.debug("Unable to preallocate {}: {}".format(
+                    self.tempPath, err.strerror))
+                return
+            os.close(self.fd)
+            if created:
+                os.unlink(self.tempPath)
+            raise RuntimeError("No room for {} ({} bytes): {}".format(
+                os.path.basename(path), size, err.strerror))
+
+    def write(self, content, offset):
+        os.pwrite(self.fd, content, offset)
+
+    def completeRange(self, offset, length):
+        """Mark a byte range as received
+
+        Returns:
+          bool: True if that was the last missing range and the file is done
+        """
+        # Only one process (and thread) may look at (and act on) the ranges
+        # at once
+        with self.lock:
+            return self._completeRange(offset, length)
+
+    def _completeRange(self, offset, length):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            with open(self.rangesPath, "a+") as ranges:
+                ranges.write("{} {}\n".format(offset, length))
+                ranges.seek(0)
+                completed = dict(map(int, line.split()) for line in ranges)
+
+            if sum(completed.values()) < self.size or not os.path.exists(self.tempPath):
+                return False
+
+            # Every byte is here, move the file into place
+            os.replace(self.tempPath, self.path)
+            os.unlink(self.rangesPath)
+            removeManifest(self.path)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+        self._logger.debug("Assembled {} from {} ranges".format(
+            self.path, len(completed)))
+        return True
+
+    def acquire(self):
+        with self.lock:
+            self.references += 1
+
+    def release(self):
+        with self.lock:
+            self.references -= 1
+            if self.references == 0:
+                os.close(self.fd)
+
+
+class PartialFile:
+    def __init__(self, _logger, path, size=None, offset=0, blockSize=None, compression=None,
+                 mtime=None, mode=None, algorithm=CRC32C):
+        """A file that is uploaded over one connection
+
+        Content is written into a temporary file, which replaces path once the
+        upload ends. How much of it has been written (and the checksum of
+        that) is recorded next to the temporary file every now and then and
+        when the upload is interrupted, so the upload can be continued from
+        there later on. If its size is known the temporary file is
+        preallocated, and content is written to it with positional writes.
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          path (str): where the finished file is stored
+          size (int): total size of the file in bytes, if known
+          offset (int): continue an interrupted upload from this offset
+          blockSize (int): the upload is a delta against the current file at
+            path, with blocks of this size
+          compression (str): codec the content of the upload is compressed
+            with
+          mtime (float): modification time the finished file is given
+          mode (int): permission bits the finished file is given
+          algorithm (str): algorithm of the checksum of the file, CRC32C or
+            CRC32
+
+        Returns:
+          :class:`PartialFile`: an open partial file
+        """
+        self._logger = _logger
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.tempPath, self.resumePath = PartialFile.paths(path)
+
+        # The fields come straight from the endpoint
+        for name, value, types in (('size', size, int), ('mtime', mtime, (int, float)),
+                                   ('mode', mode, int)):
+            if value is not None and (not isinstance(value, types) or isinstance(value, bool) or
+                                      value < 0):
+                raise RuntimeError("Invalid {} for {}: {}".format(
+                    name, os.path.basename(path), value))
+
+        # Turn an unsupported codec down before anything is opened
+        self.decompressor = None
+        if compression is not None:
+            self.decompressor = Decompressor(compression)
+
+        # File descriptor of the file a delta refers to
+        self.basis = None
+        self.blockSize = blockSize
+        if blockSize is not None:
+            if not delta.MINIMUM_BLOCK_SIZE <= blockSize <= delta.MAXIMUM_BLOCK_SIZE:
+                raise RuntimeError("Invalid block size for a delta of {}: {}".format(
+                    os.path.basename(path), blockSize))
+            try:
+                self.basis = os.open(path, os.O_RDONLY)
+            except OSError as err:
+                raise RuntimeError("No basis for a delta of {}: {}".format(
+                    os.path.basename(path), err.strerror))
+
+        # Bytes received, checksum of them (None if unknown) and bytes
+        # received when the last record was written. What a compressed upload
+        # decompresses to (or a delta is rebuilt into) is only known to its
+        # writes, they keep position and crc up to date.
+        self.rebuilt = compression is not None or blockSize is not None
+        self.offset = offset
+        self.algorithm = algorithm
+        self.crc = 0
+        self.recorded = offset
+
+        # Where the next write goes, writes may run behind what was received
+        self.position = offset
+        self.closed = False
+
+        if offset != 0:
+            record = PartialFile.readRecord(path)
+            if (record is None or record['offset'] != offset or
+                    record.get('algorithm', CRC32C) != algorithm):
+                self.closeBasis()
+                raise RuntimeError("Unable to resume {} at offset {}".format(
+                    os.path.basename(path), offset))
+
+        # Nothing is left open if the file can't be
+        self.fd = None
+        try:
+            if offset == 0:
+                # Forget about any earlier upload of the file
+                self.fd = os.open(self.tempPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                if os.path.exists(self.resumePath):
+                    os.unlink(self.resumePath)
+            else:
+                # Drop anything that was written after the record
+                self.fd = os.open(self.tempPath, os.O_WRONLY)
+                os.ftruncate(self.fd, offset)
+                self.crc = record['crc']
+                if self.size is None:
+                    self.size = record['size']
+        except OSError:
+            if self.fd is not None:
+                os.close(self.fd)
+            self.closeBasis()
+            raise
+
+        self.preallocate()
+
+    def preallocate(self):
+        # Reserve the whole file up front, so it isn't fragmented and an
+        # upload that doesn't fit is turned down before its content arrives
+        if not self.size:
+            return
+        try:
+            os.posix_fallocate(self.fd, 0, self.size)
+        except OSError as err:
+            if err.errno not in (errno.ENOSPC, errno.EFBIG, errno.EDQUOT):
+                # Not every file system can, the file grows as it is written
+                self._logger.debug("Unable to preallocate {}: {}".format(
+                    self.tempPath, err.strerror))
+                return
+            os.close(self.fd)
+            self.closeBasis()
+            if self.offset == 0:
+                os.unlink(self.tempPath)
+            raise RuntimeError("No room for {} ({} bytes): {}".format(
+                os.path.basename(self.path), self.size, err.strerror))
+
+    def paths(path):
+        # The temporary file and the record of how much of it was written
+        tempPath = os.path.join(
+            os.path.dirname(path), ".{}.part".format(os.path.basename(path)))
+        return tempPath, tempPath + ".resume"
+
+    def readRecord(path):
+        _, resumePath = PartialFile.paths(path)
+        try:
+            with open(resumePath, "r") as record:
+                return json.load(record)
+        except (OSError, ValueError):
+            return None
+
+    def resumeOffset(path, size=None, algorithm=CRC32C):
+        """Find where an interrupted upload of path can be continued
+
+        Args:
+          path (str): where the finished file is stored
+          size (int): total size of the file being uploaded, an upload of a
+            file of another size is not continued
+          algorithm (str): algorithm of the checksum, an upload checksummed
+            with the other one is not continued
+
+        Returns:
+          tuple: the offset and the checksum of the bytes before it (None if
+            unknown), (0, None) if the upload has to start over
+        """
+        tempPath, _ = PartialFile.paths(path)
+        record = PartialFile.readRecord(path)
+        if record is None or (size is not None and record['size'] not in (None, size)):
+            return 0, None
+        if record.get('algorithm', CRC32C) != algorithm:
+            return 0, None
+
+        # The temporary file may have been removed (or cut short) since
+        try:
+            if os.stat(tempPath).st_size < record['offset']:
+                return 0, None
+        except OSError:
+            return 0, None
+
+        return record['offset'], record['crc']
+
+    def write(self, content):
+        self.writev([content])
+
+    def writev(self, contents):
+        # Write several pieces of content with one system call each IOV_MAX
+        # of them
+        for start in range(0, len(contents), IOV_MAX):
+            pieces = contents[start:start + IOV_MAX]
+            size = sum(len(piece) for piece in pieces)
+            written = os.pwritev(self.fd, pieces, self.position)
+
+            # Interrupted part way, write the rest the plain way
+            if written < size:
+                rest = memoryview(b"".join(pieces))[written:]
+                while len(rest) != 0:
+                    written = os.pwrite(self.fd, rest, self.position + size - len(rest))
+                    rest = rest[written:]
+            self.position += size
+
+    def writeCompressed(self, content, verify):
+        # Decompress and write a piece at a time, so what a small message
+        # decompresses to is never held all at once
+        for data in self.decompressor.decompress(content):
+            self.writeRebuilt(data, verify)
+
+    def writeDelta(self, content, verify):
+        # Rebuild the file from delta operations and the blocks of the basis
+        # they copy, a piece at a time
+        for data in delta.patch(content, self.basis, self.blockSize):
+            self.writeRebuilt(data, verify)
+
+    def writeRebuilt(self, data, verify):
+        # The file can't grow past its announced size, its checksum is that
+        # of the data written
+        if self.size is not None and self.position + len(data) > self.size:
+            raise RuntimeError("Content of {} grows past {} bytes".format(
+                os.path.basename(self.path), self.size))
+        self.write(data)
+
+        if verify and self.crc is not None:
+            self.crc = ALGORITHMS[self.algorithm](data, self.crc)
+        else:
+            self.crc = None
+
+    def verifyRebuilt(self, crc):
+        # The size and checksum of a compressed (or delta) upload are checked
+        # once all of it was written
+        if self.size is not None and self.position != self.size:
+            raise RuntimeError("Size mismatch in {} ({} of {} bytes)".format(
+                os.path.basename(self.path), self.position, self.size))
+        if crc is not None and self.crc is not None and crc != self.crc:
+            raise RuntimeError("Checksum mismatch in {}".format(os.path.basename(self.path)))
+
+    def record(self, offset, crc):
+        # Everything up to offset was written (we don't buffer), say so
+        if self.rebuilt:
+            offset, crc = self.position, self.crc
+        recordPath = self.resumePath + ".tmp"
+        with open(recordPath, "w") as record:
+            json.dump({'size': self.size, 'offset': offset, 'crc': crc,
+                       'algorithm': self.algorithm}, record)
+        os.replace(recordPath, self.resumePath)
+
+    def close(self):
+        os.close(self.fd)
+        self.closed = True
+        self.closeBasis()
+
+    def closeBasis(self):
+        if self.basis is not None:
+            os.close(self.basis)
+            self.basis = None
+
+    def interrupt(self, offset, crc):
+        self.record(offset, crc)
+        self.close()
+        self._logger.info("Upload of {} was interrupted at offset {}".format(
+            self.path, self.position))
+
+    def finish(self):
+        # Give the file the announced mode (keeping our own access to it) and
+        # modification time, then move the complete file into place
+        if self.mode is not None:
+            os.fchmod(self.fd, self.mode & 0o777 | 0o600)
+        if self.mtime is not None:
+            os.utime(self.fd, (self.mtime, self.mtime))
+        self.close()
+        os.replace(self.tempPath, self.path)
+        removeManifest(self.path)
+        if os.path.exists(self.resumePath):
+            os.unlink(self.resumePath)
+
+    def discard(self):
+        # May follow a failed write, finish or interrupt
+        if not self.closed:
+            self.close()
+        for path in (self.tempPath, self.resumePath):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class ChunkedFile:
+    def __init__(self, _logger, store, path, entries, missing):
+        """A file that is uploaded as the chunks the server was missing
+
+        Received data is cut into the missing chunks of the file's manifest,
+        every chunk is checked against its hash and stored as soon as it is
+        complete. Once all of them have arrived the manifest takes the place
+        of the file.
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          store (:class:`chunks.ChunkStore`): where chunks are stored
+          path (str): where the finished file is stored
+          entries (list): (hash, length) of every chunk of the file
+          missing (list): indexes of the chunks that will be received
+
+        Returns:
+          :class:`ChunkedFile`: a file waiting for its first chunk
+        """
+        self._logger = _logger
+        self.store = store
+        self.path = path
+        self.entries = entries
+        self.missing = deque(missing)
+
+        # The chunk being received
+        self.chunk = bytearray()
+
+    def write(self, content):
+        content = memoryview(content)
+        while len(content) != 0:
+            if len(self.missing) == 0:
+                raise RuntimeError("Received more than the missing chunks of {}".format(
+                    self.path))
+
+            digest, length = self.entries[self.missing[0]]
+            needed = length - len(self.chunk)
+            self.chunk += content[:needed]
+            content = content[needed:]
+
+            if len(self.chunk) == length:
+                self.store.put(digest, self.chunk)
+                self.chunk = bytearray()
+                self.missing.popleft()
+
+    def finish(self):
+        if len(self.missing) != 0:
+            raise RuntimeError("{} is missing {} chunks, it was not stored".format(
+                self.path, len(self.missing)))
+
+        self.store.writeManifest(self.path, self.entries)
+        self._logger.debug("Stored {} as {} chunks".format(self.path, len(self.entries)))
+
+
+class BatchFile:
+    def __init__(self, _logger, root):
+        """A directory that is uploaded as one stream of file records
+
+        Files are written straight into place below root as their records
+        (see batch.py) arrive. Directories are created once per batch and
+        nothing is renamed or synced per file, which is what makes many
+        small files cheap.
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          root (str): the directory files are unpacked to
+
+        Returns:
+          :class:`BatchFile`: a batch waiting for its first record
+        """
+        self._logger = _logger
+        self.root = root
+
+        # Header of the record being received, and the file and number of
+        # its bytes still to come once the header is complete (the file is
+        # None while a file that couldn't be opened is skipped)
+        self.header = bytearray()
+        self.fd = None
+        self.remaining = None
+
+        self.directories = set()
+        self.files = 0
+
+    def write(self, content):
+        # A file that can't be written is skipped, the records after it are
+        # still unpacked
+        content = memoryview(content)
+        error = None
+        while len(content) != 0:
+            try:
+                if self.remaining is None:
+                    content, name = self.readHeader(content)
+                    if name is not None:
+                        self.openFile(name)
+                else:
+                    length = min(self.remaining, len(content))
+                    self.remaining -= length
+                    piece, content = content[:length], content[length:]
+                    self.writeData(piece)
+            except (OSError, RuntimeError) as err:
+                self.skipFile()
+                error = err
+
+        if error is not None:
+            raise error
+
+    def readHeader(self, content):
+        """Collect the fixed header of a record, then the path that follows it
+
+        Returns:
+          tuple: the rest of content and the path of the file, once the
+            header is complete
+        """
+        needed = RECORD_HEADER.size
+        if len(self.header) >= needed:
+            needed += RECORD_HEADER.unpack_from(self.header)[0]
+        taken = needed - len(self.header)
+        self.header += content[:taken]
+        content = content[taken:]
+
+        if len(self.header) < needed:
+            return content, None
+        if needed == RECORD_HEADER.size and RECORD_HEADER.unpack_from(self.header)[0] != 0:
+            return content, None
+
+        _, size = RECORD_HEADER.unpack_from(self.header)
+        name = bytes(self.header[RECORD_HEADER.size:])
+        self.header = bytearray()
+        self.remaining = size
+        self.files += 1
+        return content, name.decode('utf-8', 'replace')
+
+    def openFile(self, name):
+        path = safePath(self.root, name)
+        directory = os.path.dirname(path)
+        if directory not in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            self.directories.add(directory)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+        if self.remaining == 0:
+            self.closeFile()
+
+    def writeData(self, piece):
+        while self.fd is not None and len(piece) != 0:
+            piece = piece[os.write(self.fd, piece):]
+        if self.remaining == 0:
+            self.closeFile()
+
+    def skipFile(self):
+        # Drop what is left of the current file
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.remaining == 0:
+            self.remaining = None
+
+    def closeFile(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+        self.remaining = None
+
+    def finish(self):
+        incomplete = self.remaining is not None or len(self.header) != 0
+        self.closeFile()
+        if incomplete:
+            raise RuntimeError("Batch {} ended in the middle of a file".format(self.root))
+        self._logger.debug("Unpacked {} files into {}".format(self.files, self.root))
+
+    def interrupt(self):
+        self.closeFile()
+        self._logger.info("Batch upload to {} was interrupted after {} files".format(
+            self.root, self.files))
+
+
+def removeManifest(path):
+    # A file that was stored as a whole replaces its manifest
+    try:
+        os.unlink(chunks.manifestPath(path))
+    except FileNotFoundError:
+        pass
+
+
+class ChecksumCache:
+    def __init__(self, capacity=1024):
+        """Checksums of the download parts of recently downloaded files
+
+        The checksum of a part is computed by reading the part before
+        sendfile sends it. Once that was done for every part of a file its
+        checksums are kept, so sending the file again leaves its content to
+        the kernel. A file is known by its inode, size and modification time,
+        a file that changed since is read again.
+
+        Args:
+          capacity (int): most files whose checksums are kept
+
+        Returns:
+          :class:`ChecksumCache`: an empty cache
+        """
+        self.capacity = capacity
+
+        # (device, inode, size, mtime, part size, algorithm) -> [checksum of
+        # each part], least recently used first
+        self.files = OrderedDict()
+
+    def key(info, partSize, algorithm):
+        return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns, partSize, algorithm)
+
+    def get(self, info, partSize, algorithm=CRC32C):
+        """Get the checksums of the parts of a file
+
+        Args:
+          info (:class:`os.stat_result`): the status of the open file
+          partSize (int): size of the parts the file is sent in
+          algorithm (str): algorithm of the checksums, CRC32C or CRC32
+
+        Returns:
+          list: checksum of every part, None if they aren't known
+        """
+        key = ChecksumCache.key(info, partSize, algorithm)
+        checksums = self.files.get(key)
+        if checksums is not None:
+            self.files.move_to_end(key)
+        return checksums
+
+    def put(self, info, partSize, checksums, algorithm=CRC32C):
+        self.files[ChecksumCache.key(info, partSize, algorithm)] = checksums
+        while len(self.files) > self.capacity:
+            self.files.popitem(last=False)
+
+
+# Attributes of Connection that make up the state of a download
+DOWNLOAD_STATE = ('download', 'downloadStream', 'downloadCrc', 'downloadOffset',
+                  'downloadSize', 'downloadChunks', 'downloadStarted', 'downloadInfo',
+                  'downloadChecksums', 'downloadCached')
 
 
 class Connection:
-    def __init__(self, _logger, socket, address="unknown", fileroot='/tmp'):
+    def __init__(self, _logger, socket, address="unknown", config={}, transfers=None, writer=None,
+                 metrics=None, tracer=None, limiter=None, checksumCache=None):
         self._logger = _logger
         self.socket = socket
         self.address = address
-        # Create a buffer byte array for our client
-        self.buffer = b""
-        self.responses = {}
+
+        # Setup config with defaults
+        self.config = {
+            'file_root': '/tmp',
+            'internal_recv_size': 8192,
+            'internal_buffer_size': 65536,
+            'internal_send_size': 4194304,
+            'download_segment_size': 1048576,
+            'checksums': True,  # Send checksums with downloads
+            'verify_checksums': True,
+            'checksum_algorithm': ALGORITHM,  # crc32c or crc32, see checksum.py
+            'resume_record_size': 4194304,  # Bytes between resume records
+            'chunk_store': False,
+            'ack_bytes': 65536,  # Bytes handled between acknowledgements
+            'maximum_frame_size': 16777216  # Largest message kept in memory, see message.py
+        }
+        self.config.update(config)
+
+        # Create a buffer byte array for our client. It is reused for the life
+        # of the connection, received data lives in buffer[bufferStart:bufferEnd]
+        self.bufferSize = self.config['internal_buffer_size']
+        self.buffer = bytearray(self.bufferSize)
+        self.bufferView = memoryview(self.buffer)
+        self.bufferStart = 0
+        self.bufferEnd = 0
+        self.decoder = FrameDecoder(self.config['verify_checksums'],
+                                    self.config['maximum_frame_size'])
+
+        # Bytes waiting to be sent, and the file (if any) being streamed to
+        # the endpoint after them. The header and checksum of the download
+        # part being sent are kept apart, so nothing is sent in the middle of
+        # a part.
+        self.responses = deque()
+        self.framing = deque()
+        self.download = None
+        self.downloadRemaining = 0
+
+        # Downloads of other streams, sent in turns with the current one
+        self.downloads = deque()
+
+        # Checksums of the parts of files we sent before, shared with the
+        # other connections
+        self.checksumCache = checksumCache if checksumCache is not None else ChecksumCache()
+
+        # Algorithm of the checksums of our downloads, and the flags that
+        # say so
+        self.downloadAlgorithm = self.config['checksum_algorithm']
+        self.downloadFlags = MessageFlag.Crc32 if self.downloadAlgorithm == CRC32 else 0
+
+        # Answers to our Resume and Signature messages, (type, filename) ->
+        # Message
+        self.answers = {}
+
+        # The PartialFile being received
         self.file = False
-        self.fileroot = fileroot
+        self.fileroot = self.config['file_root']
+
+        # Uploads can be stored as deduplicated chunks. Manifests the
+        # endpoint asked about (filename -> (entries, missing indexes)) and
+        # the ChunkedFile being received.
+        self.store = None
+        if self.config['chunk_store']:
+            self.store = chunks.ChunkStore(self.fileroot)
+        self.manifests = {}
+        self.chunked = None
+
+        # The BatchFile (directory upload) being received
+        self.batch = None
+
+        # Checksum of what has been received of self.file, None if a message
+        # without a checksum was received
+        self.fileCrc = None
+
+        # Segmented uploads shared by all connections (transfer id ->
+        # SegmentedFile), and the range of one that this connection is
+        # receiving
+        self.transfers = transfers if transfers is not None else {}
+        self.segment = None
+
+        # Disk operations go through a WriterQueue if we have one, we stop
+        # receiving (pause) while it is full
+        self.writer = writer
+        self.paused = False
+
+        # Uploads ((stream, upload) owners, see submit) whose disk operations
+        # failed and that are still to be given up on, and those whose
+        # operations are dropped while we have no writer
+        self.failures = deque()
+        self.failed = set()
+
+        # Streams whose upload was given up on, the rest of it is ignored
+        self.abandoned = set()
+
+        # Our traffic is charged to the token buckets of a Limiter if we have
+        # one. Once they run dry we stop being polled (are throttled) until
+        # the time in throttled, then switch to its mode.
+        self.limiter = limiter
+        self.throttled = None
+
+        # True if our last receive (or send) got everything the socket had
+        # (or filled it up). Edge triggered loops only get another event
+        # once that happened.
+        self.drained = False
+
+        # Uploads of several streams may be received at once. The state of
+        # the stream being handled is in self.file, self.fileCrc,
+        # self.segment, self.chunked and self.batch, that of the others in
+        # streams (stream id -> state).
+        self.stream = 0
+        self.streams = {}
+
+        # Metrics shared with the other connections of the server, and the
+        # counts of this connection alone which are logged when it closes
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.receivedBytes = self.metrics.counter(
+            'simftp_received_bytes_total', "Bytes received from endpoints")
+        self.sentBytes = self.metrics.counter(
+            'simftp_sent_bytes_total', "Bytes sent to endpoints")
+        self.parsedFrames = self.metrics.counter(
+            'simftp_frames_total', "Messages received and parsed")
+        self.parseErrors = self.metrics.counter(
+            'simftp_parse_errors_total', "Received messages that could not be parsed")
+        self.messageErrors = self.metrics.counter(
+            'simftp_message_errors_total', "Parsed messages that failed to be handled")
+        self.recvSizes = self.metrics.histogram(
+            'simftp_recv_bytes', "Bytes returned by each receive", BYTES_BUCKETS)
+        self.receiveSeconds = self.metrics.histogram(
+            'simftp_receive_transfer_seconds', "Time from FileStart to FileEnd of files received")
+        self.sendSeconds = self.metrics.histogram(
+            'simftp_send_transfer_seconds', "Time to send a downloaded file")
+        self.throttles = self.metrics.counter(
+            'simftp_throttled_total', "Times a connection waited for its rate limits")
+        self.stats = {'received': 0, 'sent': 0, 'messages': 0, 'errors': 0}
+
+        # When the transfers being received started, by stream id
+        self.started = {}
+
+        # Bytes of whole messages handled since the connection was opened. We
+        # acknowledge them once the endpoint asks for it, and keep what it
+        # acknowledged of ours.
+        self.processed = 0
+        self.acking = False
+        self.ackedProcessed = 0
+        self.peerAcked = 0
+
+        # Spans of sampled receives and sends go to the tracer, tracing is
+        # set while one is handled
+        self.tracer = tracer
+        self.tracing = False
 
     # Close our socket and cleanup
     def close(self):
         self.socket.close()
-        # Close any open files
+        self.closeFiles()
+        if self.limiter is not None:
+            self.limiter.close()
+        self.logStats()
+
+    def logStats(self):
+        self._logger.info(
+            "[{}] received {} bytes in {} messages ({} errors), sent {} bytes".format(
+                self.address, self.stats['received'], self.stats['messages'],
+                self.stats['errors'], self.stats['sent']))
+
+    def countReceived(self, received):
+        self.stats['received'] += received
+        self.receivedBytes.inc(received)
+        self.recvSizes.observe(received)
+
+    def countSent(self, sent):
+        self.stats['sent'] += sent
+        self.sentBytes.inc(sent)
+
+    def openTransfers(self):
+        # Uploads and downloads in progress, may be called from any thread
+        uploads = len(self.streams) + bool(
+            self.fileIsOpen() or self.segment is not None or self.chunked is not None or
+            self.batch is not None)
+        return uploads + len(self.downloads) + (self.download is not None)
+
+    # Close any open files
+    def closeFiles(self):
+        for stream in [self.stream] + list(self.streams):
+            self.selectStream(stream)
+            self.closeUpload()
+
+        if self.download is not None:
+            self.download.close()
+            self.download = None
+        for state in self.downloads:
+            state['download'].close()
+        self.downloads.clear()
+
+    def closeUpload(self):
+        # Give up on the upload of the current stream
         if self.fileIsOpen():
-            self.file.close()
+            # Keep what we got so the upload can be continued
+            self.submit(self.file.interrupt, self.file.offset, self.fileCrc, upload=self.file)
+            self.file = False
+        if self.segment is not None:
+            self._logger.info("Upload of {} was interrupted".format(
+                self.segment[0].path))
+            self.leaveSegment()
+        if self.chunked is not None:
+            # The chunks we got are kept, sending the file again skips them
+            self._logger.info("Upload of {} was interrupted".format(self.chunked.path))
+            self.chunked = None
+        if self.batch is not None:
+            # The files we got are kept
+            self.submit(self.batch.interrupt)
+            self.batch = None
+
+    def selectStream(self, stream):
+        # Put the upload of the current stream aside and continue that of
+        # another one
+        if stream == self.stream:
+            return
+        if (self.fileIsOpen() or self.segment is not None or self.chunked is not None or
+                self.batch is not None):
+            self.streams[self.stream] = (
+                self.file, self.fileCrc, self.segment, self.chunked, self.batch)
+        self.file, self.fileCrc, self.segment, self.chunked, self.batch = self.streams.pop(
+            stream, (False, None, None, None, None))
+        self.stream = stream
+
+    def startTrace(self):
+        # Decide if the receive or send we are starting is traced
+        self.tracing = self.tracer is not None and self.tracer.sampled()
+        return self.tracing
+
+    def submit(self, function, *args, upload=None):
+        # Run a disk operation, in order with the others of this connection.
+        # Once one of the operations of an upload failed its later ones are
+        # dropped, and the upload is given up on by handleWriteFailures.
+        if self.tracing:
+            function = self.tracer.traced('write', function)
+        owner = (self.stream, upload) if upload is not None else None
+        if self.writer is not None:
+            self.writer.submit(function, *args, owner=owner)
+            return
+
+        if owner is None:
+            function(*args)
+        elif owner not in self.failed:
+            try:
+                function(*args)
+            except (OSError, RuntimeError) as err:
+                self._logger.error("Disk operation failed: {}".format(err))
+                self.failed.add(owner)
+                self.writeFailed(owner, err)
+
+    def writeFailed(self, owner, err):
+        # Called (from a writer thread) when a disk operation of an upload
+        # failed
+        self.failures.append((owner, err))
+
+    def handleWriteFailures(self):
+        """Give up on the uploads whose disk operations failed
+
+        A partial file is discarded, since what was written after the failure
+        is missing from it. The endpoint is told with an Error on the stream
+        of the upload.
+
+        Returns:
+          bool: True if there were any, and Errors are waiting to be sent
+        """
+        handled = False
+        while len(self.failures) != 0:
+            (stream, upload), err = self.failures.popleft()
+            handled = True
+            self.messageErrors.inc()
+            self.stats['errors'] += 1
+
+            # The stream may still be receiving the upload
+            self.selectStream(stream)
+            if upload is self.file:
+                self.file = False
+            elif self.segment is not None and self.segment[0] is upload:
+                self.leaveSegment()
+            elif upload is self.chunked:
+                self.chunked = None
+
+            reason = "Unable to write {}: {}".format(
+                os.path.basename(upload.path), getattr(err, 'strerror', None) or err)
+            if isinstance(upload, PartialFile):
+                reason = "{}, it was discarded".format(reason)
+                self.submit(upload.discard)
+
+            # Operations submitted from now on are no longer dropped, once
+            # the dropped ones are behind us
+            failed = self.failed if self.writer is None else self.writer.failed
+            self.submit(failed.discard, (stream, upload))
+
+            self.abandoned.add(stream)
+            self.respond(Message(type=MessageType.Error, stream=stream,
+                                 content=reason.encode('utf-8')))
+        return handled
+
+    def fileContent(self, message):
+        # Content is a view into our receive buffer, which will be reused
+        # before a writer thread gets to it
+        if self.writer is None:
+            return message.content
+        return bytes(message.content)
+
+    def filePath(self, filename):
+        # Only ever touch files directly inside of our file root, a name that
+        # is empty or has more than one part is turned down
+        if '/' in filename or os.sep in filename:
+            raise RuntimeError("Invalid file name: {}".format(filename))
+        return safePath(self.fileroot, filename)
+
+    def requestedPath(self, message):
+        """Get the path of the file a request is about
+
+        Returns:
+          str: the path, None if its name is invalid (the endpoint is told)
+        """
+        try:
+            return self.filePath(message.filename)
+        except RuntimeError as err:
+            self.respond(Message(version=message.version, type=MessageType.Error,
+                                 stream=message.stream, content=str(err).encode('utf-8')))
+            return None
 
     def processMessage(self, message):
 
+        # File messages belong to the upload of their stream
+        if message.type in FILE_TYPES:
+            if message.stream in self.abandoned:
+                if message.type != MessageType.FileStart:
+                    return
+                self.abandoned.discard(message.stream)
+            self.selectStream(message.stream)
+
+        if message.type == MessageType.FileStart:
+            self.started[message.stream] = time.monotonic()
+        elif message.type == MessageType.FileEnd and message.stream in self.started:
+            self.receiveSeconds.observe(time.monotonic() - self.started.pop(message.stream))
+
         # ### Process the message depending on what type of message it is
+        if message.type == MessageType.Download:
+            self.startDownload(message)
+
+        if message.type == MessageType.Error:
+            self._logger.error("[{}] reported: {}".format(
+                self.address, str(message.content, 'utf-8', 'replace')))
+
+        # An Ack without a count asks us to acknowledge what we receive, with
+        # a count it acknowledges what we sent
+        if message.type == MessageType.Ack:
+            if message.acked is None:
+                self.acking = True
+            elif message.acked > self.stats['sent']:
+                reason = "Acknowledged {} bytes, {} were sent".format(
+                    message.acked, self.stats['sent'])
+                self.respond(Message(type=MessageType.Error, stream=message.stream,
+                                     content=reason.encode('utf-8')))
+                raise RuntimeError(reason)
+            else:
+                self.peerAcked = max(self.peerAcked, message.acked)
+
+        # A Resume without an offset asks for one, with an offset it answers
+        # one of ours. The same goes for a Signature and its block size.
+        if message.type == MessageType.Resume:
+            if message.offset is None:
+                self.answerResume(message)
+            else:
+                self.answers[(message.type, message.filename)] = message
+
+        if message.type == MessageType.Signature:
+            if message.block_size is None:
+                self.answerSignature(message)
+            else:
+                # The content is a view into our receive buffer
+                message.content = bytes(message.content)
+                self.answers[(message.type, message.filename)] = message
+
+        if message.type == MessageType.Chunks:
+            if message.missing is None:
+                self.answerChunks(message)
+            else:
+                # The content is a view into our receive buffer
+                message.content = bytes(message.content)
+                self.answers[(message.type, message.filename)] = message
+
+        # Tell the endpoint if an upload can't be received, eg. because the
+        # file doesn't fit. The rest of it is ignored.
         if message.type == MessageType.FileStart:
+            try:
+                self.startUpload(message)
+            except (OSError, RuntimeError) as err:
+                reason = str(err)
+                if isinstance(err, OSError):
+                    reason = "Unable to receive {}: {}".format(message.filename, err.strerror)
+                self.abandoned.add(message.stream)
+                self.respond(Message(type=MessageType.Error, stream=message.stream,
+                                     content=reason.encode('utf-8')))
+                raise RuntimeError(reason)
 
-            # If FileStart, open a new file for writing to
-            self.file = open(
-                "{0}/{1}".format(self.fileroot, message.filename), "wb")
-            self._logger.debug(
-                "Opened: {}".format(message.filename))
+        # Ranges of a segmented upload are written straight into place
+        if self.segment is not None and message.type in FILE_TYPES:
+            self.writeSegment(message)
+            return
+
+        # So are the chunks of a chunked upload
+        if self.chunked is not None and message.type in FILE_TYPES:
+            self.writeChunked(message)
+            return
+
+        # And the files of a directory upload
+        if self.batch is not None and message.type in FILE_TYPES:
+            self.writeBatch(message)
+            return
 
-        if message.type in MessageType.File:
+        if message.type in FILE_TYPES:
 
             # Check if a file was never opened for this connection
             if not self.fileIsOpen():
                 raise RuntimeError("No file opened")
 
-            # All File message types have a content, lets write that to the
-            # file.
-            self.file.write(message.content)
-            self._logger.debug("Wrote {}.".format(
-                message.content))
+            if self.file.rebuilt:
+                self.writeRebuilt(message)
+            else:
+                # All File message types have a content, lets write that to
+                # the file.
+                self.submit(self.file.write, self.fileContent(message), upload=self.file)
+
+                self.addChecksum(message, len(message.content))
+                self.file.offset += len(message.content)
+
+            self.recordProgress()
 
         # We can go ahead and close the file if we receive a FileEnd message
         if message.type == MessageType.FileEnd:
-            self.file.close()
+            partialFile = self.file
+            self.file = False
+            if partialFile.rebuilt:
+                crc = message.crc if self.config['verify_checksums'] else None
+                self.submit(partialFile.verifyRebuilt, crc, upload=partialFile)
+            else:
+                self.verifyFile(message, partialFile)
+            self.submit(partialFile.finish, upload=partialFile)
+
+    def startUpload(self, message):
+        # A previous upload of this stream was never finished
+        self.closeUpload()
+
+        if message.transfer is not None:
+            self.startSegment(message)
+        elif message.chunked:
+            self.startChunked(message)
+        elif message.batch:
+            self.startBatch(message)
+        else:
+            # Open a new file for writing to, or continue an interrupted
+            # upload of it
+            self.file = PartialFile(self._logger, self.filePath(message.filename),
+                                    message.size, message.offset or 0, message.delta,
+                                    message.compression, message.mtime, message.mode,
+                                    message.algorithm())
+            self.fileCrc = self.file.crc
+            self._logger.debug(
+                "Opened: {} at offset {}".format(message.filename, self.file.offset))
+
+    def recordProgress(self):
+        # Record how far we got every now and then, in case we are
+        # interrupted without closing the file
+        if self.file.offset - self.file.recorded >= self.config['resume_record_size']:
+            self.file.recorded = self.file.offset
+            self.submit(self.file.record, self.file.offset, self.fileCrc, upload=self.file)
+
+    def writesPlainly(self, message):
+        # FileParts of the current upload whose content goes straight into
+        # self.file, any number of them can be written at once
+        return (message.stream == self.stream and self.segment is None and
+                self.chunked is None and self.batch is None and self.fileIsOpen() and
+                not self.file.rebuilt)
+
+    def writeParts(self, parts):
+        # Write a run of FileParts of the current upload with one disk
+        # operation
+        contents = [part.content for part in parts]
+        if self.writer is None:
+            self.submit(self.file.writev, contents, upload=self.file)
+        else:
+            # One copy of all of them, our receive buffer is reused before a
+            # writer thread gets to it
+            self.submit(self.file.write, b"".join(contents), upload=self.file)
+
+        for part, content in zip(parts, contents):
+            self.addChecksum(part, len(content))
+            self.file.offset += len(content)
+
+        self.recordProgress()
+
+    def addChecksum(self, message, length):
+        # Continue the checksum of the upload with that of a message, it is
+        # unknown from a message without one (or with another algorithm) on
+        if (message.checksum is not None and self.fileCrc is not None and
+                message.algorithm() == self.file.algorithm):
+            self.fileCrc = combine(self.fileCrc, message.checksum, length, self.file.algorithm)
+        else:
+            self.fileCrc = None
+
+    def verifyFile(self, message, partialFile):
+        # A file that announced its size must have arrived whole
+        if partialFile.size is not None and partialFile.offset != partialFile.size:
+            self.discardFile(message, partialFile, "Size mismatch in {} ({} of {} bytes)".format(
+                os.path.basename(partialFile.path), partialFile.offset, partialFile.size))
+
+        # Compare the checksum of the whole file with what was received
+        if message.crc is None or self.fileCrc is None or not self.config['verify_checksums']:
+            return
+        if message.crc == self.fileCrc:
+            return
+
+        self.discardFile(message, partialFile, "Checksum mismatch in {}".format(
+            os.path.basename(partialFile.path)))
+
+    def discardFile(self, message, partialFile, reason):
+        # Don't leave a corrupt file behind
+        reason = "{}, it was discarded".format(reason)
+        self.submit(partialFile.discard)
+        self.respond(Message(type=MessageType.Error, stream=message.stream,
+                             content=reason.encode('utf-8')))
+        raise RuntimeError(reason)
+
+    def writeRebuilt(self, message):
+        # Content is decompressed (or a delta is rebuilt from our current copy
+        # of the file) by the disk operation that writes it, which also keeps
+        # the checksum of the data written (see PartialFile.writeRebuilt). A
+        # failure gives up on the upload.
+        self.file.offset += len(message.content)
+        if len(message.content) == 0:
+            return
+        write = self.file.writeDelta if self.file.basis is not None else self.file.writeCompressed
+        self.submit(write, self.fileContent(message),
+                    message.checksum is not None and self.config['verify_checksums'],
+                    upload=self.file)
+
+    def answerSignature(self, message):
+        # Describe our copy of a file so the endpoint can send a delta of it
+        if message.version != Message.VERSION:
+            self.respond(Message(version=message.version, type=MessageType.Error,
+                                 content="Deltas require protocol version {}".format(
+                                     Message.VERSION).encode('utf-8')))
+            return
+
+        path = self.requestedPath(message)
+        if path is None:
+            return
+
+        filename = message.filename
+        size = 0
+        blockSize = delta.MINIMUM_BLOCK_SIZE
+        signatures = b""
+        try:
+            with open(path, "rb") as file:
+                size = os.fstat(file.fileno()).st_size
+                blockSize = delta.blockSize(size)
+                signatures = delta.signatures(file, blockSize)
+        except OSError:
+            # We don't have the file, everything has to be sent
+            pass
+
+        self.respond(Message(type=MessageType.Signature, stream=message.stream,
+                             filename=filename, size=size, block_size=blockSize,
+                             content=signatures))
+        self._logger.debug("Sent {} signatures of {}".format(
+            len(signatures) // delta.SIGNATURE.size, filename))
+
+    def answerResume(self, message):
+        # Tell the endpoint how much of an interrupted upload we have
+        if message.version != Message.VERSION:
+            self.respond(Message(version=message.version, type=MessageType.Error,
+                                 content="Resuming requires protocol version {}".format(
+                                     Message.VERSION).encode('utf-8')))
+            return
+
+        path = self.requestedPath(message)
+        if path is None:
+            return
+
+        filename = message.filename
+        offset, crc = PartialFile.resumeOffset(path, message.size, message.algorithm())
+        self.respond(Message(type=MessageType.Resume, stream=message.stream,
+                             flags=message.flags & MessageFlag.Crc32, filename=filename,
+                             offset=offset, crc=crc))
+        self._logger.debug("{} can be resumed at offset {}".format(filename, offset))
+
+    def answerChunks(self, message):
+        # Tell the endpoint which chunks of a file we don't have yet
+        if message.version != Message.VERSION:
+            self.respond(Message(version=message.version, type=MessageType.Error,
+                                 content="Chunked uploads require protocol version {}".format(
+                                     Message.VERSION).encode('utf-8')))
+            return
+
+        if self.requestedPath(message) is None:
+            return
+
+        filename = message.filename
+        try:
+            entries = chunks.unpackManifest(message.content, message.size)
+        except RuntimeError as err:
+            self.respond(Message(type=MessageType.Error, stream=message.stream,
+                                 content=str(err).encode('utf-8')))
+            raise
+
+        # Without a chunk store the answer has no bitmap, the file has to be
+        # sent as a whole
+        if self.store is None:
+            self.respond(Message(type=MessageType.Chunks, stream=message.stream,
+                                 filename=filename, missing=len(entries), content=b""))
+            return
+
+        # Chunks that appear several times in the file are only sent once
+        missing = []
+        seen = set()
+        for index, (digest, _) in enumerate(entries):
+            if digest not in seen and not self.store.has(digest):
+                missing.append(index)
+            seen.add(digest)
+
+        self.manifests[filename] = (entries, missing)
+        self.respond(Message(type=MessageType.Chunks, stream=message.stream,
+                             filename=filename, missing=len(missing),
+                             content=chunks.packBitmap(missing, len(entries))))
+        self._logger.debug("Missing {} of {} chunks of {}".format(
+            len(missing), len(entries), filename))
+
+    def startChunked(self, message):
+        path = self.filePath(message.filename)
+        if message.filename not in self.manifests:
+            raise RuntimeError("Chunks of {} were sent without a manifest".format(
+                message.filename))
+
+        entries, missing = self.manifests.pop(message.filename)
+        size = sum(length for _, length in entries)
+        if message.size != size:
+            raise RuntimeError("Manifest of {} describes {} bytes, not {}".format(
+                message.filename, size, message.size))
+        self.chunked = ChunkedFile(self._logger, self.store, path, entries, missing)
+
+    def writeChunked(self, message):
+        self.submit(self.chunked.write, self.fileContent(message), upload=self.chunked)
+
+        if message.type == MessageType.FileEnd:
+            self.submit(self.chunked.finish, upload=self.chunked)
+            self.chunked = None
+
+    def startBatch(self, message):
+        self.batch = BatchFile(self._logger, self.filePath(message.filename))
+        self._logger.debug("Receiving directory {}".format(message.filename))
+
+    def writeBatch(self, message):
+        self.submit(self.batch.write, self.fileContent(message))
+
+        if message.type == MessageType.FileEnd:
+            self.submit(self.batch.finish)
+            self.batch = None
+
+    def startSegment(self, message):
+        # Everything is checked before anything is opened
+        path = self.filePath(message.filename)
+        if message.size is None or message.offset is None:
+            raise RuntimeError("Segment of {} is missing its size or offset".format(
+                message.filename))
+        if message.offset > message.size:
+            raise RuntimeError("Segment of {} starts past the end of the file".format(
+                message.filename))
+        if not message.transfer.isalnum():
+            raise RuntimeError("Invalid transfer id: {}".format(message.transfer))
+
+        segmentedFile = self.transfers.get(message.transfer)
+        if segmentedFile is not None and segmentedFile.size != message.size:
+            raise RuntimeError("Segment of {} is of a file of {} bytes, not {}".format(
+                message.filename, segmentedFile.size, message.size))
+        if segmentedFile is None:
+            segmentedFile = SegmentedFile(self._logger, path, message.size, message.transfer)
+            self.transfers[message.transfer] = segmentedFile
+
+        segmentedFile.writers += 1
+        segmentedFile.acquire()
+        # [file, transfer id, range offset, bytes written to the range]
+        self.segment = [segmentedFile, message.transfer, message.offset, 0]
+        self._logger.debug("Receiving {} from offset {}".format(
+            message.filename, message.offset))
+
+    def writeSegment(self, message):
+        segmentedFile, _, offset, written = self.segment
+
+        if offset + written + len(message.content) > segmentedFile.size:
+            self.leaveSegment()
+            raise RuntimeError("Segment of {} goes past the end of the file".format(
+                segmentedFile.path))
+
+        self.submit(segmentedFile.write, self.fileContent(message), offset + written,
+                    upload=segmentedFile)
+        self.segment[3] += len(message.content)
+
+        if message.type == MessageType.FileEnd:
+            self.submit(segmentedFile.completeRange, offset, self.segment[3],
+                        upload=segmentedFile)
+            self.leaveSegment()
+
+    def leaveSegment(self):
+        segmentedFile, transfer = self.segment[:2]
+        self.segment = None
+        segmentedFile.writers -= 1
+
+        # Forget the file once no connection of ours is writing to it. An
+        # unfinished file is kept so its missing ranges can still arrive.
+        if segmentedFile.writers == 0:
+            del self.transfers[transfer]
+        self.submit(segmentedFile.release)
+
+    def respond(self, message):
+        # Queue a message to be sent when the socket is writable
+        self.responses.append(memoryview(message.toBytes()))
+
+    def acknowledge(self):
+        # Acknowledge what we handled once ack_bytes add up, or when we
+        # handled everything we received so the endpoint isn't left waiting
+        unacknowledged = self.processed - self.ackedProcessed
+        if unacknowledged == 0:
+            return
+        if unacknowledged >= self.config['ack_bytes'] or self.bufferStart == self.bufferEnd:
+            self.ackedProcessed = self.processed
+            self.respond(Message(type=MessageType.Ack, acked=self.processed))
+
+    def startDownload(self, message):
+
+        # We stream file content with sendfile, which needs the length
+        # prefixed messages of version 0.2
+        if message.version != Message.VERSION:
+            self.respond(Message(version=message.version, type=MessageType.Error,
+                                 content="Downloads require protocol version {}".format(
+                                     Message.VERSION).encode('utf-8')))
+            return
+
+        # Files kept as a manifest are sent chunk after chunk
+        path = self.requestedPath(message)
+        if path is None:
+            return
+        manifest = self.store.readManifest(path) if self.store is not None else None
+        downloadChunks = deque(digest for digest, _ in manifest or ())
+
+        try:
+            if len(downloadChunks) != 0:
+                download = self.store.open(downloadChunks.popleft())
+            else:
+                download = open(path, "rb")
+        except OSError as err:
+            self.respond(Message(type=MessageType.Error, stream=message.stream,
+                                 content="Unable to download {}: {}".format(
+                                     message.filename, err.strerror).encode('utf-8')))
+            return
+
+        info = os.fstat(download.fileno())
+        state = {
+            'download': download,
+            'downloadStream': message.stream,
+            'downloadCrc': 0,
+            'downloadOffset': 0,
+            'downloadSize': info.st_size,
+            'downloadChunks': downloadChunks,
+            'downloadStarted': time.monotonic(),
+            'downloadInfo': info,
+            'downloadChecksums': [],
+            'downloadCached': self.checksumCache.get(info, self.config['download_segment_size'],
+                                                     self.downloadAlgorithm)
+        }
+
+        # Announce the size of the file so the endpoint can reserve room for
+        # it, a file kept as a manifest has no mtime and mode of its own
+        start = {'size': info.st_size, 'mtime': info.st_mtime, 'mode': info.st_mode & 0o777}
+        if manifest:
+            start = {'size': sum(length for _, length in manifest)}
+        self.respond(Message(type=MessageType.FileStart, stream=message.stream,
+                             flags=self.downloadFlags, filename=message.filename, content=b"",
+                             **start))
+        if manifest:
+            self._logger.debug("Sending {} ({} bytes in {} chunks) to [{}]".format(
+                message.filename, sum(length for _, length in manifest), len(manifest),
+                self.address))
+        else:
+            self._logger.debug("Sending {} ({} bytes) to [{}]".format(
+                message.filename, state['downloadSize'], self.address))
+
+        # Downloads of several streams are sent a part of each at a time
+        if self.download is None:
+            self.loadDownload(state)
+        else:
+            self.downloads.append(state)
+
+    def saveDownload(self):
+        return {name: getattr(self, name) for name in DOWNLOAD_STATE}
+
+    def loadDownload(self, state):
+        for name in DOWNLOAD_STATE:
+            setattr(self, name, state[name])
+
+    def finishDownload(self):
+        self.download.close()
+        self.download = None
+        self.sendSeconds.observe(time.monotonic() - self.downloadStarted)
+
+        message = Message(type=MessageType.FileEnd, stream=self.downloadStream, content=b"")
+        if self.config['checksums']:
+            message.flags = MessageFlag.Checksum | self.downloadFlags
+            message.crc = self.downloadCrc
+        self.respond(message)
+
+        if len(self.downloads) != 0:
+            self.loadDownload(self.downloads.popleft())
+
+    def nextDownloadPart(self):
+        """Start the next part of a file being downloaded or end the transfer
+
+        Queues the header of the next FilePart, the caller sends the
+        downloadRemaining bytes of content that follow it from the file.
+        Parts of the downloads of several streams take turns.
+        """
+        if len(self.downloads) != 0:
+            self.downloads.append(self.saveDownload())
+            self.loadDownload(self.downloads.popleft())
+
+        # Move on to the next chunk of a file kept as a manifest
+        if self.downloadOffset >= self.downloadSize and len(self.downloadChunks) != 0:
+            self.download.close()
+            self.download = self.store.open(self.downloadChunks.popleft())
+            self.downloadOffset = 0
+            self.downloadInfo = os.fstat(self.download.fileno())
+            self.downloadSize = self.downloadInfo.st_size
+            self.downloadChecksums = []
+            self.downloadCached = self.checksumCache.get(
+                self.downloadInfo, self.config['download_segment_size'], self.downloadAlgorithm)
+
+        if self.downloadOffset < self.downloadSize:
+            self.downloadRemaining = min(
+                self.config['download_segment_size'], self.downloadSize - self.downloadOffset)
+            message = Message(type=MessageType.FilePart, stream=self.downloadStream, content=b"")
+
+            # The checksum follows the part
+            self.downloadTrailer = None
+            if self.config['checksums']:
+                message.flags = MessageFlag.Checksum | self.downloadFlags
+                checksum = self.partChecksum()
+                self.downloadCrc = combine(self.downloadCrc, checksum, self.downloadRemaining,
+                                           self.downloadAlgorithm)
+                self.downloadTrailer = memoryview(FRAME_CHECKSUM.pack(checksum))
+
+            self.framing.append(memoryview(message.headerBytes(self.downloadRemaining)))
+        else:
+            self.finishDownload()
+
+    def partChecksum(self):
+        # Get the checksum of the part about to be sent. Unless it is known
+        # from an earlier download of the file, that means reading the part
+        # from the (page cached) file once.
+        partSize = self.config['download_segment_size']
+        if self.downloadCached is not None:
+            return self.downloadCached[self.downloadOffset // partSize]
+
+        checksum = ALGORITHMS[self.downloadAlgorithm](os.pread(
+            self.download.fileno(), self.downloadRemaining, self.downloadOffset))
+        self.downloadChecksums.append(checksum)
+        if self.downloadOffset + self.downloadRemaining == self.downloadSize:
+            self.checksumCache.put(self.downloadInfo, partSize, self.downloadChecksums,
+                                   self.downloadAlgorithm)
+        return checksum
+
+    def finishDownloadPart(self):
+        # Follow the content of a part with its checksum
+        if self.downloadTrailer is not None:
+            self.framing.append(self.downloadTrailer)
+            self.downloadTrailer = None
+
+    def wantsToSend(self):
+        return (len(self.responses) != 0 or len(self.framing) != 0 or
+                self.download is not None)
+
+    def sendQueued(self, queue):
+        """Send the first buffer of a queue
 
-    def processBuffer(self, buffer):
-        # Add this events buffer to our overall buffer
-        self.buffer += buffer
+        Returns:
+          int: bytes sent, None if the socket buffer filled up before all of
+            the buffer was sent
+        """
+        buffer = queue[0]
+        sent = self.socket.send(buffer)
+        self.countSent(sent)
+        if sent < len(buffer):
+            queue[0] = buffer[sent:]
+            self.drained = True
+            return None
+        queue.popleft()
+        return sent
 
-        # Our packets are terminated with a null terminator (\0).
-        # If we find one we know we have received a whole packet.
-        packetMarkerPosition = self.buffer.find(b'\0')
-        while packetMarkerPosition != -1:
+    def send(self):
+        """Send as much pending data as the socket will take
+
+        File content is copied to the socket by the kernel with sendfile.
+        Sending stops when the socket buffer is full or internal_send_size
+        bytes (or what our rate limits grant) were sent, so other connections
+        get a turn.
+
+        Returns:
+          int: the epoll mode the connection should be switched to, or None
+            to keep waiting for the socket to become writable
+        """
+        budget = self.config['internal_send_size']
+        if self.limiter is not None:
+            budget = self.limiter.grant(budget)
+            if budget == 0:
+                return self.throttle(select.EPOLLOUT, self.config['internal_send_size'])
+            sent = self.stats['sent']
+
+        self.drained = False
+        if not self.startTrace():
+            mode = self.sendPending(budget)
+        else:
+            started = time.perf_counter()
             try:
+                mode = self.sendPending(budget)
+            finally:
+                self.tracer.record('send', started)
 
-                # Extract our packet from the buffer
-                messageBuffer = self.buffer[:packetMarkerPosition]
+        if self.limiter is not None:
+            self.limiter.charge(self.stats['sent'] - sent)
+        return mode
 
-                # Attempt to convert our packet into a message
-                message = Message.fromBytes(messageBuffer)
-                self._logger.debug("Got a {} message!".format(message.type.name))
+    def sendPending(self, budget):
+        try:
+            while budget > 0:
+                # A download part is finished before anything else is sent
+                if len(self.framing) != 0:
+                    sent = self.sendQueued(self.framing)
+                    if sent is None:
+                        return None
+                    budget -= sent
 
-                self.processMessage(message)
+                elif self.downloadRemaining:
+                    sent = os.sendfile(self.socket.fileno(), self.download.fileno(),
+                                       self.downloadOffset, min(self.downloadRemaining, budget))
 
-            # If we have any issues running the above code, such as failing to
-            # parse the incoming bytes into a valid message, we should log that
-            # error.
+                    # The file shrunk while we were sending it, our messages
+                    # are length prefixed so we can't recover
+                    if sent == 0:
+                        self._logger.error("{} was truncated while downloading".format(
+                            self.download.name))
+                        self.shutdown()
+                        return 0
+
+                    budget -= sent
+                    self.countSent(sent)
+                    self.downloadOffset += sent
+                    self.downloadRemaining -= sent
+                    if self.downloadRemaining == 0:
+                        self.finishDownloadPart()
+
+                elif len(self.responses) != 0:
+                    sent = self.sendQueued(self.responses)
+                    if sent is None:
+                        return None
+                    budget -= sent
+
+                elif self.download is not None:
+                    self.nextDownloadPart()
+
+                else:
+                    # Nothing left to send, go back to receiving
+                    return select.EPOLLIN
+
+        # Socket buffer is full, wait until it is writable again
+        except BlockingIOError:
+            self.drained = True
+            return None
+        except (BrokenPipeError, ConnectionResetError):
+            self.shutdown()
+            return 0
+
+        return None
+
+    def processBuffer(self):
+        tracing = self.tracing
+
+        # Every complete message in the buffer is parsed in one pass. Version
+        # 0.2 messages announce their own length, legacy (0.1) messages are
+        # terminated with a null terminator (\0). A message that has not
+        # fully arrived stays at bufferStart.
+        while self.bufferStart < self.bufferEnd:
+            try:
+                if tracing:
+                    started = time.perf_counter()
+                messages, consumed = self.decoder.decode(
+                    self.buffer, self.bufferStart, self.bufferEnd)
+                if tracing:
+                    self.tracer.record('parse', started, bytes=consumed, messages=len(messages))
             except RuntimeError as err:
+                # We can't find the next message boundary in a stream we
+                # don't understand, so give up on this connection
                 self._logger.error(err)
+                self.parseErrors.inc()
+                self.stats['errors'] += 1
+                self.bufferStart = self.bufferEnd = 0
+                self.decoder.reset()
+                self.shutdown()
+                return
+
+            if not consumed:
+                return
+
+            # The messages (and their content) are views into the buffer,
+            # they are only valid until it is reused
+            try:
+                self.processMessages(messages)
             finally:
-                # Trim the buffer of packet we just processed
-                self.buffer = self.buffer[packetMarkerPosition + 1:]
+                # Move past the messages we just processed
+                self.bufferStart += consumed
+                self.processed += consumed
+
+        # Everything has been processed, start filling from the front again
+        self.bufferStart = self.bufferEnd = 0
 
-                # Check if there is another whole packet in the buffer
-                packetMarkerPosition = self.buffer.find(
-                    b'\0')
+    def processMessages(self, messages):
+        tracing = self.tracing
+        count = len(messages)
+        index = 0
+
+        while index < count:
+            message = messages[index]
+            index += 1
+
+            # The decoder puts the error of a message it could not parse in
+            # its place. Messages that were too large are turned down.
+            if isinstance(message, RuntimeError):
+                self.rejectMessage(message, getattr(message, 'stream', None))
+                continue
+
+            # So are messages with an invalid header, before any of it is
+            # acted on. The rest of an upload that couldn't start is ignored.
+            try:
+                message.validate()
+            except RuntimeError as err:
+                if message.type == MessageType.FileStart:
+                    self.abandoned.add(message.stream)
+                self.rejectMessage(err, message.stream)
+                continue
+
+            # Consecutive FileParts of a plain upload are written at once
+            parts = None
+            if message.type == MessageType.FilePart and self.writesPlainly(message):
+                end = index
+                while (end < count and isinstance(messages[end], Message) and
+                       messages[end].type == MessageType.FilePart and
+                       messages[end].stream == message.stream):
+                    end += 1
+                parts = messages[index - 1:end]
+                index = end
+
+            received = len(parts) if parts is not None else 1
+            self.parsedFrames.inc(received)
+            self.stats['messages'] += received
+
+            try:
+                if tracing:
+                    started = time.perf_counter()
+                if parts is not None:
+                    self.writeParts(parts)
+                else:
+                    self._logger.debug("Got a %s message!", message.type.name)
+                    self.processMessage(message)
+                if tracing:
+                    self.tracer.record('process', started, type=message.type.name,
+                                       messages=received)
+
+            # If we have any issues handling a message, such as it
+            # referring to a file that was never opened, we should log that
+            # error.
+            except RuntimeError as err:
+                self._logger.error(err)
+                self.messageErrors.inc()
+                self.stats['errors'] += 1
+
+    def rejectMessage(self, err, stream):
+        # A received message could not be parsed, the endpoint is told on its
+        # stream (if it is known)
+        self._logger.error(err)
+        self.parseErrors.inc()
+        self.stats['errors'] += 1
+        if stream is not None:
+            self.respond(Message(type=MessageType.Error, stream=stream,
+                                 content=str(err).encode('utf-8')))
+
+    def reserveBuffer(self, size):
+        """Ensure there are at least size free bytes at the end of the buffer
+
+        Args:
+          size (int): number of bytes that are about to be received
+        """
+        if len(self.buffer) - self.bufferEnd >= size:
+            return
+
+        used = self.bufferEnd - self.bufferStart
+
+        # Grow the buffer if the partial message and the next receive don't
+        # fit, otherwise just move the partial message to the front
+        if used + size > len(self.buffer):
+            buffer = bytearray(max(len(self.buffer) * 2, used + size))
+            buffer[:used] = self.bufferView[self.bufferStart:self.bufferEnd]
+            self.buffer = buffer
+            self.bufferView = memoryview(buffer)
+        else:
+            self.bufferView[:used] = self.bufferView[self.bufferStart:self.bufferEnd]
+
+        self.bufferStart = 0
+        self.bufferEnd = used
 
     def recv(self, bufferSize):
-        buffer = self.socket.recv(bufferSize)
+        if self.limiter is not None:
+            wanted = bufferSize
+            bufferSize = self.limiter.grant(bufferSize)
+            if bufferSize == 0:
+                return self.throttle(select.EPOLLIN, wanted)
+
+        # Give back memory a huge message made us allocate
+        if self.bufferStart == self.bufferEnd and len(self.buffer) > self.bufferSize * 4:
+            self.buffer = bytearray(self.bufferSize)
+            self.bufferView = memoryview(self.buffer)
+            self.bufferStart = self.bufferEnd = 0
+
+        self.reserveBuffer(bufferSize)
+        if self.startTrace():
+            started = time.perf_counter()
+        try:
+            received = self.socket.recv_into(
+                self.bufferView[self.bufferEnd:], bufferSize)
+        except ConnectionResetError:
+            # The endpoint closed the connection with our acknowledgements
+            # (or other answers) still unread
+            received = 0
+        except BlockingIOError:
+            # Edge triggered loops receive until there is nothing left
+            received = None
+        if self.tracing:
+            self.tracer.record('recv', started, bytes=received or 0)
+
+        self.drained = not received or received < bufferSize
+        if received is None:
+            return None
+
         # If we get an empty message, when know the communication channel
         # has been closed
-        if len(buffer) == 0:
+        if received == 0:
             self.shutdown()
             return 0
 
-        self._logger.debug("Got bytes: {0}".format(buffer))
+        self._logger.debug("Got %d bytes", received)
+        self.countReceived(received)
+        if self.limiter is not None:
+            self.limiter.charge(received)
 
-        self.processBuffer(buffer)
+        self.bufferEnd += received
+        self.processBuffer()
+        self.handleWriteFailures()
+        if self.acking:
+            self.acknowledge()
+
+        # Switch to sending if we have to respond to something, or stop
+        # receiving until our writes catch up
+        if self.wantsToSend():
+            return select.EPOLLOUT
+        if self.writer is not None and self.writer.pause():
+            self.paused = True
+            return 0
 
         return None
 
+    def resume(self):
+        # Our writes caught up, start receiving again (once the Errors of
+        # writes that failed are sent)
+        self.paused = False
+        return select.EPOLLOUT if self.wantsToSend() else select.EPOLLIN
+
+    def throttle(self, mode, size):
+        # Our rate limits are used up, stop polling until they granted size
+        # bytes again
+        self.throttles.inc()
+        self.throttled = (time.monotonic() + self.limiter.delay(size), mode)
+        return 0
+
+    def unthrottle(self):
+        _, mode = self.throttled
+        self.throttled = None
+        return mode
+
     def fileIsOpen(self):
         return self.file and not self.file.closed
 
     def shutdown(self):
-        self.socket.shutdown(socket.SHUT_RDWR)
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # The endpoint may already be gone
+            pass
 
 
 class Server:
@@ -111,10 +1866,41 @@ class Server:
         self.config = {
             'file_root': '/tmp',
             'event_timeout': 0.2,
-            'internal_recv_size': 8192
+            'internal_recv_size': 8192,
+            'internal_buffer_size': 65536,
+            'internal_send_size': 4194304,
+            'download_segment_size': 1048576,
+            'reuse_port': False,
+            'listen_backlog': socket.SOMAXCONN,  # Connections the kernel queues for us
+            'accept_burst': 64,  # Most connections accepted per turn
+            'edge_triggered': False,  # Poll connections with EPOLLET
+            'turn_size': 262144,  # Most bytes an edge triggered connection receives per turn
+            'writer_threads': 4,
+            'writer_queue_size': 64,
+            'metrics_port': None,  # Serve metrics over HTTP on this port
+            'metrics_interval': 0,  # Seconds between metrics in the log
+            'trace': None,  # Write a trace of the connections to this path
+            'trace_sample': 1,  # Trace one receive or send out of this many
+            'profile': None,  # Write a cProfile profile of the loop to this path
+            'rate_limit': 0,  # Bytes per second of all connections together, 0 is no limit
+            'ip_rate_limit': 0,  # Bytes per second of the connections of one ip
+            'connection_rate_limit': 0,  # Bytes per second of one connection
+            'rate_burst': 0.25  # Seconds of traffic a rate limit saves up
         }
         self.config.update(config)
 
+        # The bandwidth connections get, see shaping.py
+        self.shaper = Shaper(self.config)
+
+        # What the server is doing, see metrics.py
+        self.metrics = Metrics()
+        self.metricsEndpoint = None
+
+        # Where its time goes, see tracing.py
+        self.tracer = None
+        if self.config['trace'] is not None:
+            self.tracer = Tracer(self._logger, self.config['trace'], self.config['trace_sample'])
+
         # This msgQueue can be used to communicate messages to the server thread
         # See the commented out section in run for more info
         self.msgQueue = Queue()
@@ -125,6 +1911,23 @@ class Server:
         # Set the socket to reuse old port if server is restarted
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
+        # Let several server processes listen on the same port, the kernel
+        # spreads incoming connections between them
+        if self.config['reuse_port']:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        # Uploads that are being received over several connections
+        self.transfers = {}
+
+        # Checksums of the files that were downloaded
+        self.checksumCache = ChecksumCache()
+
+        # Writer threads tell the loop which paused connections can receive
+        # again (or have failed writes to answer) through this pipe
+        self.wakeup = os.pipe()
+        os.set_blocking(self.wakeup[0], False)
+        self.resumed = deque()
+
         # This is set to true when we want to end the server loop
         self.done = False
 
@@ -133,12 +1936,20 @@ class Server:
         # Sets the interface and port number for the socket to listen for connections
         # on.
         self.socket.bind((addr, port))
-        self.socket.listen(1)
+        self.socket.listen(self.config['listen_backlog'])
+
+        # Connections are accepted until none are left, and workers sharing
+        # the port may take one before we do
+        self.socket.setblocking(False)
 
         # In order to prevent locking up the main thread, we start a new child thread.
         # This child thread will continously run the server's loop function and
         # check self.done periodically if to see if it should end
-        thread = Thread(target=self.loop, args=())
+        if self.config['metrics_port'] is not None:
+            self.metricsEndpoint = self.metrics.serve(
+                self._logger, self.config['metrics_port'], addr)
+
+        thread = Thread(target=profiled(self.loop, self.config['profile']), args=())
         thread.start()
 
         self._logger.debug("Server listening on {}".format(port))
@@ -149,95 +1960,237 @@ class Server:
     def close(self):
         self.done = True
 
+    def wake(self, fileno, connection):
+        # Called from a writer thread once a connection's writes caught up,
+        # or one of them failed
+        self.resumed.append((fileno, connection))
+        os.write(self.wakeup[1], b"\0")
+
+    def writeFailed(self, fileno, connection, owner, err):
+        connection.writeFailed(owner, err)
+        self.wake(fileno, connection)
+
     def loop(self):
 
         connections = {}
 
+        # Connections waiting for their rate limits, a heap of (resume time,
+        # order, fileno, connection). Ties resume in the order they came in.
+        throttled = []
+        order = itertools.count()
+
+        writerPool = None
+        if self.config['writer_threads'] > 0:
+            writerPool = WriterPool(self._logger, self.config)
+
         # See http://scotdoyle.com/python-epoll-howto.html for a detailed
         # explination on the epoll interface
         epoll = select.epoll()
 
+        activeConnections = self.metrics.gauge(
+            'simftp_connections', "Connections currently open")
+        acceptedConnections = self.metrics.counter(
+            'simftp_accepted_connections_total', "Connections accepted")
+        self.metrics.gauge(
+            'simftp_open_transfers', "Uploads and downloads in progress",
+            lambda: sum(connection.openTransfers() for connection in list(connections.values())))
+        loopSeconds = self.metrics.histogram(
+            'simftp_loop_seconds', "Time spent handling the events of one epoll wait")
+        reporter = Reporter(self._logger, self.metrics, self.config['metrics_interval'])
+
+        # Edge triggered connections are only told about new data (or room),
+        # so they receive and send until the socket is drained. Those that
+        # used up their turn first go to ready and get another turn after the
+        # next poll, along with its events.
+        edge = self.config['edge_triggered']
+        flags = select.EPOLLET | select.EPOLLRDHUP if edge else 0
+        turns = max(1, self.config['turn_size'] // self.config['internal_recv_size']) if edge else 1
+        ready = []
+
         # We register our socket server in EPOLLIN mode to watch for incomming
         # connections.
-        epoll.register(self.socket.fileno(), select.EPOLLIN)
+        epoll.register(self.socket.fileno(), select.EPOLLIN | (select.EPOLLET if edge else 0))
+        epoll.register(self.wakeup[0], select.EPOLLIN)
         try:
 
             # Check if we should end our loop
             while not self.done:
 
-                # This will return any new events
-                events = epoll.poll(self.config['event_timeout'])
+                # This will return any new events, or wake us up when the
+                # first throttled connection may continue
+                timeout = self.config['event_timeout']
+                if len(ready) != 0:
+                    timeout = 0
+                elif len(throttled) != 0:
+                    timeout = min(timeout, max(0, throttled[0][0] - time.monotonic()))
+                events = epoll.poll(timeout)
+                started = time.perf_counter()
+
+                # Throttled connections whose rate limits refilled get polled
+                # again, before the events so they aren't passed over
+                now = time.monotonic()
+                while len(throttled) != 0 and throttled[0][0] <= now:
+                    _, _, fileno, connection = heapq.heappop(throttled)
+                    if connections.get(fileno) is connection:
+                        epoll.modify(fileno, connection.unthrottle() | flags)
+
+                if len(ready) != 0:
+                    events = ready + events
+                    ready = []
 
                 # Process any new events
                 for fileno, event in events:
 
-                    # This handles a new connection
+                    # This handles new connections, as many as a turn allows
                     if fileno == self.socket.fileno():
-                        client, address = self.socket.accept()
-                        client.setblocking(0)
-                        self._logger.info(
-                            "New connection from {0}".format(address))
+                        for _ in range(self.config['accept_burst']):
+                            try:
+                                client, address = self.socket.accept()
+                            except BlockingIOError:
+                                break
+                            except ConnectionAbortedError:
+                                continue
+                            except OSError as err:
+                                # Most likely out of file descriptors, the
+                                # connection stays in the backlog
+                                self._logger.error("Unable to accept a connection: {}".format(err))
+                                break
 
-                        # Store our client in a connections dictionary
-                        connections[client.fileno()] = Connection(self._logger, client, address, self.config['file_root'])
+                            client.setblocking(0)
+                            self._logger.info(
+                                "New connection from {0}".format(address))
 
-                        # Register incomming client connection with our epoll interface
-                        epoll.register(client.fileno(), select.EPOLLIN)
+                            connection = Connection(
+                                self._logger, client, address, self.config, self.transfers,
+                                metrics=self.metrics, tracer=self.tracer,
+                                limiter=self.shaper.limiter(address),
+                                checksumCache=self.checksumCache)
+                            activeConnections.inc()
+                            acceptedConnections.inc()
 
-                    # This event is called when there is data to be read in
-                    elif event & select.EPOLLIN:
+                            # Hand our client's disk writes to the writer threads
+                            if writerPool is not None:
+                                connection.writer = writerPool.createQueue(
+                                    lambda fileno=client.fileno(), connection=connection: (
+                                        self.wake(fileno, connection)),
+                                    lambda owner, err, fileno=client.fileno(),
+                                    connection=connection: (
+                                        self.writeFailed(fileno, connection, owner, err)))
 
-                        # Try to receive data from our client
-                        mode = connections[fileno].recv(self.config['internal_recv_size'])
+                            # Store our client in a connections dictionary
+                            connections[client.fileno()] = connection
 
-                        if mode is not None:
-                            epoll.modify(fileno, mode)
+                            # Register incomming client connection with our epoll interface
+                            epoll.register(client.fileno(), select.EPOLLIN | flags)
 
+                        else:
+                            # The backlog isn't empty yet
+                            if edge:
+                                ready.append((fileno, select.EPOLLIN))
+                        continue
 
-                        # Check if transmission is complete. In our case we are
-                        # using an NULL termination (\0)
-                        # Now that we know the transmission is complete, we should
-                        # send a response (switch to send mode)
-                        # if not buffers[fileno].endswith(b'\\\\0') and buffers[fileno].endswith(b'\\0'):
-                        #     responses[fileno]  = b'HTTP/1.0 200 OK\r\nDate: Mon, 1 Jan 1996 01:01:01 GMT\r\n'
-                        #     responses[fileno] += b'Content-Type: text/plain\r\nContent-Length: 13\r\n\r\n'
-                        #     responses[fileno] += b'Hello, world!'
-                        #     epoll.modify(fileno, select.EPOLLOUT)
-                        # Server.parse_message(buffers[fileno])
+                    # Some paused connections can receive again, or writes
+                    # of some failed. The uploads of those are given up on
+                    # even if the connection closed since.
+                    if fileno == self.wakeup[0]:
+                        os.read(self.wakeup[0], 4096)
+                        while len(self.resumed) != 0:
+                            fileno, connection = self.resumed.popleft()
+                            failed = connection.handleWriteFailures()
+                            if (connections.get(fileno) is not connection or
+                                    connection.throttled is not None):
+                                continue
+                            if connection.paused and not connection.writer.waiting:
+                                epoll.modify(fileno, connection.resume() | flags)
+                            elif failed and not connection.paused:
+                                epoll.modify(fileno, select.EPOLLOUT | flags)
+                        continue
+
+                    # A connection we closed earlier in this turn, or one
+                    # that stopped being polled after its event was reported
+                    connection = connections.get(fileno)
+                    if connection is None or (
+                            event & (select.EPOLLIN | select.EPOLLOUT) and
+                            (connection.paused or connection.throttled is not None)):
+                        continue
+
+                    # The connection failed (was reset or timed out)
+                    if event & select.EPOLLERR:
+                        error = connection.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                        self._logger.info("Connection to [{}] failed: {}".format(
+                            connection.address, os.strerror(error)))
+                        event = select.EPOLLHUP
+
+                    # This event is called when there is data to be read in
+                    elif event & select.EPOLLIN:
+
+                        # Try to receive data from our client, edge
+                        # triggered ones until there is nothing left. If the
+                        # endpoint closed its side that is only once we got
+                        # to the end, there won't be another event. Rate
+                        # limited connections share their buckets, they
+                        # receive once per turn so they take turns.
+                        for _ in range(turns if connection.limiter is None else 1):
+                            mode = connection.recv(self.config['internal_recv_size'])
+                            if mode is not None or (
+                                    connection.drained and not event & select.EPOLLRDHUP):
+                                break
+                        else:
+                            if edge:
+                                ready.append((fileno, select.EPOLLIN))
 
                     # This event is called when there is data to be written out
                     elif event & select.EPOLLOUT:
-                        pass
-                        # # Send out our response
-                        # numBytesWritten = connections[fileno].send(
-                        #     responses[fileno])
-                        # self._logger.debug("Sent response: {0}".format(
-                        #     responses[fileno][:numBytesWritten]))
-                        #
-                        # # Truncate our response buffer (remove the part that is
-                        # # already sent)
-                        # responses[fileno] = responses[fileno][numBytesWritten:]
-                        # self._logger.debug(responses[fileno])
-                        #
-                        # if len(responses[fileno]) == 0:
-                        #     epoll.modify(fileno, select.EPOLLIN)
-
-                    # Endpoint has closed the connection (No need to send shutdown)
-                    elif event & select.EPOLLHUP:
-                        self._logger.debug("Connection to [{}] closed!".format(connections[fileno].address))
+
+                        # Send out our responses, switches back to EPOLLIN
+                        # once everything is sent
+                        mode = connection.send()
+                        if edge and mode is None and not connection.drained:
+                            ready.append((fileno, select.EPOLLOUT))
+
+                    # The endpoint won't send anything more, what it sent
+                    # before is received once we are polling for it again
+                    elif not event & select.EPOLLHUP:
+                        continue
+
+                    # Endpoint has closed the connection (No need to send
+                    # shutdown), once we received everything it sent
+                    if event & select.EPOLLHUP and (
+                            not event & select.EPOLLIN or connection.drained):
+                        self._logger.debug("Connection to [{}] closed!".format(connection.address))
                         epoll.unregister(fileno)
-                        connections[fileno].close()
+                        connection.close()
                         del connections[fileno]
+                        activeConnections.dec()
+                        continue
+
+                    if mode is not None:
+                        epoll.modify(fileno, mode | flags)
+                    if connection.throttled is not None:
+                        heapq.heappush(throttled, (
+                            connection.throttled[0], next(order), fileno, connection))
+
+                if len(events) != 0:
+                    loopSeconds.observe(time.perf_counter() - started)
+                reporter.tick()
         finally:
 
-            # Close all open connections
+            # Close all open connections, then wait for pending disk writes
+            # (our writer threads would keep the process alive)
             self._logger.debug("Closing all connections...")
-            for fileno in connections:
-                epoll.unregister(fileno)
-                connections[fileno].close()
+            try:
+                for fileno in connections:
+                    epoll.unregister(fileno)
+                    connections[fileno].close()
+            finally:
+                if writerPool is not None:
+                    writerPool.close()
 
             # Unregister our server socket with our epoll
             epoll.unregister(self.socket.fileno())
+            epoll.unregister(self.wakeup[0])
+            os.close(self.wakeup[0])
+            os.close(self.wakeup[1])
 
             # Close our epoll
             epoll.close()
@@ -245,4 +2198,11 @@ class Server:
             # Close our socket server
             self.socket.close()
 
+            if self.metricsEndpoint is not None:
+                self.metricsEndpoint.shutdown()
+                self.metricsEndpoint.server_close()
+
+            if self.tracer is not None:
+                self.tracer.close()
+
             self._logger.info("Server shutdown")
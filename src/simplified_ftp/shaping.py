@@ -0,0 +1,167 @@
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        """Bytes that may be received or sent, refilled at a fixed rate
+
+        Args:
+          rate (float): bytes per second added to the bucket
+          burst (int): most bytes the bucket holds
+
+        Returns:
+          :class:`TokenBucket`: a full bucket
+        """
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+        # Connections drawing from this bucket
+        self.sharers = 0
+
+    def available(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self, amount):
+        # A send may overshoot what was granted, the bucket is in debt until
+        # that has been refilled
+        self.tokens -= amount
+
+    def ready(self, amount, now):
+        # Seconds until the bucket holds amount bytes
+        return max(0, (amount - self.available(now)) / self.rate)
+
+
+class Limiter:
+    def __init__(self, shaper, address, buckets, minimum):
+        """The rate limits of one connection
+
+        Every bucket a connection draws from is charged for all of its
+        traffic. Buckets shared with other connections only grant a fair
+        share of their burst per turn, so whoever epoll reports first can't
+        take all of it and connections get their turns round robin.
+
+        Args:
+          shaper (:class:`Shaper`): the shaper that made the limiter
+          address (str): ip of the endpoint
+          buckets ([:class:`TokenBucket`]): buckets the connection draws from
+          minimum (int): fewest bytes worth a receive or send
+
+        Returns:
+          :class:`Limiter`: a limiter of a new connection
+        """
+        self.shaper = shaper
+        self.address = address
+        self.buckets = buckets
+        self.minimum = minimum
+        for bucket in buckets:
+            bucket.sharers += 1
+
+    def grant(self, size):
+        """Bytes the connection may receive or send in this turn
+
+        Args:
+          size (int): bytes the connection would like to receive or send
+
+        Returns:
+          int: at most size bytes, 0 if the connection has to wait
+        """
+        now = time.monotonic()
+        allowed = size
+        for bucket in self.buckets:
+            share = bucket.available(now)
+            if bucket.sharers > 1:
+                share = min(share, max(bucket.capacity // bucket.sharers, self.minimum))
+            allowed = min(allowed, int(share))
+
+        if allowed < min(size, self.minimum):
+            return 0
+        return allowed
+
+    def charge(self, amount):
+        for bucket in self.buckets:
+            bucket.take(amount)
+
+    def delay(self, size):
+        """Seconds until a turn of the connection would be granted
+
+        Args:
+          size (int): bytes the connection would like to receive or send
+
+        Returns:
+          float: seconds to wait
+        """
+        now = time.monotonic()
+        amount = min(size, self.minimum)
+        return max(bucket.ready(amount, now) for bucket in self.buckets)
+
+    def close(self):
+        self.shaper.release(self)
+
+
+class Shaper:
+    def __init__(self, config):
+        """Token buckets limiting the bandwidth of a server's connections
+
+        Args:
+          config (obj): configuration options of the server
+
+        Returns:
+          :class:`Shaper`: a shaper without connections
+        """
+
+        # Setup config with defaults, a rate of 0 is no limit
+        self.config = {
+            'internal_recv_size': 8192,
+            'rate_limit': 0,  # Bytes per second of all connections together
+            'ip_rate_limit': 0,  # Bytes per second of the connections of one ip
+            'connection_rate_limit': 0,  # Bytes per second of one connection
+            'rate_burst': 0.25  # Seconds of traffic a bucket saves up
+        }
+        self.config.update(config)
+
+        self.total = self.bucket(self.config['rate_limit'])
+
+        # Buckets of the ips we have connections from, ip -> TokenBucket
+        self.addresses = {}
+
+    def bucket(self, rate):
+        if not rate:
+            return None
+        burst = max(int(rate * self.config['rate_burst']), self.config['internal_recv_size'])
+        return TokenBucket(rate, burst)
+
+    def limiter(self, address):
+        """Get the limiter of a new connection
+
+        Args:
+          address ((str, int)): address of the endpoint
+
+        Returns:
+          :class:`Limiter`: the connection's limiter, None if it isn't limited
+        """
+        ip = address[0]
+        buckets = []
+        if self.total is not None:
+            buckets.append(self.total)
+        if self.config['ip_rate_limit']:
+            if ip not in self.addresses:
+                self.addresses[ip] = self.bucket(self.config['ip_rate_limit'])
+            buckets.append(self.addresses[ip])
+        if self.config['connection_rate_limit']:
+            buckets.append(self.bucket(self.config['connection_rate_limit']))
+
+        if len(buckets) == 0:
+            return None
+        return Limiter(self, ip, buckets, self.config['internal_recv_size'])
+
+    def release(self, limiter):
+        # Forget the bucket of an ip once its last connection closed
+        for bucket in limiter.buckets:
+            bucket.sharers -= 1
+        bucket = self.addresses.get(limiter.address)
+        if bucket is not None and bucket.sharers == 0:
+            del self.addresses[limiter.address]
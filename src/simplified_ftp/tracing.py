@@ -0,0 +1,146 @@
+import threading
+import cProfile
+import json
+import time
+import os
+
+# ################# TRACING ###################
+#
+# Connections can time what they do in named spans:
+#
+# recv     a receive from the socket
+# parse    splitting the receive buffer into Messages, all at once
+# process  handling a message, or a run of FileParts written together
+# write    a disk operation, in the writer thread that runs it
+# send     a turn at sending responses and downloads
+#
+# Only every sample-th receive and send is traced, with the spans inside of
+# it, so tracing can stay on under load. Without a Tracer a connection only
+# tests a flag per receive, message and send. Spans are written as Chrome
+# trace events, which chrome://tracing, https://ui.perfetto.dev and
+# https://www.speedscope.app show as a flame chart.
+
+# Spans kept for the trace file, the summary counts every span
+MAXIMUM_EVENTS = 1000000
+
+
+def threadId():
+    # Native thread ids (Python 3.8) match those of profilers and top
+    return getattr(threading, 'get_native_id', threading.get_ident)()
+
+
+class Tracer:
+    def __init__(self, _logger, path=None, sample=1):
+        """Collects spans and writes them to a trace file
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          path (str): where the trace is written when the tracer is closed,
+            None only logs a summary
+          sample (int): trace one receive or send out of every sample
+
+        Returns:
+          :class:`Tracer`: an empty tracer
+        """
+        self._logger = _logger
+        self.path = path
+        self.sample = max(sample, 1)
+        self.skipped = 0
+        self.lock = threading.Lock()
+        self.events = []
+
+        # Span name -> [count, total seconds, longest seconds]
+        self.stats = {}
+
+    def sampled(self):
+        # Should the next receive or send be traced
+        self.skipped += 1
+        if self.skipped < self.sample:
+            return False
+        self.skipped = 0
+        return True
+
+    def record(self, name, started, **args):
+        """Record a span that started at started (time.perf_counter) and ends now
+
+        Args:
+          name (str): name of the span
+          started (float): when the span started
+          args: details shown with the span, like its size
+        """
+        ended = time.perf_counter()
+        duration = ended - started
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = [0, 0, 0]
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+            if self.path is not None and len(self.events) < MAXIMUM_EVENTS:
+                self.events.append({
+                    'name': name,
+                    'ph': 'X',
+                    'ts': started * 1e6,
+                    'dur': duration * 1e6,
+                    'pid': os.getpid(),
+                    'tid': threadId(),
+                    'args': args
+                })
+
+    def traced(self, name, function):
+        # Wrap a function so calling it is recorded as a span
+        def run(*args):
+            started = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                self.record(name, started)
+        return run
+
+    def summary(self):
+        lines = ["{:<8} {:>10} {:>12} {:>10} {:>10}".format(
+            "span", "count", "total ms", "mean us", "max us")]
+        for name, (count, total, longest) in sorted(self.stats.items()):
+            lines.append("{:<8} {:>10} {:>12.3f} {:>10.1f} {:>10.1f}".format(
+                name, count, total * 1e3, total / count * 1e6, longest * 1e6))
+        return "\n".join(lines)
+
+    def close(self):
+        # Log a summary and write the trace file
+        self._logger.info("Trace of 1 in {} receives and sends:\n{}".format(
+            self.sample, self.summary()))
+        if self.path is None:
+            return
+        with self.lock:
+            events = list(self.events)
+        with open(self.path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+        self._logger.info("Wrote {} spans to {}".format(len(events), self.path))
+
+
+def profiled(function, path):
+    """Run a function (like an event loop) under cProfile
+
+    Args:
+      function (callable): the function
+      path (str): where the profile is written when the function returns,
+        None runs the function as is
+
+    Returns:
+      callable: the function, profiled
+    """
+    if path is None:
+        return function
+
+    def run(*args):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return function(*args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+
+    return run
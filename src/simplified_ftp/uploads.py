@@ -0,0 +1,468 @@
+from message import Message, MessageType, MessageFlag
+from checksum import combine, ALGORITHM, ALGORITHMS, CRC32
+import compression
+import chunks
+import batch
+import delta
+import mmap
+import os
+
+# ################# UPLOADS ###################
+#
+# Uploads are generators of the messages to send, which don't know how the
+# messages are sent. Both clients (client.Client with its epoll loop and
+# aio.AsyncClient) drive the same generators, which may also yield:
+#
+# - an Ask, to send a Resume, Signature or Chunks message and be resumed
+#   with its answer (None if it didn't arrive within answer_timeout)
+# - a Work, to run a slow computation off the loop and be resumed with its
+#   result (or have what it raised raised in the generator)
+# - a concurrent.futures.Future, to be resumed once it is done
+#
+# Every upload is sent on a stream of its own, which the client picks.
+
+# Bytes of delta operations or directory records prepared by one Work
+READ_AHEAD = 1048576
+
+
+class Ask:
+    def __init__(self, message):
+        """An upload's question to the server
+
+        Args:
+          message (:class:`message.Message`): the Resume, Signature or
+            Chunks message
+
+        Returns:
+          :class:`Ask`: a question that wasn't sent yet
+        """
+        self.message = message
+        self.key = (message.type, message.filename)
+
+
+class Work:
+    def __init__(self, function, *args):
+        """An upload's slow computation, like the chunks of a file
+
+        Args:
+          function (callable): the computation
+          *args: arguments to call function with
+
+        Returns:
+          :class:`Work`: a computation that wasn't started yet
+        """
+        self.function = function
+        self.args = args
+
+
+def checksumRange(file, offset, end, algorithm):
+    # Checksum of part of a file, read a megabyte at a time
+    checksum = ALGORITHMS[algorithm]
+    fileCrc = 0
+    while offset < end:
+        fileBuffer = os.pread(file.fileno(), min(1048576, end - offset), offset)
+        if len(fileBuffer) == 0:
+            raise RuntimeError("{} shrunk while it was being read".format(file.name))
+        fileCrc = checksum(fileBuffer, fileCrc)
+        offset += len(fileBuffer)
+    return fileCrc
+
+
+def readAhead(pieces, size):
+    # The next pieces of an iterator, at least size bytes of them unless it
+    # ends first
+    taken = []
+    total = 0
+    for piece in pieces:
+        taken.append(piece)
+        total += len(piece)
+        if total >= size:
+            break
+    return taken
+
+
+def mapFile(file):
+    """Map a file to read it without copying
+
+    Slices of the map are sent straight from the page cache (see
+    Message.toBuffers). The map is unmapped once the last slice of it is
+    gone. Touching a page past the end of a file that shrunk raises SIGBUS,
+    so slices are only taken with readMapped.
+
+    Args:
+      file (obj): a file opened for reading
+
+    Returns:
+      memoryview: a view of the whole file
+    """
+    # Empty files can't be mapped
+    if os.fstat(file.fileno()).st_size == 0:
+        return memoryview(b"")
+    return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def readMapped(file, data, offset, size):
+    # Read the next slice of a mapped file. The size of the file is checked
+    # every time, a file that shrunk ends early like it would with a read.
+    end = min(offset + size, os.fstat(file.fileno()).st_size)
+    fileBuffer = data[offset:max(end, offset)]
+    return offset + len(fileBuffer), fileBuffer
+
+
+class Uploads:
+    def __init__(self, _logger, config):
+        """The uploads a client can send
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          config (obj): configuration options of the client
+
+        Returns:
+          :class:`Uploads`: the uploads
+        """
+        self._logger = _logger
+
+        # Setup config with defaults
+        self.config = {
+            'file_segment_size': 1024,  # Bytes
+            'protocol_version': Message.VERSION,
+            'checksums': True,  # Send checksums
+            'checksum_algorithm': ALGORITHM,  # crc32c or crc32, see checksum.py
+            'resume_uploads': True,
+            'delta_uploads': False,
+            'chunked_uploads': False,
+            'compression': None  # zlib, lzma or zstd
+        }
+        self.config.update(config)
+
+    def fileMessage(self, type, fileBuffer, compressor=None, **params):
+        # Create a File message, with a checksum if they are enabled
+        version = self.config['protocol_version']
+        content = fileBuffer
+        if compressor is not None:
+            content = compressor.compress(fileBuffer)
+            if type == MessageType.FileEnd:
+                content += compressor.flush()
+        if self.config['checksums'] and version == Message.VERSION:
+            params['flags'] = MessageFlag.Checksum | self.algorithmFlags()
+            params['checksum'] = ALGORITHMS[self.config['checksum_algorithm']](content)
+        return Message(version=version, type=type, content=content, **params)
+
+    def algorithmFlags(self):
+        # The flags that tell the server which checksums we send
+        return MessageFlag.Crc32 if self.config['checksum_algorithm'] == CRC32 else 0
+
+    def fileChecksum(self, fileCrc, message, fileBuffer, compressor=None):
+        # Continue the checksum of the whole file over fileBuffer, from the
+        # checksum of its message unless the message holds it compressed
+        if message.checksum is None:
+            return fileCrc
+        algorithm = self.config['checksum_algorithm']
+        if compressor is not None:
+            return ALGORITHMS[algorithm](fileBuffer, fileCrc)
+        return combine(fileCrc, message.checksum, len(fileBuffer), algorithm)
+
+    def fileCompressor(self, file, offset):
+        """Pick how to compress a file that is sent from offset on
+
+        Args:
+          file (obj): the file being sent, opened for reading
+          offset (int): where sending starts
+
+        Returns:
+          :class:`compression.Compressor`: None if the file is sent as is
+        """
+        codec = self.config['compression']
+        if codec is None or self.config['protocol_version'] != Message.VERSION:
+            return None
+
+        # Don't waste time on data that is already compressed
+        compressor = compression.compressorFor(
+            codec, os.pread(file.fileno(), compression.SAMPLE_SIZE, offset))
+        if compressor is None:
+            self._logger.info("{} doesn't compress, sending it as is".format(file.name))
+        return compressor
+
+    def resumeOffset(self, file, filename, size):
+        """Ask the server how much of an interrupted upload of a file it has
+
+        Args:
+          file (obj): the file being sent, opened for reading
+          filename (str): name of the file on the server
+          size (int): size of the file in bytes
+
+        Returns:
+          tuple: the offset to continue sending from and the checksum of the
+            file up to there
+        """
+        answer = yield Ask(Message(type=MessageType.Resume, flags=self.algorithmFlags(),
+                                   filename=filename, size=size))
+        if answer is None or answer.offset == 0 or answer.offset > size:
+            return 0, 0
+
+        # Make sure the server has the same bytes as we do before building
+        # on them
+        fileCrc = 0
+        if self.config['checksums']:
+            fileCrc = yield Work(checksumRange, file, 0, answer.offset,
+                                 self.config['checksum_algorithm'])
+            if answer.crc is not None and answer.crc != fileCrc:
+                self._logger.info("{} changed since it was interrupted, starting over".format(
+                    filename))
+                return 0, 0
+
+        self._logger.info("Resuming {} at offset {}".format(filename, answer.offset))
+        return answer.offset, fileCrc
+
+    def sendDelta(self, file, filename, size):
+        """Send a file as a delta of the server's copy of it
+
+        Args:
+          file (obj): the file being sent, opened for reading
+          filename (str): name of the file on the server
+          size (int): size of the file in bytes
+
+        Returns:
+          bool: False if the server has no copy to build on, nothing was
+            sent then
+        """
+        answer = yield Ask(Message(type=MessageType.Signature, filename=filename, content=b""))
+        if answer is None or len(answer.content) == 0 or size == 0:
+            return False
+
+        blockSize = answer.block_size
+        table = delta.signatureTable(answer.content)
+        self._logger.info("Sending {} as a delta of {} blocks".format(
+            filename, len(answer.content) // delta.SIGNATURE.size))
+
+        # The server checks the file it rebuilt, not the operations
+        fileCrc = 0
+        if self.config['checksums']:
+            fileCrc = yield Work(checksumRange, file, 0, size, self.config['checksum_algorithm'])
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+
+            # Searching for blocks is slow, it is done off the loop a batch
+            # of operations at a time
+            operations = delta.encode(data, blockSize, table, self.config['file_segment_size'])
+            type = MessageType.FileStart
+            while True:
+                contents = yield Work(readAhead, operations, READ_AHEAD)
+                if len(contents) == 0:
+                    break
+
+                for content in contents:
+                    if type == MessageType.FileStart:
+                        yield self.fileMessage(type, content, filename=filename,
+                                               size=size, delta=blockSize)
+                        type = MessageType.FilePart
+                    else:
+                        yield self.fileMessage(type, content)
+
+        message = self.fileMessage(MessageType.FileEnd, b"")
+        if message.checksum is not None:
+            message.crc = fileCrc
+        yield message
+        return True
+
+    def sendChunks(self, file, filename, size):
+        """Send the chunks of a file the server doesn't have yet
+
+        Args:
+          file (obj): the file being sent, opened for reading
+          filename (str): name of the file on the server
+          size (int): size of the file in bytes
+
+        Returns:
+          bool: False if the server doesn't store chunks, the file has to be
+            sent as a whole then
+        """
+        if size == 0:
+            return False
+
+        data = mapFile(file)
+        manifest = yield Work(chunks.manifest, data)
+        answer = yield Ask(Message(
+            type=MessageType.Chunks, filename=filename, size=size,
+            content=chunks.packManifest((digest, length) for digest, _, length in manifest)))
+        missing = None
+        if answer is not None:
+            missing = chunks.unpackBitmap(answer.content, len(manifest))
+        if missing is None or len(answer.content) == 0:
+            return False
+
+        self._logger.info("Sending {} of {} chunks of {}".format(
+            len(missing), len(manifest), filename))
+
+        # The missing chunks are sent back to back, cut into segments
+        segmentSize = self.config['file_segment_size']
+        type = MessageType.FileStart
+        for index in missing:
+            _, offset, length = manifest[index]
+            end = offset + length
+            while offset < end:
+                offset, fileBuffer = readMapped(file, data, offset, min(segmentSize, end - offset))
+                if len(fileBuffer) == 0:
+                    raise RuntimeError("{} shrunk while it was being sent".format(file.name))
+                if type == MessageType.FileStart:
+                    yield self.fileMessage(type, fileBuffer, filename=filename,
+                                           size=size, chunked=True)
+                    type = MessageType.FilePart
+                else:
+                    yield self.fileMessage(type, fileBuffer)
+
+        if type == MessageType.FileStart:
+            yield self.fileMessage(type, b"", filename=filename, size=size, chunked=True)
+        yield self.fileMessage(MessageType.FileEnd, b"")
+        return True
+
+    def sendFile(self, filepath):
+        """Send a file to the server
+
+        Args:
+          filepath (str): path of the file to send
+        """
+        offset = 0
+        segmentSize = self.config['file_segment_size']
+        endSent = False
+        filename = os.path.basename(filepath)
+        modern = self.config['protocol_version'] == Message.VERSION
+
+        # Checksum of the whole file, built from the checksums of its messages
+        fileCrc = 0
+
+        # Open a file to read from
+        with open(filepath, 'rb') as file:
+            start = {'filename': filename}
+
+            # Announce the size of the file, the server reserves room for it
+            # and checks that all of it arrived, and the mtime and mode its
+            # copy gets
+            info = os.fstat(file.fileno())
+            start.update(size=info.st_size, mtime=info.st_mtime, mode=info.st_mode & 0o777)
+
+            # Only send the chunks of the file the server doesn't have
+            if self.config['chunked_uploads'] and modern:
+                if (yield from self.sendChunks(file, filename, info.st_size)):
+                    return
+
+            # Continue where an interrupted upload of the file stopped
+            if self.config['resume_uploads'] and modern:
+                offset, fileCrc = yield from self.resumeOffset(file, filename, info.st_size)
+                if offset != 0:
+                    start['offset'] = offset
+
+            # Only send what changed since the server's copy of the file
+            if self.config['delta_uploads'] and offset == 0 and modern:
+                if (yield from self.sendDelta(file, filename, info.st_size)):
+                    return
+
+            # Compress the content as one stream
+            compressor = self.fileCompressor(file, offset)
+            if compressor is not None:
+                start['compression'] = compressor.codec
+
+            # The content of our messages are views of the mapped file
+            data = mapFile(file)
+
+            # Create file start message, the server checks that it supports
+            # the codec of a compressed upload before any content follows
+            if compressor is None:
+                offset, fileBuffer = readMapped(file, data, offset, segmentSize)
+            else:
+                fileBuffer = b""
+            message = self.fileMessage(MessageType.FileStart, fileBuffer, compressor, **start)
+            fileCrc = self.fileChecksum(fileCrc, message, fileBuffer, compressor)
+            yield message
+
+            # Create file part or file end message depending on size of fileBuffer
+            offset, fileBuffer = readMapped(file, data, offset, segmentSize)
+            while len(fileBuffer) != 0:
+                if len(fileBuffer) < segmentSize:
+                    message = self.fileMessage(MessageType.FileEnd, fileBuffer, compressor)
+                    if message.checksum is not None:
+                        message.crc = self.fileChecksum(fileCrc, message, fileBuffer, compressor)
+                    yield message
+                    endSent = True
+                    break
+                else:
+                    message = self.fileMessage(MessageType.FilePart, fileBuffer, compressor)
+                    fileCrc = self.fileChecksum(fileCrc, message, fileBuffer, compressor)
+
+                    # The compressor may keep a segment to itself for now
+                    if len(message.content) != 0:
+                        yield message
+                    offset, fileBuffer = readMapped(file, data, offset, segmentSize)
+
+        # If we happened to send the entire file but not send a file end, lets do that now
+        if not endSent:
+            message = self.fileMessage(MessageType.FileEnd, b"", compressor)
+            if message.checksum is not None:
+                message.crc = fileCrc
+            yield message
+
+    def sendDirectory(self, dirpath):
+        """Send every file below a directory as one transfer
+
+        Files are packed into records (see batch.py) as the directory is
+        walked, many small files share a message. Walking and reading is
+        done off the loop.
+
+        Args:
+          dirpath (str): path of the directory to send
+        """
+        segmentSize = self.config['file_segment_size']
+        name = os.path.basename(os.path.normpath(dirpath))
+
+        type = MessageType.FileStart
+        pending = bytearray()
+        records = batch.pack(dirpath, segmentSize)
+        while True:
+            pieces = yield Work(readAhead, records, READ_AHEAD)
+            if len(pieces) == 0:
+                break
+
+            for piece in pieces:
+                pending += piece
+                while len(pending) >= segmentSize:
+                    if type == MessageType.FileStart:
+                        yield self.fileMessage(type, bytes(pending[:segmentSize]),
+                                               filename=name, batch=True)
+                        type = MessageType.FilePart
+                    else:
+                        yield self.fileMessage(type, bytes(pending[:segmentSize]))
+                    del pending[:segmentSize]
+
+        if type == MessageType.FileStart:
+            yield self.fileMessage(type, bytes(pending), filename=name, batch=True)
+            pending = b""
+        yield self.fileMessage(MessageType.FileEnd, bytes(pending))
+
+    def sendFileRange(self, filepath, transfer, offset, length):
+        """Send one byte range of a file that is uploaded over several connections
+
+        Args:
+          filepath (str): path of the file to send
+          transfer (str): id of the upload, shared by all of its ranges
+          offset (int): where the range starts in the file
+          length (int): size of the range in bytes
+        """
+        segmentSize = self.config['file_segment_size']
+        filename = os.path.basename(filepath)
+        end = offset + length
+
+        with open(filepath, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            data = mapFile(file)
+
+            offset, fileBuffer = readMapped(file, data, offset, min(segmentSize, end - offset))
+            yield self.fileMessage(MessageType.FileStart, fileBuffer, filename=filename,
+                                   transfer=transfer, size=size, offset=offset - len(fileBuffer))
+
+            while offset < end:
+                offset, fileBuffer = readMapped(file, data, offset, min(segmentSize, end - offset))
+                if len(fileBuffer) == 0:
+                    raise RuntimeError("{} shrunk while it was being sent".format(filepath))
+                yield self.fileMessage(MessageType.FilePart, fileBuffer)
+
+        yield self.fileMessage(MessageType.FileEnd, b"")
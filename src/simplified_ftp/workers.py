@@ -0,0 +1,110 @@
+from server import Server
+import signal
+import time
+import os
+
+
+class Workers:
+    def __init__(self, _logger, config):
+        """Creates a group of server processes sharing one port
+
+        Every worker is a forked process running its own :class:`Server` (and
+        epoll loop) bound with SO_REUSEPORT, so connections are spread over
+        all cores. Workers that die are restarted.
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          config (obj): configuration options, also passed on to every
+            worker's server
+
+        Returns:
+          :class:`Workers`: a group of workers that is not started yet
+        """
+        self._logger = _logger
+
+        # Setup config with defaults
+        self.config = {
+            'workers': os.cpu_count() or 1,
+            'restart_delay': 1  # Seconds
+        }
+        self.config.update(config)
+
+        # Worker process ids, pid -> worker number
+        self.workers = {}
+
+        # This is set to true when we want the workers to stop
+        self.done = False
+
+    def listen(self, port, addr='0.0.0.0'):
+        self.port = port
+        self.addr = addr
+
+        for number in range(self.config['workers']):
+            self.spawn(number)
+
+        self._logger.debug("{} workers listening on {}".format(
+            len(self.workers), port))
+
+    def spawn(self, number):
+        pid = os.fork()
+
+        if pid != 0:
+            self.workers[pid] = number
+            return pid
+
+        # This is the worker process, it must never return into the code of
+        # the parent process
+        status = 1
+        try:
+            status = self.work(number)
+        finally:
+            os._exit(status)
+
+    def work(self, number):
+        config = dict(self.config, reuse_port=True)
+        server = Server(self._logger, config)
+
+        def close(sig, frame):
+            server.close()
+
+        # The parent tells us to stop with SIGTERM, ctrl-c sends SIGINT to
+        # the whole process group
+        signal.signal(signal.SIGTERM, close)
+        signal.signal(signal.SIGINT, close)
+
+        thread = server.listen(self.port, self.addr)
+        self._logger.info("Worker {} ({}) started".format(number, os.getpid()))
+        thread.join()
+
+        return 0
+
+    def supervise(self):
+        """Wait for workers to exit, restarting them until closed"""
+        while len(self.workers) != 0:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            number = self.workers.pop(pid, None)
+            if number is None or self.done:
+                continue
+
+            if os.WIFSIGNALED(status):
+                reason = "was killed by signal {}".format(os.WTERMSIG(status))
+            else:
+                reason = "exited with status {}".format(os.WEXITSTATUS(status))
+            self._logger.error("Worker {} ({}) {}, restarting".format(number, pid, reason))
+            time.sleep(self.config['restart_delay'])
+
+            # We may have been closed while waiting to restart
+            if not self.done:
+                self.spawn(number)
+
+    def close(self):
+        self.done = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,147 @@
+from threading import Thread, Lock
+from collections import deque
+import queue
+
+
+class WriterQueue:
+    def __init__(self, _logger, pool, limit, onDrained=None, onFailed=None):
+        """Disk operations of one connection, run in order by a :class:`WriterPool`
+
+        Once an operation of an owner (eg. the upload it writes to) failed,
+        the later operations of that owner are dropped. The owner and the
+        exception are passed to onFailed, the connection decides what to do
+        about them.
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          pool (:class:`WriterPool`): the pool that runs our operations
+          limit (int): number of pending operations at which the queue is full
+          onDrained (function): called from a writer thread once a paused
+            queue has drained to half of its limit
+          onFailed (function): called from a writer thread with the owner of
+            an operation that failed and the exception it raised
+
+        Returns:
+          :class:`WriterQueue`: an empty queue
+        """
+        self._logger = _logger
+        self.pool = pool
+        self.limit = limit
+        self.onDrained = onDrained
+        self.onFailed = onFailed
+
+        self.lock = Lock()
+        self.pending = deque()
+
+        # True while a writer thread owns (or is about to own) this queue, so
+        # only one thread ever runs our operations
+        self.scheduled = False
+
+        # True while our connection waits for us to drain
+        self.waiting = False
+
+        # Owners whose operations are dropped, only used by the writer thread
+        self.failed = set()
+
+    def submit(self, function, *args, owner=None):
+        with self.lock:
+            self.pending.append((function, args, owner))
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.pool.ready.put(self)
+
+    def full(self):
+        return len(self.pending) >= self.limit
+
+    def pause(self):
+        """Ask to be told (through onDrained) when the queue drains
+
+        Returns:
+          bool: True if the queue is full and onDrained will be called
+        """
+        with self.lock:
+            if len(self.pending) < self.limit:
+                return False
+            self.waiting = True
+            return True
+
+    def run(self):
+        # Called by a writer thread, runs operations until the queue is empty
+        while True:
+            drained = False
+            with self.lock:
+                if len(self.pending) == 0:
+                    self.scheduled = False
+                    return
+                function, args, owner = self.pending.popleft()
+                if self.waiting and len(self.pending) <= self.limit // 2:
+                    self.waiting = False
+                    drained = True
+
+            if drained and self.onDrained is not None:
+                self.onDrained()
+
+            if owner is not None and owner in self.failed:
+                continue
+            try:
+                function(*args)
+            except Exception as err:
+                self._logger.error("Disk operation failed: {}".format(err))
+                if owner is not None:
+                    self.failed.add(owner)
+                    if self.onFailed is not None:
+                        self.onFailed(owner, err)
+
+
+class WriterPool:
+    def __init__(self, _logger, config):
+        """Creates a pool of threads that write incoming file data to disk
+
+        Every connection gets its own bounded :class:`WriterQueue`, so a slow
+        disk only holds up the connections writing to it and the memory
+        used by pending writes stays capped.
+
+        Args:
+          _logger (obj): A logger with a info and debug method
+          config (obj): configuration options
+
+        Returns:
+          :class:`WriterPool`: a started pool
+        """
+        self._logger = _logger
+
+        # Setup config with defaults
+        self.config = {
+            'writer_threads': 4,
+            'writer_queue_size': 64  # Pending operations per connection
+        }
+        self.config.update(config)
+
+        # Queues that have operations waiting for a writer thread
+        self.ready = queue.Queue()
+
+        self.threads = []
+        for _ in range(self.config['writer_threads']):
+            # Not daemons, what was submitted is written before we exit
+            thread = Thread(target=self.work, args=())
+            thread.start()
+            self.threads.append(thread)
+
+    def createQueue(self, onDrained=None, onFailed=None):
+        return WriterQueue(self._logger, self, self.config['writer_queue_size'], onDrained,
+                           onFailed)
+
+    def work(self):
+        while True:
+            writerQueue = self.ready.get()
+            if writerQueue is None:
+                return
+            writerQueue.run()
+
+    def close(self):
+        # Let the threads finish what has been submitted, then stop them
+        for _ in self.threads:
+            self.ready.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Loopback benchmarks for simplified-ftp.
+
+    Starts a Server and a Client on localhost and transfers files of varied
+    size and content, then times the message hot paths on their own.
+    Results are printed and can be saved as JSON, a later run compares
+    itself against such a file:
+
+        $ pipenv run benchmark --output before.json
+        $ pipenv run benchmark --compare before.json
+
+    CPU time is that of the whole process, client and server included.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'simplified_ftp'))
+
+from checksum import ALGORITHM, IMPLEMENTATION  # noqa: E402
+from client import Client  # noqa: E402
+from message import Message, MessageType, MessageFlag  # noqa: E402
+from server import Connection, Server  # noqa: E402
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+BIG_TXT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'big.txt')
+
+MEGABYTE = 1048576
+GIGABYTE = 1073741824
+
+# Metrics where a lower value is better, for comparisons
+LOWER_IS_BETTER = ('seconds', 'ttfb_ms', 'cpu_s_per_gb', 'us_per_call')
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the SimFTP client and server over loopback")
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="PATH",
+        help="write the results to a JSON file")
+    parser.add_argument(
+        "-c",
+        "--compare",
+        metavar="PATH",
+        help="compare the results with those of an earlier run")
+    parser.add_argument(
+        "-q",
+        "--quick",
+        help="use small files and few iterations, for a smoke test",
+        action="store_true")
+    parser.add_argument(
+        "-k",
+        "--only",
+        metavar="TEXT",
+        help="only run benchmarks whose name contains TEXT")
+    parser.add_argument(
+        "--segment-size",
+        dest="segment_size",
+        type=int,
+        default=65536,
+        help="file_segment_size of the client in bytes")
+    parser.add_argument(
+        "--edge-triggered",
+        dest="edge_triggered",
+        help="run the server's event loop edge triggered",
+        action="store_true")
+    return parser.parse_args(args)
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(path, timeout=120):
+    # Finished transfers are renamed into place, so the file appearing means
+    # it is complete
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise RuntimeError("Timed out waiting for {}".format(path))
+        time.sleep(0.0005)
+    return time.perf_counter()
+
+
+def random_bytes(rand, size):
+    # random.randbytes needs Python 3.9
+    return rand.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def make_files(directory, quick):
+    """Create the files that are transferred
+
+    Returns:
+      dict: name -> path
+    """
+    size = 4 * MEGABYTE if quick else 64 * MEGABYTE
+    rand = random.Random(471)
+    files = {}
+
+    # Text, as many copies of big.txt as fit
+    path = os.path.join(directory, 'text.txt')
+    with open(BIG_TXT, 'rb') as source:
+        text = source.read()
+    with open(path, 'wb') as file:
+        for _ in range(max(size // len(text), 1)):
+            file.write(text)
+    files['text'] = path
+
+    # Incompressible binary data
+    path = os.path.join(directory, 'random.bin')
+    with open(path, 'wb') as file:
+        for _ in range(size // MEGABYTE):
+            file.write(random_bytes(rand, MEGABYTE))
+    files['random'] = path
+
+    # Sparse binary data, compresses very well
+    path = os.path.join(directory, 'zeros.bin')
+    with open(path, 'wb') as file:
+        file.truncate(size)
+    files['zeros'] = path
+
+    # A small file, dominated by per transfer costs
+    path = os.path.join(directory, 'small.bin')
+    with open(path, 'wb') as file:
+        file.write(random_bytes(rand, 4096))
+    files['small'] = path
+
+    return files
+
+
+def transfer_result(size, seconds, cpu, frames, ttfb=None):
+    result = {
+        'bytes': size,
+        'seconds': round(seconds, 6),
+        'mb_per_s': round(size / MEGABYTE / seconds, 2),
+        'frames_per_s': round(frames / seconds, 1),
+        'cpu_s_per_gb': round(cpu / size * GIGABYTE, 3)
+    }
+    if ttfb is not None:
+        result['ttfb_ms'] = round(ttfb * 1000, 3)
+    return result
+
+
+def run_loopback(files, segmentSize, selected, edgeTriggered=False):
+    """Upload every file to a local server, then download it again
+
+    Returns:
+      dict: benchmark name -> metrics
+    """
+    results = {}
+    root = tempfile.mkdtemp(prefix='simftp-server-')
+    downloads = tempfile.mkdtemp(prefix='simftp-client-')
+    port = free_port()
+
+    server = Server(_logger, {'file_root': root, 'edge_triggered': edgeTriggered})
+    serverThread = server.listen(port, '127.0.0.1')
+    client = Client(_logger, {
+        'file_segment_size': segmentSize,
+        'download_root': downloads,
+        'resume_uploads': False
+    })
+    clientThread = client.connect(port)
+
+    # Note when the first message of a download arrives
+    firstMessage = {}
+    processMessage = client.connection.processMessage
+
+    def timedProcessMessage(message):
+        if message.type == MessageType.FileStart and message.filename not in firstMessage:
+            firstMessage[message.filename] = time.perf_counter()
+        processMessage(message)
+
+    client.connection.processMessage = timedProcessMessage
+
+    try:
+        for name, path in files.items():
+            size = os.path.getsize(path)
+            filename = os.path.basename(path)
+
+            if selected('upload_' + name):
+                cpu = cpu_time()
+                start = time.perf_counter()
+                client.commandQueue.put(client.sendFile(path))
+                end = wait_for(os.path.join(root, filename))
+                results['upload_' + name] = transfer_result(
+                    size, end - start, cpu_time() - cpu, max(-(-size // segmentSize), 1) + 1)
+
+            if selected('download_' + name):
+                if not os.path.exists(os.path.join(root, filename)):
+                    shutil.copyfile(path, os.path.join(root, filename))
+                segment = server.config['download_segment_size']
+                cpu = cpu_time()
+                start = time.perf_counter()
+                client.commandQueue.put(client.download(filename))
+                end = wait_for(os.path.join(downloads, filename))
+                results['download_' + name] = transfer_result(
+                    size, end - start, cpu_time() - cpu, -(-size // segment) + 2,
+                    firstMessage[filename] - start)
+    finally:
+        client.close()
+        server.close()
+        clientThread.join()
+        serverThread.join()
+        shutil.rmtree(root)
+        shutil.rmtree(downloads)
+
+    return results
+
+
+def time_calls(function, iterations):
+    # Best of a few rounds, in seconds per call
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        elapsed = (time.perf_counter() - start) / iterations
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def call_result(seconds, size):
+    return {
+        'us_per_call': round(seconds * 1e6, 3),
+        'calls_per_s': round(1 / seconds, 1),
+        'mb_per_s': round(size / MEGABYTE / seconds, 2)
+    }
+
+
+class NullSocket:
+    # Stands in for the socket of a Connection that only parses
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+def run_micro(quick, selected):
+    """Time the message hot paths without any I/O
+
+    Returns:
+      dict: benchmark name -> metrics
+    """
+    results = {}
+    iterations = 200 if quick else 5000
+    content = random_bytes(random.Random(471), 65536)
+
+    for flags, suffix in ((0, ''), (MessageFlag.Checksum, '_checksum')):
+        message = Message(type=MessageType.FilePart, content=content, flags=flags)
+        frame = message.toBytes()
+
+        if selected('toBytes' + suffix):
+            def toBytes():
+                message.checksum = None
+                message.toBytes()
+            results['toBytes' + suffix] = call_result(
+                time_calls(toBytes, iterations), len(content))
+
+        if selected('fromBytes' + suffix):
+            view = memoryview(frame)
+            results['fromBytes' + suffix] = call_result(
+                time_calls(lambda: Message.fromBytes(view), iterations), len(content))
+
+    if selected('processBuffer'):
+        # A buffer full of FileParts of an upload in progress
+        root = tempfile.mkdtemp(prefix='simftp-micro-')
+        connection = Connection(_logger, NullSocket(), 'benchmark', {
+            'file_root': root,
+            'internal_buffer_size': 1048576
+        })
+        connection.processMessage(Message(type=MessageType.FileStart, filename='micro.bin',
+                                          content=b""))
+        frames = [Message(type=MessageType.FilePart, content=content[:4096],
+                          flags=MessageFlag.Checksum).toBytes() for _ in range(128)]
+        buffer = b"".join(frames)
+
+        def processBuffer():
+            connection.buffer[:len(buffer)] = buffer
+            connection.bufferStart = 0
+            connection.bufferEnd = len(buffer)
+            connection.processBuffer()
+
+        seconds = time_calls(processBuffer, max(iterations // 100, 10))
+        results['processBuffer'] = call_result(seconds, len(buffer))
+        results['processBuffer']['frames_per_s'] = round(len(frames) / seconds, 1)
+        connection.close()
+        shutil.rmtree(root)
+
+    return results
+
+
+def compare(results, earlier):
+    """Print how results changed since an earlier run"""
+    print("\nCompared with the earlier run:")
+    for name, metrics in results.items():
+        if name not in earlier:
+            continue
+        changes = []
+        for metric, value in metrics.items():
+            before = earlier[name].get(metric)
+            if not before or metric == 'bytes':
+                continue
+            change = (value - before) / before * 100
+            better = change < 0 if metric in LOWER_IS_BETTER else change > 0
+            changes.append("{} {:+.1f}%{}".format(
+                metric, change, "" if abs(change) < 5 else (" (better)" if better else " (worse)")))
+        print("  {:<20} {}".format(name, ", ".join(changes)))
+
+
+def main(args):
+    """Run the benchmarks
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+
+    def selected(name):
+        return args.only is None or args.only in name
+
+    directory = tempfile.mkdtemp(prefix='simftp-bench-')
+    try:
+        files = make_files(directory, args.quick)
+        results = run_loopback(files, args.segment_size, selected, args.edge_triggered)
+    finally:
+        shutil.rmtree(directory)
+    results.update(run_micro(args.quick, selected))
+
+    for name, metrics in results.items():
+        print("{:<20} {}".format(name, ", ".join(
+            "{} {}".format(metric, value) for metric, value in metrics.items())))
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'crc32c': IMPLEMENTATION,
+        'checksum': ALGORITHM,
+        'quick': args.quick,
+        'segment_size': args.segment_size,
+        'edge_triggered': args.edge_triggered,
+        'results': results
+    }
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file)['results'])
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,11 +1,94 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-    Dummy conftest.py for simplified_ftp.
+    conftest.py for simplified_ftp.
 
-    If you don't know what this is for, just leave it empty.
-    Read more about conftest.py under:
-    https://pytest.org/latest/plugins.html
+    The modules of simplified_ftp import each other by their own names, the
+    package directory is put on the path so the tests can do the same.
 """
 
-# import pytest
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'simplified_ftp'))
+
+from aio import AsyncServer  # noqa: E402
+from client import Client  # noqa: E402
+from server import Server  # noqa: E402
+from loopback import free_port, wait_until, RawConnection  # noqa: E402
+
+_logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def serve(tmp_path):
+    """Start servers on free loopback ports, they are closed after the test
+
+    Returns:
+      function: takes the config and engine (:class:`server.Server` by
+        default) of a server, returns the started server, its port and its
+        file root
+    """
+    started = []
+
+    def start(config={}, engine=Server):
+        root = tmp_path / "server{}".format(len(started))
+        root.mkdir()
+        port = free_port()
+        server = engine(_logger, dict({'file_root': str(root)}, **config))
+        started.append((server, server.listen(port, '127.0.0.1')))
+
+        # The asyncio engine starts listening in its own thread
+        if isinstance(server, AsyncServer):
+            wait_until(lambda: server.server is not None)
+        return server, port, str(root)
+
+    yield start
+    for server, thread in started:
+        server.close()
+        thread.join()
+
+
+@pytest.fixture
+def connect(tmp_path):
+    """Connect clients to a port, they are closed after the test
+
+    Returns:
+      function: takes the port and config of a client, returns the connected
+        :class:`client.Client`
+    """
+    connected = []
+
+    def start(port, config={}):
+        root = tmp_path / "client{}".format(len(connected))
+        root.mkdir()
+        client = Client(_logger, dict({'download_root': str(root)}, **config))
+        connected.append((client, client.connect(port)))
+        return client
+
+    yield start
+    for client, thread in connected:
+        client.close()
+        thread.join()
+
+
+@pytest.fixture
+def raw():
+    """Open plain socket connections, they are closed after the test
+
+    Returns:
+      function: takes a port, returns a :class:`loopback.RawConnection`
+    """
+    opened = []
+
+    def start(port):
+        opened.append(RawConnection(port))
+        return opened[-1]
+
+    yield start
+    for connection in opened:
+        connection.close()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Helpers for tests that talk to a server over loopback.
+
+    RawConnection sends hand made frames, so tests can send what the client
+    never would and check what the server answers.
+"""
+
+import json
+import os
+import socket
+import time
+
+from message import Message, MessageType, FRAME_HEADER
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError("Timed out waiting for {}".format(condition))
+        time.sleep(0.005)
+
+
+def wait_for(path, timeout=10):
+    # Finished transfers are renamed into place, so the file appearing means
+    # it is complete
+    wait_until(lambda: os.path.exists(path), timeout)
+
+
+def read(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def frame(type, fields=None, content=b"", stream=0, flags=0):
+    """Build a version 0.2 frame with any header, valid or not
+
+    Args:
+      type (int): the message type
+      fields (obj): encoded as the JSON header, bytes are sent as they are
+      content (bytes): the content of the frame
+      stream (int): the stream of the frame
+      flags (int): the flags of the frame, a checksum is not appended
+
+    Returns:
+      bytes: the frame
+    """
+    header = b""
+    if isinstance(fields, bytes):
+        header = fields
+    elif fields is not None:
+        header = json.dumps(fields).encode('utf-8')
+    return FRAME_HEADER.pack(Message.MAGIC, type, flags, len(header), len(content),
+                             stream) + header + content
+
+
+class RawConnection:
+    def __init__(self, port, timeout=10):
+        """A plain socket connection to a server
+
+        Servers of the asyncio engine start listening in their own thread,
+        connecting is retried until they do.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.socket = socket.create_connection(('127.0.0.1', port), timeout)
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        self.buffer = b""
+
+    def send(self, data):
+        if isinstance(data, Message):
+            data = data.toBytes()
+        self.socket.sendall(data)
+
+    def receive(self, skipAcks=True):
+        """Wait for the next message from the server
+
+        Returns:
+          :class:`message.Message`: the message, None if the server closed
+            the connection
+        """
+        while True:
+            size = Message.frameSize(self.buffer) if self.buffer else None
+            if size is not None:
+                data, self.buffer = self.buffer[:size], self.buffer[size:]
+                message = Message.fromBytes(data)
+                if skipAcks and message.type == MessageType.Ack:
+                    continue
+                return message
+
+            received = self.socket.recv(65536)
+            if not received:
+                return None
+            self.buffer += received
+
+    def closed(self):
+        # True once the server closed the connection, whatever it sent before
+        try:
+            while True:
+                if not self.socket.recv(65536):
+                    return True
+        except socket.timeout:
+            return False
+
+    def close(self):
+        self.socket.close()
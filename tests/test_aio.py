@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import os
+
+import pytest
+from aio import AsyncClient, AsyncServer
+from loopback import wait_for, read, frame
+from message import Message, MessageType
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+@pytest.mark.parametrize("writers", [0, 2])
+def test_async_server(serve, connect, tmp_path, writers):
+    data = os.urandom(300000)
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+
+    _, port, root = serve({'writer_threads': writers}, engine=AsyncServer)
+    client = connect(port, {'file_segment_size': 65536})
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_for(os.path.join(root, "file.bin"))
+    assert read(os.path.join(root, "file.bin")) == data
+
+    client.commandQueue.put(client.download("file.bin"))
+    wait_for(os.path.join(client.config['download_root'], "file.bin"))
+    assert read(os.path.join(client.config['download_root'], "file.bin")) == data
+
+
+def test_async_client(serve, tmp_path):
+    data = os.urandom(300000)
+    paths = []
+    for index in range(3):
+        paths.append(tmp_path / "file{}.bin".format(index))
+        paths[-1].write_bytes(data[index:])
+
+    _, port, root = serve()
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+
+    async def transfer():
+        client = AsyncClient(_logger, {'download_root': str(downloads)})
+        await client.connect(port)
+        try:
+            # Several uploads share the connection at once
+            await asyncio.gather(*(client.sendFile(str(path)) for path in paths))
+            for path in paths:
+                wait_for(os.path.join(root, path.name))
+            return await client.download(paths[0].name)
+        finally:
+            await client.close()
+
+    downloaded = asyncio.run(transfer())
+    for index, path in enumerate(paths):
+        assert read(os.path.join(root, path.name)) == data[index:]
+    assert read(downloaded) == data
+
+
+def test_async_invalid_header(serve, raw):
+    _, port, _ = serve(engine=AsyncServer)
+    connection = raw(port)
+    connection.send(frame(MessageType.FileStart, {"filename": 123}, stream=1))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 1
+
+    connection.send(Message(type=MessageType.Download, filename="missing.bin", stream=2))
+    assert connection.receive().stream == 2
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+from batch import RECORD_HEADER, pack, safePath
+from loopback import wait_for, wait_until, read, frame
+from message import Message, MessageType
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+
+def record(name, content):
+    name = name.encode('utf-8')
+    return RECORD_HEADER.pack(len(name), len(content)) + name + content
+
+
+def test_pack(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.txt").write_bytes(b"a")
+    (tmp_path / "sub" / "b.txt").write_bytes(b"")
+    packed = b"".join(pack(str(tmp_path), 1024))
+    assert packed == record("a.txt", b"a") + record("sub/b.txt", b"")
+
+
+def test_safe_path(tmp_path):
+    root = str(tmp_path)
+    assert safePath(root, "a/./b//c") == os.path.join(root, "a", "b", "c")
+    for name in ("", ".", "..", "a/../../b", "/", "a\0b"):
+        with pytest.raises(RuntimeError):
+            safePath(root, name)
+
+
+def test_directory_upload(serve, connect, tmp_path):
+    directory = tmp_path / "upload"
+    (directory / "sub").mkdir(parents=True)
+    files = {"a.txt": os.urandom(1000), "sub/b.txt": os.urandom(100000), "sub/c.txt": b""}
+    for name, content in files.items():
+        (directory / name).write_bytes(content)
+
+    _, port, root = serve()
+    client = connect(port)
+    client.commandQueue.put(client.sendDirectory(str(directory)))
+    for name, content in files.items():
+        path = os.path.join(root, "upload", name)
+        wait_for(path)
+        wait_until(lambda: read(path) == content)
+
+
+@pytest.mark.parametrize("name", ["..", ".", "", "a/b"])
+def test_invalid_batch_name(serve, raw, name):
+    _, port, root = serve()
+    connection = raw(port)
+    connection.send(frame(MessageType.FileStart, {"filename": name, "batch": True},
+                          record("escaped.txt", b"outside"), stream=1))
+    connection.send(frame(MessageType.FileEnd, None, b"", stream=1))
+
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 1
+
+    # The server is still serving, and nothing was written
+    connection.send(Message(type=MessageType.Download, filename="missing.bin", stream=2))
+    assert connection.receive().stream == 2
+    assert os.listdir(root) == []
+    assert not os.path.exists(os.path.join(os.path.dirname(root), "escaped.txt"))
+
+
+@pytest.mark.parametrize("type", [MessageType.FileStart, MessageType.Download,
+                                  MessageType.Resume, MessageType.Signature],
+                         ids=lambda type: type.name)
+def test_invalid_names(serve, raw, type):
+    _, port, root = serve()
+    connection = raw(port)
+    for stream, name in enumerate(["..", ".", "", "a/b"], 1):
+        connection.send(frame(type, {"filename": name}, b"" if type != MessageType.FileStart
+                              else b"content", stream=stream))
+        answer = connection.receive()
+        assert answer.type == MessageType.Error
+        assert answer.stream == stream
+    assert os.listdir(root) == []
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import zlib
+
+import pytest
+from checksum import crc32c, crc32cSoftware, crc32, combine, CRC32C, CRC32
+from loopback import wait_for, read, frame
+from message import Message, MessageType, MessageFlag, FRAME_CHECKSUM
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+# Check values of CRC-32C, from RFC 3720 (iSCSI)
+VECTORS = [
+    (b"", 0),
+    (b"123456789", 0xE3069283),
+    (bytes(32), 0x8A9136AA),
+    (b"\xff" * 32, 0x62A8AB43),
+    (bytes(range(32)), 0x46DD794E),
+    (bytes(range(31, -1, -1)), 0x113FDB5C),
+]
+
+
+@pytest.mark.parametrize("data,expected", VECTORS)
+def test_vectors(data, expected):
+    assert crc32cSoftware(data) == expected
+    assert crc32c(data) == expected
+
+
+def test_lengths():
+    # The software implementation handles 8 bytes at a time and the rest
+    # bytewise, every split of that is covered
+    data = os.urandom(100)
+    for length in range(len(data)):
+        assert crc32cSoftware(data[:length]) == crc32c(data[:length])
+        assert crc32cSoftware(memoryview(data)[:length]) == crc32c(data[:length])
+
+
+def test_incremental():
+    data = os.urandom(10000)
+    crc = 0
+    for start in range(0, len(data), 777):
+        crc = crc32c(data[start:start + 777], crc)
+    assert crc == crc32c(data)
+    assert crc32cSoftware(data[5000:], crc32cSoftware(data[:5000])) == crc
+
+
+def test_combine():
+    data = os.urandom(5000)
+    for split in (0, 1, 7, 8, 1000, 4999, 5000):
+        first, second = data[:split], data[split:]
+        assert combine(crc32c(first), crc32c(second), len(second)) == crc32c(data)
+
+
+def test_combine_zeros():
+    assert combine(crc32c(b"123456789"), crc32c(bytes(32)), 32) == \
+        crc32c(b"123456789" + bytes(32))
+    assert combine(0, crc32c(b"\xff" * 32), 32) == 0x62A8AB43
+
+
+def test_crc32():
+    data = os.urandom(5000)
+    assert crc32(b"123456789") == 0xCBF43926
+    assert crc32(data[1000:], crc32(data[:1000])) == zlib.crc32(data)
+    for split in (0, 1, 7, 1000, 5000):
+        first, second = data[:split], data[split:]
+        assert combine(crc32(first), crc32(second), len(second), CRC32) == crc32(data)
+
+
+def test_message_algorithm():
+    flags = MessageFlag.Checksum | MessageFlag.Crc32
+    message = Message.fromBytes(Message(type=MessageType.FilePart, flags=flags,
+                                        content=b"123456789").toBytes())
+    assert message.algorithm() == CRC32
+    assert message.checksum == 0xCBF43926
+
+    # The flag says which checksum the frame carries
+    data = frame(MessageType.FilePart, None, b"123456789", flags=MessageFlag.Checksum)
+    with pytest.raises(RuntimeError):
+        Message.fromBytes(data + FRAME_CHECKSUM.pack(0xCBF43926))
+    assert Message.fromBytes(data + FRAME_CHECKSUM.pack(0xE3069283)).algorithm() == CRC32C
+
+
+@pytest.mark.parametrize("algorithm", [CRC32C, CRC32])
+def test_checksummed_transfers(serve, connect, tmp_path, algorithm):
+    data = os.urandom(300000)
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+
+    # Both ends check what they receive, whatever the other end picked
+    _, port, root = serve({'checksum_algorithm': algorithm, 'download_segment_size': 65536})
+    other = CRC32 if algorithm == CRC32C else CRC32C
+    client = connect(port, {'checksum_algorithm': other, 'file_segment_size': 65536})
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_for(os.path.join(root, "file.bin"))
+    assert read(os.path.join(root, "file.bin")) == data
+
+    client.commandQueue.put(client.download("file.bin"))
+    wait_for(os.path.join(client.config['download_root'], "file.bin"))
+    assert read(os.path.join(client.config['download_root'], "file.bin")) == data
+
+
+def test_corrupt_file_crc(serve, raw):
+    # A file whose checksum doesn't match the one of its FileEnd is discarded
+    _, port, root = serve()
+    connection = raw(port)
+    flags = MessageFlag.Checksum | MessageFlag.Crc32
+    connection.send(Message(type=MessageType.FileStart, flags=flags, filename="file.txt",
+                            content=b"12345", stream=1))
+    connection.send(Message(type=MessageType.FileEnd, flags=flags, crc=crc32c(b"12345"),
+                            content=b"", stream=1))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 1
+
+    connection.send(Message(type=MessageType.FileStart, flags=flags, filename="file.txt",
+                            content=b"12345", stream=2))
+    connection.send(Message(type=MessageType.FileEnd, flags=flags, crc=crc32(b"12345"),
+                            content=b"", stream=2))
+    wait_for(os.path.join(root, "file.txt"))
+    assert read(os.path.join(root, "file.txt")) == b"12345"
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import os
+import random
+
+import pytest
+from chunks import (manifest, packManifest, unpackManifest, packBitmap, unpackBitmap,
+                    manifestPath, MINIMUM_CHUNK_SIZE, MAXIMUM_CHUNK_SIZE)
+from client import Client
+from loopback import wait_for, read, frame
+from message import Message, MessageType
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+
+def randomBytes(size, seed=0):
+    # random.randbytes needs Python 3.9
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def test_manifest():
+    data = randomBytes(1048576)
+    entries = manifest(data)
+
+    # The chunks cover the data back to back, within the size limits
+    offset = 0
+    for digest, start, length in entries:
+        assert start == offset
+        assert digest == hashlib.sha256(data[start:start + length]).digest()
+        assert length <= MAXIMUM_CHUNK_SIZE
+        offset += length
+    assert offset == len(data)
+    assert all(length >= MINIMUM_CHUNK_SIZE for _, _, length in entries[:-1])
+    assert len(entries) > 1
+
+
+def test_manifest_small():
+    assert manifest(b"") == []
+    assert manifest(b"small") == [(hashlib.sha256(b"small").digest(), 0, 5)]
+
+
+def test_manifest_content_defined():
+    # Bytes inserted at the start only change the chunks around them
+    data = randomBytes(1048576)
+    digests = [digest for digest, _, _ in manifest(data)]
+    edited = [digest for digest, _, _ in manifest(b"inserted" + data)]
+    assert digests[0] != edited[0]
+    assert len(set(digests) & set(edited)) >= len(digests) - 2
+
+
+def test_manifest_packing():
+    entries = [(hashlib.sha256(bytes([index])).digest(), (index + 1) * 1000)
+               for index in range(5)]
+    packed = packManifest(entries)
+    assert len(packed) == 36 * len(entries)
+    assert unpackManifest(packed) == entries
+    assert unpackManifest(b"") == []
+    with pytest.raises(RuntimeError):
+        unpackManifest(packed[:-1])
+
+
+def test_manifest_size():
+    digest = hashlib.sha256(b"").digest()
+    assert unpackManifest(packManifest([(digest, 10), (digest, 20)]), 30) == [
+        (digest, 10), (digest, 20)]
+    with pytest.raises(RuntimeError):
+        unpackManifest(packManifest([(digest, 10), (digest, 20)]), 31)
+    with pytest.raises(RuntimeError):
+        unpackManifest(packManifest([(digest, MAXIMUM_CHUNK_SIZE + 1)]))
+    with pytest.raises(RuntimeError):
+        unpackManifest(packManifest([(digest, 0)]))
+
+
+def test_bitmap():
+    assert packBitmap([0, 9], 10) == b"\x80\x40"
+    assert packBitmap([], 0) == b""
+    assert unpackBitmap(b"\x80\x40", 10) == [0, 9]
+
+    indexes = [1, 2, 3, 8, 15, 16, 63, 64]
+    assert unpackBitmap(packBitmap(indexes, 65), 65) == indexes
+
+
+def test_bitmap_size():
+    assert unpackBitmap(b"\x80", 10) is None
+    assert unpackBitmap(b"\x80\x00\x00", 10) is None
+
+
+def test_chunked_upload(serve, connect, tmp_path):
+    data = randomBytes(1048576)
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+
+    _, port, root = serve({'chunk_store': True})
+    client = connect(port, {'chunked_uploads': True})
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_for(manifestPath(os.path.join(root, "file.bin")))
+
+    # The file is kept as its manifest, a download puts it back together
+    client.commandQueue.put(client.download("file.bin"))
+    wait_for(os.path.join(client.config['download_root'], "file.bin"))
+    assert read(os.path.join(client.config['download_root'], "file.bin")) == data
+
+
+@pytest.mark.parametrize("entries,size", [
+    ([MAXIMUM_CHUNK_SIZE + 1], MAXIMUM_CHUNK_SIZE + 1),
+    ([2 ** 32 - 1], 2 ** 32 - 1),
+    ([0], 0),
+    ([1000, 1000], 3000),
+], ids=["too long", "huge", "empty", "wrong size"])
+def test_invalid_manifest(serve, raw, entries, size):
+    _, port, root = serve({'chunk_store': True})
+    connection = raw(port)
+    digest = hashlib.sha256(b"").digest()
+    connection.send(frame(MessageType.Chunks, {"filename": "file.bin", "size": size},
+                          packManifest((digest, length) for length in entries), stream=1))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 1
+
+    # The server is still serving
+    connection.send(Message(type=MessageType.Download, filename="missing.bin", stream=2))
+    assert connection.receive().stream == 2
+
+
+def test_chunked_size_mismatch(serve, raw):
+    # The FileStart has to be of the file the manifest describes
+    _, port, root = serve({'chunk_store': True})
+    connection = raw(port)
+    connection.send(frame(MessageType.Chunks, {"filename": "file.bin", "size": 10},
+                          packManifest([(hashlib.sha256(bytes(10)).digest(), 10)]), stream=1))
+    assert connection.receive().type == MessageType.Chunks
+    connection.send(frame(MessageType.FileStart,
+                          {"filename": "file.bin", "size": 2 ** 40, "chunked": True},
+                          bytes(10), stream=2))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 2
+    assert not os.path.exists(manifestPath(os.path.join(root, "file.bin")))
+
+
+def test_close_with_work(serve, tmp_path):
+    # Manifests that weren't made yet are dropped when the client closes
+    _, port, _ = serve({'chunk_store': True})
+    client = Client(logging.getLogger(__name__), {
+        'download_root': str(tmp_path), 'chunked_uploads': True, 'worker_threads': 1})
+    thread = client.connect(port)
+    for index in range(8):
+        path = tmp_path / "file{}.bin".format(index)
+        path.write_bytes(randomBytes(1048576, index))
+        client.commandQueue.put(client.sendFile(str(path)))
+
+    client.close()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert len(client.submitted) == 0
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+from compression import (Compressor, Decompressor, worthCompressing, compressorFor, CODECS,
+                         PIECE_SIZE)
+from loopback import wait_for, read, frame
+from message import Message, MessageType
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+TEXT = b"".join(b"line %d of a file that compresses well\n" % index for index in range(20000))
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_round_trip(codec):
+    compressor = Compressor(codec)
+    compressed = b"".join(compressor.compress(TEXT[start:start + 4096])
+                          for start in range(0, len(TEXT), 4096)) + compressor.flush()
+    assert len(compressed) < len(TEXT) // 4
+
+    # The stream decompresses the same when it arrives in small pieces
+    decompressor = Decompressor(codec)
+    assert b"".join(piece for start in range(0, len(compressed), 1000)
+                    for piece in decompressor.decompress(compressed[start:start + 1000])) == TEXT
+
+
+def test_bounded_pieces():
+    # A small message may decompress to a lot, it is handed out a piece at a
+    # time
+    compressor = Compressor('zlib')
+    compressed = compressor.compress(bytes(PIECE_SIZE * 10)) + compressor.flush()
+    pieces = list(Decompressor('zlib').decompress(compressed))
+    assert max(len(piece) for piece in pieces) <= PIECE_SIZE
+    assert sum(len(piece) for piece in pieces) == PIECE_SIZE * 10
+
+
+def test_worth_compressing():
+    assert worthCompressing(TEXT[:65536])
+    assert not worthCompressing(os.urandom(65536))
+    assert not worthCompressing(b"")
+    assert compressorFor('zlib', os.urandom(65536)) is None
+    assert compressorFor('unknown', TEXT[:65536]).codec == 'zlib'
+
+
+def test_invalid():
+    with pytest.raises(RuntimeError):
+        Compressor('unknown')
+    with pytest.raises(RuntimeError):
+        Decompressor('unknown')
+    with pytest.raises(RuntimeError):
+        list(Decompressor('zlib').decompress(b"not a zlib stream"))
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_compressed_upload(serve, connect, tmp_path, codec):
+    path = tmp_path / "file.txt"
+    path.write_bytes(TEXT)
+
+    _, port, root = serve()
+    client = connect(port, {'compression': codec, 'file_segment_size': 65536})
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_for(os.path.join(root, "file.txt"))
+    assert read(os.path.join(root, "file.txt")) == TEXT
+
+
+@pytest.mark.parametrize("fields,content", [
+    ({"filename": "file.txt", "compression": "unknown"}, b""),
+    ({"filename": "file.txt", "compression": "zlib"}, b"not a zlib stream"),
+], ids=["unknown codec", "invalid stream"])
+def test_invalid_compressed_upload(serve, raw, fields, content):
+    _, port, root = serve()
+    connection = raw(port)
+    connection.send(frame(MessageType.FileStart, fields, content, stream=1))
+    connection.send(frame(MessageType.FileEnd, None, b"", stream=1))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 1
+
+    # The server is still serving, and didn't keep anything
+    connection.send(Message(type=MessageType.Download, filename="missing.bin", stream=2))
+    assert connection.receive().stream == 2
+    assert not os.path.exists(os.path.join(root, "file.txt"))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import random
+
+import pytest
+from delta import (blockSize, signatures, signatureTable, encode, patch, SIGNATURE,
+                   LITERAL_HEADER, COPY_OPERATION, COPY, MINIMUM_BLOCK_SIZE, MAXIMUM_BLOCK_SIZE,
+                   MAXIMUM_COPY_SIZE)
+from loopback import wait_until, read, frame
+from message import Message, MessageType
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+BLOCK_SIZE = MINIMUM_BLOCK_SIZE
+
+
+def randomBytes(size, seed=0):
+    # random.randbytes needs Python 3.9
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def roundTrip(tmp_path, basis, data, segmentSize=65536):
+    """Encode data against basis and patch basis with the operations
+
+    Returns:
+      tuple: the patched data and the packed operations
+    """
+    path = tmp_path / "basis"
+    path.write_bytes(basis)
+    with open(str(path), "rb") as file:
+        table = signatureTable(signatures(file, BLOCK_SIZE))
+        packed = list(encode(data, BLOCK_SIZE, table, segmentSize))
+        patched = b"".join(bytes(piece) for content in packed
+                           for piece in patch(content, file.fileno(), BLOCK_SIZE))
+    return patched, packed
+
+
+def test_block_size():
+    assert blockSize(0) == MINIMUM_BLOCK_SIZE
+    assert blockSize(1 << 30) == 32768
+    assert blockSize(1 << 40) == MAXIMUM_BLOCK_SIZE
+
+
+def test_signatures(tmp_path):
+    path = tmp_path / "basis"
+    path.write_bytes(randomBytes(BLOCK_SIZE * 3 + 100))
+    with open(str(path), "rb") as file:
+        packed = signatures(file, BLOCK_SIZE)
+
+    # The partial block at the end has no signature
+    assert len(packed) == SIGNATURE.size * 3
+    assert sum(len(strong) for strong in signatureTable(packed).values()) == 3
+
+
+def test_unchanged(tmp_path):
+    data = randomBytes(BLOCK_SIZE * 20)
+    patched, packed = roundTrip(tmp_path, data, data)
+    assert patched == data
+
+    # Only copies of runs of blocks are sent
+    assert sum(len(content) for content in packed) < 100
+
+
+def test_edited(tmp_path):
+    basis = randomBytes(BLOCK_SIZE * 20 + 123)
+    data = (b"inserted" + basis[:BLOCK_SIZE * 5] + basis[BLOCK_SIZE * 6:BLOCK_SIZE * 15] +
+            b"changed" + basis[BLOCK_SIZE * 15 + 7:] + b"appended")
+    patched, packed = roundTrip(tmp_path, basis, data)
+    assert patched == data
+    assert sum(len(content) for content in packed) < BLOCK_SIZE * 3
+
+
+def test_unrelated(tmp_path):
+    basis = randomBytes(BLOCK_SIZE * 4)
+    data = randomBytes(BLOCK_SIZE * 4 + 1, 1)
+    patched, packed = roundTrip(tmp_path, basis, data, 1000)
+    assert patched == data
+
+    # Literals are split to fill the segments, past their header
+    assert all(len(content) <= 1000 + LITERAL_HEADER.size for content in packed)
+    assert len(packed) > 1
+
+
+def test_empty(tmp_path):
+    patched, packed = roundTrip(tmp_path, b"", b"")
+    assert patched == b""
+    assert packed == []
+
+    patched, _ = roundTrip(tmp_path, b"", b"new")
+    assert patched == b"new"
+
+
+def test_invalid_operations(tmp_path):
+    path = tmp_path / "basis"
+    path.write_bytes(bytes(BLOCK_SIZE))
+    with open(str(path), "rb") as file:
+        for content in (b"\x02", b"\x00\x00\x00\x00\x05abc", b"\x01\x00\x00",
+                        b"\x01\x00\x00\x00\x01\x00\x00\x00\x01"):
+            with pytest.raises(RuntimeError):
+                list(patch(content, file.fileno(), BLOCK_SIZE))
+
+
+@pytest.mark.parametrize("first,count", [
+    (0, 0xFFFFFFFF),
+    (0, MAXIMUM_COPY_SIZE // BLOCK_SIZE + 1),
+    (0xFFFFFFFF, 1),
+    (3, 2),
+])
+def test_invalid_copies(tmp_path, first, count):
+    # Nothing is read (or allocated) for copies that can't be right
+    path = tmp_path / "basis"
+    path.write_bytes(bytes(BLOCK_SIZE * 4))
+    with open(str(path), "rb") as file:
+        with pytest.raises(RuntimeError):
+            list(patch(COPY_OPERATION.pack(COPY, first, count), file.fileno(), BLOCK_SIZE))
+
+
+def test_delta_upload(serve, connect, tmp_path):
+    basis = randomBytes(BLOCK_SIZE * 50)
+    data = basis[:BLOCK_SIZE * 20] + b"changed" + basis[BLOCK_SIZE * 21:]
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+
+    _, port, root = serve()
+    with open(os.path.join(root, "file.bin"), "wb") as file:
+        file.write(basis)
+    client = connect(port, {'delta_uploads': True, 'checksums': True})
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_until(lambda: read(os.path.join(root, "file.bin")) == data)
+
+
+@pytest.mark.parametrize("content", [
+    COPY_OPERATION.pack(COPY, 0, 0xFFFFFFFF),
+    COPY_OPERATION.pack(COPY, 10, 1),
+    b"\x07",
+], ids=["huge", "past the end", "invalid"])
+def test_invalid_delta_upload(serve, raw, content):
+    _, port, root = serve()
+    with open(os.path.join(root, "file.bin"), "wb") as file:
+        file.write(bytes(BLOCK_SIZE * 4))
+
+    connection = raw(port)
+    connection.send(frame(MessageType.FileStart, {"filename": "file.bin", "delta": BLOCK_SIZE},
+                          content, stream=1))
+    connection.send(frame(MessageType.FileEnd, None, b"", stream=1))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 1
+
+    # The server is still serving, and our copy is untouched
+    connection.send(Message(type=MessageType.Download, filename="missing.bin", stream=2))
+    assert connection.receive().stream == 2
+    assert read(os.path.join(root, "file.bin")) == bytes(BLOCK_SIZE * 4)
+
+
+@pytest.mark.parametrize("size", [0, 1, MAXIMUM_BLOCK_SIZE + 1, 2 ** 40])
+def test_invalid_block_size(serve, raw, size):
+    _, port, root = serve()
+    with open(os.path.join(root, "file.bin"), "wb") as file:
+        file.write(bytes(BLOCK_SIZE * 4))
+
+    connection = raw(port)
+    connection.send(frame(MessageType.FileStart, {"filename": "file.bin", "delta": size},
+                          COPY_OPERATION.pack(COPY, 0, 1), stream=1))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 1
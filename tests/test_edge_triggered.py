@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+from loopback import wait_for, read, RawConnection
+from message import Message, MessageType
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+
+def test_edge_triggered_transfers(serve, connect, tmp_path):
+    # Every receive and send drains its socket, or the rest would never be
+    # reported again
+    data = os.urandom(3000000)
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+
+    _, port, root = serve({'edge_triggered': True, 'internal_recv_size': 4096,
+                           'download_segment_size': 65536})
+    client = connect(port, {'file_segment_size': 65536})
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_for(os.path.join(root, "file.bin"))
+    assert read(os.path.join(root, "file.bin")) == data
+
+    client.commandQueue.put(client.download("file.bin"))
+    wait_for(os.path.join(client.config['download_root'], "file.bin"))
+    assert read(os.path.join(client.config['download_root'], "file.bin")) == data
+
+
+def test_accept_burst(serve):
+    # Connections that arrive at once are all accepted off one event
+    _, port, _ = serve({'edge_triggered': True, 'listen_backlog': 64})
+    connections = [RawConnection(port) for _ in range(32)]
+    try:
+        for stream, connection in enumerate(connections, 1):
+            connection.send(Message(type=MessageType.Download, filename="missing.bin",
+                                    stream=stream))
+        for stream, connection in enumerate(connections, 1):
+            answer = connection.receive()
+            assert answer.type == MessageType.Error
+            assert answer.stream == stream
+    finally:
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+from loopback import wait_for, read, frame
+from message import Message, MessageType
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+
+def test_acknowledged_upload(serve, connect, tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(os.urandom(2000000))
+
+    _, port, root = serve({'ack_bytes': 65536})
+    client = connect(port, {'file_segment_size': 16384})
+    client.commandQueue.put(client.sendFile(str(path)))
+    assert client.flush(10)
+    assert client.connection.peerAcked == client.sent
+    wait_for(os.path.join(root, "file.bin"))
+    assert read(os.path.join(root, "file.bin")) == path.read_bytes()
+
+
+def test_acknowledgements(serve, raw):
+    _, port, _ = serve()
+    connection = raw(port)
+    ack = Message(type=MessageType.Ack).toBytes()
+    connection.send(ack)
+
+    # Every byte we sent is acknowledged, the Ack included
+    answer = connection.receive(skipAcks=False)
+    assert answer.type == MessageType.Ack
+    assert answer.acked == len(ack)
+
+
+@pytest.mark.parametrize("acked", ["x", -1, 1.5, True, 1000000])
+def test_invalid_ack(serve, raw, acked):
+    _, port, _ = serve()
+    connection = raw(port)
+    connection.send(frame(MessageType.Ack, {"acked": acked}, stream=1))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 1
+
+    # The server is still serving
+    connection.send(Message(type=MessageType.Download, filename="missing.bin", stream=2))
+    assert connection.receive().stream == 2
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from loopback import frame
+from message import Message, MessageType, MessageFlag, FrameDecoder
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+
+def test_frame_round_trip():
+    message = Message(type=MessageType.FileStart, filename="file.txt", content=b"a\0b",
+                      size=3, stream=7)
+    parsed = Message.fromBytes(message.toBytes())
+    assert parsed.version == Message.VERSION
+    assert parsed.type == MessageType.FileStart
+    assert parsed.filename == "file.txt"
+    assert parsed.size == 3
+    assert parsed.offset is None
+    assert parsed.stream == 7
+    assert bytes(parsed.content) == b"a\0b"
+
+
+def test_frame_size():
+    data = Message(type=MessageType.FilePart, content=b"12345").toBytes()
+    assert Message.frameSize(data) == len(data)
+    assert Message.frameSize(b"xx" + data + b"yy", 2) == len(data)
+
+
+def test_frame_checksum():
+    message = Message(type=MessageType.FilePart, content=b"123456789",
+                      flags=MessageFlag.Checksum)
+    data = bytearray(message.toBytes())
+    assert Message.fromBytes(data).checksum == 0xE3069283
+
+    data[-5] ^= 1
+    with pytest.raises(RuntimeError):
+        Message.fromBytes(data)
+    assert bytes(Message.fromBytes(data, verify=False).content) == b"123456788"
+
+
+def test_legacy_parsing():
+    parsed = Message.fromBytes(b"SimFTP/0.1 1 file.txt some content\0")
+    assert parsed.version == Message.LEGACY_VERSION
+    assert parsed.type == MessageType.FileStart
+    assert parsed.filename == "file.txt"
+    assert bytes(parsed.content) == b"some content"
+
+    parsed = Message.fromBytes(b"SimFTP/0.1 2 some content")
+    assert parsed.type == MessageType.FilePart
+    assert bytes(parsed.content) == b"some content"
+
+
+def test_legacy_round_trip():
+    message = Message(type=MessageType.Download, filename="file.txt",
+                      version=Message.LEGACY_VERSION)
+    data = message.toBytes()
+    assert data == b"SimFTP/0.1 16 file.txt \0"
+    parsed = Message.fromBytes(data)
+    assert parsed.type == MessageType.Download
+    assert parsed.filename == "file.txt"
+
+
+def test_legacy_errors():
+    with pytest.raises(RuntimeError):
+        Message.fromBytes(b"SimFTP/0.9 2 some content\0")
+    with pytest.raises(RuntimeError):
+        Message.fromBytes(b"OtherP/0.1 2 some content\0")
+    with pytest.raises(RuntimeError):
+        Message.fromBytes(b"SimFTP/0.1 3 some content\0")
+
+
+@pytest.mark.parametrize("fields", [
+    {"filename": 123},
+    {"filename": None},
+    {"filename": "a\u0000b"},
+    {"filename": "file.txt", "size": "big"},
+    {"filename": "file.txt", "size": -1},
+    {"filename": "file.txt", "size": 2 ** 64},
+    {"filename": "file.txt", "size": True},
+    {"filename": "file.txt", "offset": 1.5},
+    {"filename": "file.txt", "batch": 1},
+    {"filename": "file.txt", "transfer": ["id"]},
+    {"filename": "file.txt", "mtime": "yesterday"},
+])
+def test_invalid_fields(fields):
+    data = frame(MessageType.FileStart, fields)
+    message = Message.fromBytes(data)
+    with pytest.raises(RuntimeError):
+        message.filename
+
+
+def test_valid_fields():
+    message = Message.fromBytes(frame(MessageType.FileStart, {
+        "filename": "file.txt", "size": 0, "mtime": 1.5, "batch": True, "transfer": "ab"}))
+    assert message.filename == "file.txt"
+    assert message.size == 0
+    assert message.mtime == 1.5
+    assert message.batch is True
+    assert message.offset is None
+
+
+def test_legacy_invalid_filename():
+    with pytest.raises(RuntimeError):
+        Message.fromBytes(b"SimFTP/0.1 1 \xff\xfe content\0")
+
+
+def test_decoder_partial_frames():
+    messages = [
+        Message(type=MessageType.FileStart, filename="file.txt", content=b"start"),
+        Message(type=MessageType.FilePart, content=b"part", flags=MessageFlag.Checksum),
+        Message(type=MessageType.FilePart, content=b"old part", version=Message.LEGACY_VERSION),
+        Message(type=MessageType.FileEnd, content=b""),
+    ]
+    data = b"".join(message.toBytes() for message in messages)
+
+    # Bytes arrive one at a time, only complete messages are parsed
+    decoder = FrameDecoder()
+    buffer = bytearray()
+    decoded = []
+    for byte in data:
+        buffer.append(byte)
+        parsed, used = decoder.decode(buffer)
+        decoded += [(message.type, bytes(message.content)) for message in parsed]
+
+        # The content of the messages is a view into the buffer
+        del parsed
+        del buffer[:used]
+
+    assert buffer == b""
+    assert decoded == [
+        (MessageType.FileStart, b"start"),
+        (MessageType.FilePart, b"part"),
+        (MessageType.FilePart, b"old part"),
+        (MessageType.FileEnd, b""),
+    ]
+
+
+def test_decoder_start_and_end():
+    part = Message(type=MessageType.FilePart, content=b"part").toBytes()
+    buffer = b"xx" + part + part[:5]
+    parsed, used = FrameDecoder().decode(buffer, 2, len(buffer) - 1)
+    assert len(parsed) == 1
+    assert used == len(part)
+
+
+def test_decoder_streams_large_files():
+    content = bytes(range(256)) * 64
+    data = Message(type=MessageType.FileStart, filename="file.txt", content=content,
+                   flags=MessageFlag.Checksum).toBytes()
+
+    decoder = FrameDecoder(maximumSize=1024)
+    pieces = []
+    for start in range(0, len(data), 1000):
+        parsed, used = decoder.decode(data[start:start + 1000])
+        assert used == len(data[start:start + 1000])
+        pieces += parsed
+
+    assert not any(isinstance(piece, Exception) for piece in pieces)
+    assert pieces[0].type == MessageType.FileStart
+    assert pieces[0].filename == "file.txt"
+    assert all(piece.type == MessageType.FilePart for piece in pieces[1:])
+    assert b"".join(bytes(piece.content) for piece in pieces) == content
+
+
+def test_decoder_drops_large_messages():
+    large = Message(type=MessageType.Error, content=b"x" * 2048, stream=3).toBytes()
+    small = Message(type=MessageType.FilePart, content=b"part").toBytes()
+
+    parsed, used = FrameDecoder(maximumSize=1024).decode(large + small)
+    assert used == len(large + small)
+    assert isinstance(parsed[0], RuntimeError)
+    assert parsed[0].stream == 3
+    assert bytes(parsed[1].content) == b"part"
+
+
+def test_decoder_invalid_stream():
+    with pytest.raises(RuntimeError):
+        FrameDecoder().decode(b"not a message at all, not even close")
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import urllib.request
+
+from loopback import free_port, wait_until, wait_for, frame
+from message import Message, MessageType
+from metrics import Metrics
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+
+def samples(exposition):
+    # The value of every sample of an exposition, by its name and labels
+    return {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+            for line in exposition.splitlines() if not line.startswith("#")}
+
+
+def test_exposition():
+    metrics = Metrics()
+    metrics.counter('test_total', "A counter").inc(3)
+    assert metrics.counter('test_total', "A counter").value == 3
+    metrics.gauge('test_gauge', "A gauge", lambda: 1.5)
+    histogram = metrics.histogram('test_seconds', "A histogram", (0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+
+    exposition = metrics.exposition()
+    assert "# TYPE test_total counter\n" in exposition
+    assert samples(exposition) == {
+        'test_total': 3,
+        'test_gauge': 1.5,
+        'test_seconds_bucket{le="0.1"}': 1,
+        'test_seconds_bucket{le="1"}': 2,
+        'test_seconds_bucket{le="+Inf"}': 3,
+        'test_seconds_sum': 5.55,
+        'test_seconds_count': 3,
+    }
+
+
+def test_server_metrics(serve, connect, raw, tmp_path):
+    data = os.urandom(100000)
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+
+    metricsPort = free_port()
+    _, port, root = serve({'metrics_port': metricsPort})
+    client = connect(port)
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_for(os.path.join(root, "file.bin"))
+
+    # An invalid message is counted too
+    connection = raw(port)
+    connection.send(frame(MessageType.FileStart, {"filename": 123}, stream=1))
+    assert connection.receive().type == MessageType.Error
+
+    def scrape():
+        url = "http://127.0.0.1:{}/metrics".format(metricsPort)
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return samples(response.read().decode('utf-8'))
+
+    wait_until(lambda: scrape()['simftp_receive_transfer_seconds_count'] == 1)
+    scraped = scrape()
+    assert scraped['simftp_received_bytes_total'] >= len(data)
+    assert scraped['simftp_accepted_connections_total'] == 2
+    assert scraped['simftp_connections'] == 2
+    assert scraped['simftp_parse_errors_total'] == 1
+    assert scraped['simftp_frames_total'] >= 3
+
+    connection.send(Message(type=MessageType.Download, filename="missing.bin", stream=2))
+    assert connection.receive().stream == 2
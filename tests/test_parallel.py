@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+from loopback import wait_for, read, frame
+from message import Message, MessageType
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+
+def test_parallel_upload(serve, connect, tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(os.urandom(1000000))
+
+    _, port, root = serve()
+    client = connect(port, {'file_segment_size': 65536})
+    client.commandQueue.put(client.sendFileParallel(str(path), 3))
+    wait_for(os.path.join(root, "file.bin"))
+    assert read(os.path.join(root, "file.bin")) == path.read_bytes()
+
+    # The ranges were assembled and their records removed
+    assert os.listdir(root) == ["file.bin"]
+
+
+@pytest.mark.parametrize("fields", [
+    {"size": "big", "offset": 0},
+    {"size": 10, "offset": "0"},
+    {"size": 10},
+    {"size": 10, "offset": 11},
+    {"size": 2 ** 62, "offset": 0},
+], ids=["size", "offset", "no offset", "past the end", "no room"])
+def test_invalid_segment(serve, raw, fields):
+    _, port, root = serve()
+    connection = raw(port)
+    connection.send(frame(MessageType.FileStart, dict(fields, filename="a", transfer="t1"),
+                          b"content", stream=1))
+    connection.send(frame(MessageType.FileEnd, None, b"", stream=1))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 1
+
+    # Nothing is left behind, and the server is still serving
+    connection.send(Message(type=MessageType.Download, filename="missing.bin", stream=2))
+    assert connection.receive().stream == 2
+    assert os.listdir(root) == []
+
+
+def test_invalid_transfer(serve, raw):
+    _, port, root = serve()
+    connection = raw(port)
+    connection.send(frame(MessageType.FileStart, {"filename": "a", "transfer": "../t1",
+                                                  "size": 10, "offset": 0}, b"", stream=1))
+    assert connection.receive().type == MessageType.Error
+    assert os.listdir(root) == []
+
+
+def test_other_size(serve, raw):
+    _, port, root = serve()
+    connection = raw(port)
+    start = {"filename": "a", "transfer": "t1", "size": 10, "offset": 0}
+    connection.send(frame(MessageType.FileStart, start, b"01234", stream=1))
+    connection.send(frame(MessageType.FileStart, dict(start, size=20, offset=5), b"", stream=2))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 2
+
+    # The first range carries on
+    connection.send(frame(MessageType.FileStart, dict(start, offset=5), b"56789", stream=3))
+    connection.send(frame(MessageType.FileEnd, None, b"", stream=3))
+    connection.send(frame(MessageType.FileEnd, None, b"", stream=1))
+    wait_for(os.path.join(root, "a"))
+    assert read(os.path.join(root, "a")) == b"0123456789"
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+
+import pytest
+from loopback import wait_until, wait_for, read
+from pool import ClientPool
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def pool(tmp_path):
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    clientPool = ClientPool(_logger, {'download_root': str(downloads),
+                                      'keepalive_interval': 0.05, 'ping_timeout': 1})
+    yield clientPool
+    clientPool.close()
+
+
+def test_pooled_transfers(serve, pool, tmp_path):
+    server, port, root = serve()
+    for index in range(3):
+        path = tmp_path / "file{}.txt".format(index)
+        path.write_bytes(b"content %d" % index)
+        assert pool.transfer(port, '127.0.0.1', 'sendFile', str(path))
+        wait_for(os.path.join(root, path.name))
+        assert read(os.path.join(root, path.name)) == b"content %d" % index
+
+    # One connection did all of it, and is pinged while it is idle
+    assert len(pool.idle[('127.0.0.1', port)]) == 1
+    client, _, _ = pool.idle[('127.0.0.1', port)][0]
+    sent = client.sent
+    wait_until(lambda: client.sent > sent)
+    assert "simftp_connections 1\n" in server.metrics.exposition()
+
+
+def test_closed_connection(serve, pool):
+    server, port, _ = serve()
+    with pool.connection(port) as client:
+        pass
+
+    # A client the server closed is dropped from the pool
+    server.close()
+    wait_until(lambda: client.done)
+    wait_until(lambda: len(pool.idle[('127.0.0.1', port)]) == 0)
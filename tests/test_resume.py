@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+
+import pytest
+from checksum import crc32c, crc32, CRC32C, CRC32, ALGORITHM, ALGORITHMS
+from loopback import wait_for, read
+from server import PartialFile
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+def interrupted(path, content, size):
+    # An upload of the first part of a file, interrupted after content
+    partialFile = PartialFile(_logger, path, size)
+    partialFile.write(content)
+    partialFile.interrupt(len(content), crc32c(content))
+    return partialFile
+
+
+def test_record(tmp_path):
+    path = str(tmp_path / "file.txt")
+    partialFile = interrupted(path, b"12345", 9)
+
+    assert os.path.exists(partialFile.tempPath)
+    assert PartialFile.readRecord(path) == {'size': 9, 'offset': 5, 'crc': crc32c(b"12345"),
+                                            'algorithm': CRC32C}
+    assert PartialFile.resumeOffset(path, 9) == (5, crc32c(b"12345"))
+    assert PartialFile.resumeOffset(path) == (5, crc32c(b"12345"))
+
+
+def test_no_record(tmp_path):
+    path = str(tmp_path / "file.txt")
+    assert PartialFile.readRecord(path) is None
+    assert PartialFile.resumeOffset(path, 9) == (0, None)
+
+    # A record that can't be read is no record
+    _, resumePath = PartialFile.paths(path)
+    with open(resumePath, "w") as record:
+        record.write("{\"size\": 9, \"off")
+    assert PartialFile.resumeOffset(path, 9) == (0, None)
+
+
+def test_other_size(tmp_path):
+    path = str(tmp_path / "file.txt")
+    interrupted(path, b"12345", 9)
+    assert PartialFile.resumeOffset(path, 10) == (0, None)
+
+
+def test_other_algorithm(tmp_path):
+    # An upload checksummed with CRC-32 is only continued with CRC-32
+    path = str(tmp_path / "file.txt")
+    partialFile = PartialFile(_logger, path, 9, algorithm=CRC32)
+    partialFile.write(b"12345")
+    partialFile.interrupt(5, crc32(b"12345"))
+
+    assert PartialFile.resumeOffset(path, 9) == (0, None)
+    assert PartialFile.resumeOffset(path, 9, CRC32) == (5, crc32(b"12345"))
+    with pytest.raises(RuntimeError):
+        PartialFile(_logger, path, 9, 5)
+    partialFile = PartialFile(_logger, path, 9, 5, algorithm=CRC32)
+    assert partialFile.crc == crc32(b"12345")
+    partialFile.close()
+
+
+def test_missing_content(tmp_path):
+    path = str(tmp_path / "file.txt")
+    partialFile = interrupted(path, b"12345", 9)
+
+    os.truncate(partialFile.tempPath, 3)
+    assert PartialFile.resumeOffset(path, 9) == (0, None)
+    os.unlink(partialFile.tempPath)
+    assert PartialFile.resumeOffset(path, 9) == (0, None)
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path / "file.txt")
+    interrupted(path, b"12345", 9)
+
+    offset, crc = PartialFile.resumeOffset(path, 9)
+    partialFile = PartialFile(_logger, path, 9, offset)
+    assert partialFile.crc == crc
+    partialFile.write(b"6789")
+    partialFile.finish()
+
+    with open(path, "rb") as file:
+        assert file.read() == b"123456789"
+    assert not os.path.exists(partialFile.tempPath)
+    assert not os.path.exists(partialFile.resumePath)
+
+
+def test_resume_drops_unrecorded(tmp_path):
+    path = str(tmp_path / "file.txt")
+    partialFile = interrupted(path, b"12345", 9)
+
+    # Written after the record, before the connection went away
+    with open(partialFile.tempPath, "r+b") as file:
+        file.seek(5)
+        file.write(b"xx")
+
+    # The rest of the file is preallocated again
+    PartialFile(_logger, path, 9, 5).close()
+    with open(partialFile.tempPath, "rb") as file:
+        assert file.read() == b"12345" + bytes(4)
+
+
+def test_resume_other_offset(tmp_path):
+    path = str(tmp_path / "file.txt")
+    interrupted(path, b"12345", 9)
+    with pytest.raises(RuntimeError):
+        PartialFile(_logger, path, 9, 4)
+
+
+def test_start_over(tmp_path):
+    path = str(tmp_path / "file.txt")
+    interrupted(path, b"12345", 9)
+
+    partialFile = PartialFile(_logger, path, 9)
+    assert PartialFile.readRecord(path) is None
+    partialFile.discard()
+    assert not os.path.exists(partialFile.tempPath)
+    assert not os.path.exists(partialFile.resumePath)
+
+
+@pytest.mark.parametrize("changed", [False, True], ids=["same", "changed"])
+def test_resumed_upload(serve, connect, tmp_path, changed):
+    data = os.urandom(1048576)
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+
+    # The server has the first half of the file from an interrupted upload,
+    # or of an older version of it
+    server, port, root = serve()
+    first = os.urandom(524288) if changed else data[:524288]
+    partialFile = PartialFile(_logger, os.path.join(root, "file.bin"), len(data),
+                              algorithm=ALGORITHM)
+    partialFile.write(first)
+    partialFile.interrupt(len(first), ALGORITHMS[ALGORITHM](first))
+
+    client = connect(port, {'file_segment_size': 65536})
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_for(os.path.join(root, "file.bin"))
+    assert read(os.path.join(root, "file.bin")) == data
+
+    # Only the second half was sent, unless the file changed
+    received = server.metrics.counter('simftp_received_bytes_total', "").value
+    assert (received > len(data)) == changed
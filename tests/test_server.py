@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+from loopback import wait_for, read, frame
+from message import Message, MessageType
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+
+def test_upload(serve, connect, tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(os.urandom(300000))
+
+    _, port, root = serve()
+    client = connect(port, {'file_segment_size': 65536})
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_for(os.path.join(root, "file.bin"))
+    assert read(os.path.join(root, "file.bin")) == path.read_bytes()
+
+
+def test_download(serve, connect):
+    content = os.urandom(3000000)
+    _, port, root = serve({'download_segment_size': 65536})
+    with open(os.path.join(root, "file.bin"), "wb") as file:
+        file.write(content)
+
+    client = connect(port)
+    client.commandQueue.put(client.download("file.bin"))
+    path = os.path.join(client.config['download_root'], "file.bin")
+    wait_for(path)
+    assert read(path) == content
+
+
+def test_missing_download(serve, raw):
+    _, port, _ = serve()
+    connection = raw(port)
+    connection.send(Message(type=MessageType.Download, filename="missing.bin"))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert b"missing.bin" in bytes(answer.content)
+
+
+def test_legacy_upload(serve, connect, tmp_path):
+    # Version 0.1 messages end at a null character, so content is text
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"some text " * 10000)
+
+    _, port, root = serve()
+    client = connect(port, {'protocol_version': Message.LEGACY_VERSION,
+                            'resume_uploads': False})
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_for(os.path.join(root, "file.txt"))
+    assert read(os.path.join(root, "file.txt")) == path.read_bytes()
+
+
+def test_invalid_header(serve, raw):
+    _, port, root = serve()
+    connection = raw(port)
+
+    # Each is turned down on its stream, the rest of the upload is ignored
+    connection.send(frame(MessageType.FileStart, {"filename": 123}, b"content", stream=1))
+    connection.send(frame(MessageType.FilePart, None, b"more", stream=1))
+    connection.send(frame(MessageType.FileEnd, None, b"", stream=1))
+    connection.send(frame(MessageType.FileStart, b"not json", b"content", stream=2))
+    connection.send(frame(MessageType.Ack, {"acked": "x"}, stream=3))
+    for stream in (1, 2, 3):
+        answer = connection.receive()
+        assert answer.type == MessageType.Error
+        assert answer.stream == stream
+
+    # The server is still serving
+    connection.send(Message(type=MessageType.Download, filename="missing.bin"))
+    assert b"missing.bin" in bytes(connection.receive().content)
+    assert os.listdir(root) == []
+
+
+def test_sized_upload(serve, connect, tmp_path):
+    # The announced mode and modification time are given to the file
+    path = tmp_path / "file.bin"
+    path.write_bytes(os.urandom(100000))
+    os.chmod(str(path), 0o640)
+    os.utime(str(path), (1700000000.5, 1700000000.5))
+
+    _, port, root = serve()
+    client = connect(port)
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_for(os.path.join(root, "file.bin"))
+    info = os.stat(os.path.join(root, "file.bin"))
+    assert info.st_size == 100000
+    assert info.st_mtime == 1700000000.5
+    assert info.st_mode & 0o777 == 0o640
+
+
+def test_missing_root(serve, raw, tmp_path):
+    _, port, _ = serve({'file_root': str(tmp_path / "missing")})
+    connection = raw(port)
+    connection.send(frame(MessageType.FileStart, {"filename": "file.bin"}, b"content", stream=1))
+    connection.send(frame(MessageType.FileEnd, None, b"", stream=1))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 1
+
+    # The server is still serving
+    connection.send(Message(type=MessageType.Download, filename="missing.bin", stream=2))
+    assert connection.receive().stream == 2
+
+
+def test_no_room(serve, raw):
+    _, port, root = serve()
+    connection = raw(port)
+    connection.send(frame(MessageType.FileStart, {"filename": "file.bin", "size": 2 ** 62},
+                          b"content", stream=1))
+    answer = connection.receive()
+    assert answer.type == MessageType.Error
+    assert answer.stream == 1
+    assert os.listdir(root) == []
+
+
+def test_interleaved_streams(serve, raw):
+    # The messages of several uploads arrive mixed, each stream is its own
+    _, port, root = serve()
+    connection = raw(port)
+    for stream in (1, 2, 3):
+        connection.send(Message(type=MessageType.FileStart, filename="file{}.txt".format(stream),
+                                content=b"start %d " % stream, stream=stream))
+    for stream in (3, 1, 2):
+        connection.send(Message(type=MessageType.FilePart, content=b"part %d " % stream,
+                                stream=stream))
+    for stream in (2, 3, 1):
+        connection.send(Message(type=MessageType.FileEnd, content=b"end %d" % stream,
+                                stream=stream))
+
+    for stream in (1, 2, 3):
+        path = os.path.join(root, "file{}.txt".format(stream))
+        wait_for(path)
+        assert read(path) == b"start %d part %d end %d" % (stream, stream, stream)
+
+
+def test_concurrent_transfers(serve, connect, tmp_path):
+    data = os.urandom(200000)
+    _, port, root = serve({'download_segment_size': 16384})
+    for index in range(2):
+        with open(os.path.join(root, "download{}.bin".format(index)), "wb") as file:
+            file.write(data[index:])
+
+    # Uploads and downloads share the connection, a segment of each at a
+    # time
+    client = connect(port, {'file_segment_size': 16384, 'max_streams': 8})
+    for index in range(6):
+        path = tmp_path / "upload{}.bin".format(index)
+        path.write_bytes(data[index:])
+        client.commandQueue.put(client.sendFile(str(path)))
+    for index in range(2):
+        client.commandQueue.put(client.download("download{}.bin".format(index)))
+
+    for index in range(6):
+        wait_for(os.path.join(root, "upload{}.bin".format(index)))
+        assert read(os.path.join(root, "upload{}.bin".format(index))) == data[index:]
+    for index in range(2):
+        path = os.path.join(client.config['download_root'], "download{}.bin".format(index))
+        wait_for(path)
+        assert read(path) == data[index:]
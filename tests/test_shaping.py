@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+import pytest
+from loopback import wait_for, read
+from shaping import TokenBucket
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+
+def test_full():
+    bucket = TokenBucket(1000, 500)
+    assert bucket.available(bucket.updated) == 500
+    assert bucket.ready(500, bucket.updated) == 0
+
+
+def test_refill():
+    bucket = TokenBucket(1000, 500)
+    start = bucket.updated
+    bucket.take(500)
+    assert bucket.available(start) == 0
+    assert bucket.available(start + 0.1) == pytest.approx(100)
+    assert bucket.ready(300, start + 0.1) == pytest.approx(0.2)
+
+    # Never more than the burst
+    assert bucket.available(start + 10) == 500
+
+
+def test_debt():
+    # A send that overshoots what was available is paid back first
+    bucket = TokenBucket(1000, 500)
+    start = bucket.updated
+    bucket.take(1500)
+    assert bucket.available(start) == -1000
+    assert bucket.ready(500, start) == pytest.approx(1.5)
+    assert bucket.available(start + 1) == pytest.approx(0)
+
+
+@pytest.mark.parametrize("limit", ['rate_limit', 'ip_rate_limit', 'connection_rate_limit'])
+def test_limited_upload(serve, connect, tmp_path, limit):
+    # 1 MB at 4 MB/s takes a quarter of a second, less the burst saved up
+    data = os.urandom(1048576)
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+
+    _, port, root = serve({limit: 4194304, 'rate_burst': 0.1})
+    client = connect(port, {'file_segment_size': 65536})
+    started = time.monotonic()
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_for(os.path.join(root, "file.bin"))
+    assert time.monotonic() - started >= 0.1
+    assert read(os.path.join(root, "file.bin")) == data
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import pstats
+import time
+
+from loopback import wait_until, wait_for
+from tracing import Tracer, profiled
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+def test_sampling():
+    tracer = Tracer(_logger, sample=3)
+    assert [tracer.sampled() for _ in range(6)] == [False, False, True] * 2
+
+
+def test_trace_file(tmp_path):
+    path = str(tmp_path / "trace.json")
+    tracer = Tracer(_logger, path)
+    tracer.record("recv", time.perf_counter(), size=10)
+    tracer.traced("write", len)(b"abc")
+    tracer.close()
+
+    with open(path) as file:
+        events = json.load(file)['traceEvents']
+    assert [event['name'] for event in events] == ["recv", "write"]
+    assert events[0]['args'] == {'size': 10}
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events)
+    assert "recv" in tracer.summary()
+
+
+def test_profiled(tmp_path):
+    assert profiled(len, None) is len
+    path = str(tmp_path / "profile")
+    assert profiled(len, path)(b"abc") == 3
+    assert pstats.Stats(path).total_calls > 0
+
+
+def test_traced_server(serve, connect, tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(os.urandom(300000))
+    tracePath = str(tmp_path / "trace.json")
+
+    server, port, root = serve({'trace': tracePath})
+    client = connect(port, {'file_segment_size': 65536})
+    client.commandQueue.put(client.sendFile(str(path)))
+    wait_for(os.path.join(root, "file.bin"))
+
+    # The trace is written once the server is closed
+    def load():
+        try:
+            with open(tracePath) as file:
+                return json.load(file)['traceEvents']
+        except (OSError, ValueError):
+            return None
+
+    server.close()
+    wait_until(lambda: load() is not None)
+    assert {"recv", "parse", "process"} <= {event['name'] for event in load()}
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import signal
+from threading import Thread
+
+import pytest
+from loopback import free_port, wait_until, wait_for, read, RawConnection
+from message import Message, MessageType
+from workers import Workers
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def workers(tmp_path):
+    # Two worker processes sharing a port, stopped after the test
+    root = tmp_path / "server"
+    root.mkdir()
+    port = free_port()
+    group = Workers(_logger, {'workers': 2, 'restart_delay': 0, 'file_root': str(root)})
+    group.listen(port, '127.0.0.1')
+    supervisor = Thread(target=group.supervise)
+    supervisor.start()
+
+    yield group, port, str(root)
+    group.close()
+    supervisor.join(10)
+
+
+def test_workers(workers, connect, tmp_path):
+    _, port, root = workers
+    data = os.urandom(100000)
+    clients = [connect(port) for _ in range(4)]
+    for index, client in enumerate(clients):
+        path = tmp_path / "file{}.bin".format(index)
+        path.write_bytes(data[index:])
+        client.commandQueue.put(client.sendFile(str(path)))
+
+    for index in range(len(clients)):
+        wait_for(os.path.join(root, "file{}.bin".format(index)))
+        assert read(os.path.join(root, "file{}.bin".format(index))) == data[index:]
+
+
+def test_worker_restart(workers):
+    group, port, _ = workers
+    pid = next(iter(group.workers))
+    os.kill(pid, signal.SIGKILL)
+    wait_until(lambda: pid not in group.workers and len(group.workers) == 2)
+
+    # Whichever worker takes the connection answers it
+    connection = RawConnection(port)
+    connection.send(Message(type=MessageType.Download, filename="missing.bin", stream=1))
+    assert connection.receive().type == MessageType.Error
+    connection.close()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+from threading import Event
+
+import pytest
+from loopback import wait_for, read
+from writer import WriterPool
+
+__author__ = "Ayrton Sparling"
+__copyright__ = "Ayrton Sparling"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def pool():
+    writerPool = WriterPool(_logger, {'writer_threads': 2, 'writer_queue_size': 4})
+    yield writerPool
+    writerPool.close()
+
+
+def test_order(pool):
+    # The operations of a queue run one after the other, in order
+    done = []
+    finished = Event()
+    writerQueue = pool.createQueue()
+    for index in range(100):
+        writerQueue.submit(done.append, index)
+    writerQueue.submit(finished.set)
+    assert finished.wait(10)
+    assert done == list(range(100))
+
+
+def test_failure(pool):
+    # Once an operation of an owner failed its later operations are dropped,
+    # those of other owners still run
+    failures = []
+    done = []
+    finished = Event()
+    writerQueue = pool.createQueue(onFailed=lambda owner, err: failures.append((owner, err)))
+    writerQueue.submit(done.append, 1, owner="a")
+    writerQueue.submit(int, "x", owner="a")
+    writerQueue.submit(done.append, 2, owner="a")
+    writerQueue.submit(done.append, 3, owner="b")
+    writerQueue.submit(finished.set)
+    assert finished.wait(10)
+    assert done == [1, 3]
+    assert len(failures) == 1 and failures[0][0] == "a"
+
+
+def test_backpressure(pool):
+    # A full queue tells its connection once it drained to half its limit
+    blocked = Event()
+    drained = Event()
+    writerQueue = pool.createQueue(onDrained=drained.set)
+    writerQueue.submit(blocked.wait)
+    for _ in range(4):
+        writerQueue.submit(len, b"")
+    assert writerQueue.full()
+    assert writerQueue.pause()
+    blocked.set()
+    assert drained.wait(10)
+
+
+@pytest.mark.parametrize("config", [
+    {'writer_threads': 0},
+    {'writer_threads': 2, 'writer_queue_size': 2},
+], ids=["inline", "writer threads"])
+def test_uploads(serve, connect, tmp_path, config):
+    data = os.urandom(1048576)
+    _, port, root = serve(dict(config, internal_buffer_size=16384))
+    clients = [connect(port, {'file_segment_size': 4096}) for _ in range(3)]
+    for index, client in enumerate(clients):
+        path = tmp_path / "file{}.bin".format(index)
+        path.write_bytes(data[index:])
+        client.commandQueue.put(client.sendFile(str(path)))
+
+    for index in range(len(clients)):
+        wait_for(os.path.join(root, "file{}.bin".format(index)))
+        assert read(os.path.join(root, "file{}.bin".format(index))) == data[index:]